@@ -258,6 +258,8 @@ sub generate_epicurve_files {
     return;
 }
 
+#  lib/SircaUI/animation.py does this without the intermediate image
+#  files, and can also write APNG and MP4
 sub generate_animations {
 
     foreach my $master (@$master_models) {
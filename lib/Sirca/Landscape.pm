@@ -5,6 +5,7 @@ use strict;
 use warnings;
 use Carp;
 use File::Spec;
+use Digest::MD5 qw /md5_hex/;
 
 use English qw { -no_match_vars };
 
@@ -14,18 +15,38 @@ use Sirca::Stats;
 
 use base qw /Sirca::Utilities/;
 
+my %default_params = (
+    REPETITIONS     => 10,
+    ITERATIONS      => 10,
+    OUTSUFFIX       => 'scs',
+    OUTSUFFIX_YAML  => 'scy',
+);
+
+#  model params that the groups, spatial index, search blocks and
+#  neighbour caches are built from.  Models are rebuilt if these change.
+#  (PARAMSFILES are only reloaded if the list of files changes.
+#  The GUI expands them before sending a config.)
+my %rebuild_params = map {$_ => 1} qw /
+    DENSITY_FILES
+    DENSITYPARAMS
+    STATESFILE
+    STATESFILES
+    BANDWIDTH
+    NBRHOOD
+    MAXNBRHOOD
+    INDEX_SEARCH_BLOCKS
+    JOIN_CHAR
+    LABEL
+    PARAMSFILES
+/;
+
 sub new {
     my $class = shift;
     my %args = @_;
 
     my $self = bless {}, $class;
 
-    $self->set_params (
-        REPETITIONS     => 10,
-        ITERATIONS      => 10,
-        OUTSUFFIX       => 'scs',
-        OUTSUFFIX_YAML  => 'scy',
-    );
+    $self->set_params (%default_params);
 
     # try to load an existing file
     if (defined $args{file}) {
@@ -124,47 +145,192 @@ sub get_model_params {
 sub init_models {
     my $self = shift;
 
-    my $repetitions = $self->get_param ('REPETITIONS');
-    my $iterations  = $self->get_param ('ITERATIONS');
-    
-    my $model_density_stats = $self->get_model_density_stats_ref;
-    my $model_count_stats   = $self->get_model_count_stats_ref;
-
     my $master_models = $self->get_master_models;
     
     my $a = $self->get_param ('MODEL_CONTROLS');  #  this is the array of model controls
     
     foreach my $i (0 .. $#$a) {
+        $master_models->[$i] = $self->build_model (model_iter => $i);
+    }
 
-        # load model object
-        my $model;
+    $self->reset_run_state;
+}
 
-        my $control_files = $self->get_model_control(
-            model_iter => $i,
-            control    => 'PARAMSFILES',
+#  load a master model from its model controls
+sub build_model {
+    my $self = shift;
+    my %args = @_;
+
+    my $i = $args{model_iter};
+    croak "model_iter is not defined\n" if ! defined $i;
+
+    my $iterations = $self->get_param ('ITERATIONS');
+
+    # load model object
+    my $model;
+
+    my $control_files = $self->get_model_control(
+        model_iter => $i,
+        control    => 'PARAMSFILES',
+    );
+
+    if (defined $control_files) {
+        # get model parameters via control files
+        $model = Sirca::Population->new (
+            control_files => $control_files,
+            ITERATIONS    => $iterations,
         );
+    }
+    else {
+        # get parameters via the global parameters hash
+        my $model_params = $self->get_model_params(model_iter => $i);
+        $model_params->{ITERATIONS} = $iterations;
+        $model = Sirca::Population->new (
+            params_hash => $model_params,
+            ITERATIONS  => $iterations,
+        );
+    }
 
-        if (defined $control_files) {
-            # get model parameters via control files
-            $model = Sirca::Population->new (
-                control_files => $control_files,
-                ITERATIONS    => $iterations,
-            );
+    #  the density image is only made if images are written (by to_image)
+    $model->get_image_params;
+
+    return $model;
+}
+
+#  apply a new config to the loaded landscape, rather than building a new
+#  one.  Only the models whose groups or spatial structures depend on
+#  what changed are rebuilt, and the rest have their params patched.
+#  Results of previous runs are cleared, as they are by new.
+#  Returns the number of models rebuilt.
+sub update_params {
+    my $self = shift;
+    my %args = @_;
+
+    my $config = $args{config} || croak "config not specified\n";
+
+    my $old_controls   = $self->get_param ('MODEL_CONTROLS') || [];
+    my $old_iterations = $self->get_param ('ITERATIONS');
+
+    #  params missing from the new config go back to their defaults (or away)
+    foreach my $key (keys %{$self->get_params_hash}) {
+        next if exists $config->{$key};
+        if (exists $default_params{$key}) {
+            $self->set_param ($key => $default_params{$key});
         }
         else {
-            # get parameters via the global parameters hash
-            my $model_params = $self->get_model_params(model_iter => $i);
-            $model_params->{ITERATIONS} = $iterations;
-            $model = Sirca::Population->new (
-                params_hash => $model_params,
-                ITERATIONS  => $iterations,
-            );
+            $self->delete_param ($key);
+        }
+    }
+    $self->set_params (%$config);
+
+    my $iterations    = $self->get_param ('ITERATIONS');
+    my $new_controls  = $self->get_param ('MODEL_CONTROLS');
+    my $master_models = $self->get_master_models;
+    $#$master_models  = $#$new_controls;  #  drop any removed models
+
+    my $rebuilt = 0;
+    foreach my $i (0 .. $#$new_controls) {
+        my $model = $master_models->[$i];
+        my $old   = $old_controls->[$i];
+        my $new   = $new_controls->[$i];
+
+        my @changed = defined $old
+                    ? grep {params_differ ($old->{$_}, $new->{$_})} keys %{{%$old, %$new}}
+                    : ();
+
+        if (! defined $model || ! defined $old || grep {$rebuild_params{$_}} @changed) {
+            $master_models->[$i] = $self->build_model (model_iter => $i);
+            $rebuilt ++;
+            next;
         }
 
-        $master_models->[$i] = $model;
+        #  build_model adds the ITERATIONS to the controls
+        $new->{ITERATIONS} = $iterations;
+        @changed = grep {$_ ne 'ITERATIONS'} @changed;
+        next if ! @changed and $iterations == $old_iterations;
+
+        my $defaults = $model->get_default_params;
+        foreach my $key (@changed) {
+            if (exists $new->{$key}) {
+                $model->set_param ($key => $new->{$key});
+            }
+            elsif (exists $defaults->{$key}) {
+                $model->set_param ($key => $defaults->{$key});
+            }
+            else {
+                $model->delete_param ($key);
+            }
+        }
+        $model->set_param (ITERATIONS => $iterations);
+        $model->process_args;  #  the death function, MAX_STATE and OUTPFX
+
+        #  the image size depends on the cellsize, and the image is
+        #  remade from it when next needed
+        if (grep {$_ eq 'IMAGE_CELLSIZE'} @changed) {
+            $model->delete_param ('DENSITY_IMAGE');
+            $model->get_image_params;
+        }
+    }
+
+    $self->reset_run_state;
+
+    $self->update_log (
+        text => "Updated landscape params: rebuilt $rebuilt of "
+              . scalar @$new_controls
+              . " models\n",
+    );
+
+    return $rebuilt;
+}
+
+#  true if two param values (nested hashes, arrays and scalars) differ
+sub params_differ {
+    my ($x, $y) = @_;
+
+    return 0 if ! defined $x and ! defined $y;
+    return 1 if ! defined $x or ! defined $y;
+
+    my $type = ref $x;
+    return 1 if $type ne ref $y;
+
+    if (! $type) {
+        return $x ne $y;
+    }
+    if ($type eq 'ARRAY') {
+        return 1 if scalar @$x != scalar @$y;
+        foreach my $i (0 .. $#$x) {
+            return 1 if params_differ ($x->[$i], $y->[$i]);
+        }
+        return 0;
+    }
+    if ($type eq 'HASH') {
+        return 1 if scalar keys %$x != scalar keys %$y;
+        foreach my $key (keys %$x) {
+            return 1 if ! exists $y->{$key};
+            return 1 if params_differ ($x->{$key}, $y->{$key});
+        }
+        return 0;
+    }
+
+    #  objects and other refs are only the same if they are the same one
+    return $x != $y;
+}
+
+#  clear the stats, random states and events of previous runs
+sub reset_run_state {
+    my $self = shift;
+
+    delete @$self{qw /MODEL_STATS REPETITION_STATS RAND_LAST_STATES STORED_EVENTS CURRENT_MODELS/};
+
+    my $iterations = $self->get_param ('ITERATIONS');
+
+    my $model_density_stats = $self->get_model_density_stats_ref;
+    my $model_count_stats   = $self->get_model_count_stats_ref;
+
+    my $master_models = $self->get_master_models;
 
-        $model->get_image_params;
-        my $img = $model->get_density_image;
+    foreach my $i (0 .. $#$master_models) {
+        my $model = $master_models->[$i];
 
         #  zero iteration is the starting state
         for my $j (0 .. $iterations) {
@@ -281,6 +447,25 @@ sub get_model_stats_ref {
     return wantarray ? %$stats : $stats;
 }
 
+#  adds a value to the stats of a model, state and timestep, keeping it
+#  with the repetition's other values when they are needed for merging
+sub add_model_stats_data {
+    my $self = shift;
+    my %args = @_;
+
+    my $type = $args{type};  #  COUNT or DENSITY
+    my ($model_iter, $timestep, $state) = @args{qw /model_iter timestep state/};
+
+    $self->{MODEL_STATS}{$type}[$model_iter][$timestep][$state]->add_data ($args{value});
+
+    if ($self->get_param ('RAND_STREAMS')) {
+        my $repetition = $args{repetition} // croak "repetition not specified\n";
+        $self->{REPETITION_STATS}[$repetition]{$type}[$model_iter][$timestep][$state] = $args{value};
+    }
+
+    return;
+}
+
 sub get_rand_state_at_end {
     my $self = shift;
     my %args = @_;
@@ -334,20 +519,33 @@ sub get_stored_model_events {
 }
 
 
+#  progress_callback, if given, is called with repetition, from and to
+#  args each time the stats for timesteps from..to have been updated
+#  repetitions, if given, is a list of the repetitions to run, which needs
+#  RAND_STREAMS (otherwise each repetition follows on from the one before)
 sub run {
     my $self = shift;
+    my %args = @_;
     
     my $master_models = $self->get_master_models;
     my $max_model_iter = $#$master_models;
     my $model_controls = $self->get_param ('MODEL_CONTROLS');
     my $model_stats = $self->get_model_stats_ref;
     
-    my $repetitions = $self->get_param ('REPETITIONS');
+    my @repetitions = (1 .. $self->get_param ('REPETITIONS'));
+    if (defined $args{repetitions}) {
+        croak "Can only run some of the repetitions with RAND_STREAMS set\n"
+          if ! $self->get_param ('RAND_STREAMS');
+        @repetitions = @{$args{repetitions}};
+    }
     
-    foreach my $model_run (1 .. $repetitions ) {  
+    foreach my $model_run (@repetitions) {  
         my $starttime = time();
     
-        $self->run_one_repetition (repetition => $model_run);
+        $self->run_one_repetition (
+            repetition        => $model_run,
+            progress_callback => $args{progress_callback},
+        );
         
         $self->store_model_events (repetition => $model_run);
         
@@ -364,12 +562,101 @@ sub run {
     
 }
 
+#  the seed of a repetition's own PRNG stream (with RAND_STREAMS set),
+#  derived from RAND_SEED (or the starting state if there isn't one)
+#  so that any repetition can be run on its own, in any process
+sub get_repetition_seed {
+    my $self = shift;
+    my %args = @_;
+
+    my $repetition = $args{repetition} // croak "repetition not specified\n";
+
+    my $base = $self->get_param ('RAND_SEED')
+            // join ($;, $self->get_rand_state_at_end (repetition => 0));
+
+    return hex substr (md5_hex (join $;, $base, $repetition), 0, 8);
+}
+
+#  the stats values, events and end PRNG state of each repetition in a list,
+#  for merging into another landscape with merge_repetition_results
+#  (only kept with RAND_STREAMS set)
+sub get_repetition_results {
+    my $self = shift;
+    my %args = @_;
+
+    my %results;
+    foreach my $repetition (@{$args{repetitions}}) {
+        my $stats = $self->{REPETITION_STATS}[$repetition]
+          // croak "No stats for repetition $repetition - was RAND_STREAMS set?\n";
+        $results{$repetition} = {
+            STATS      => $stats,
+            EVENTS     => $self->{STORED_EVENTS}[$repetition],
+            RAND_STATE => $self->get_rand_state_at_end (repetition => $repetition),
+        };
+    }
+
+    return wantarray ? %results : \%results;
+}
+
+#  adds the results of repetitions run elsewhere (eg in other processes),
+#  in repetition order, so the stats are the same as if they had been run
+#  here in sequence.  results are {repetition => result} from
+#  get_repetition_results, and must cover all the repetitions.
+sub merge_repetition_results {
+    my $self = shift;
+    my %args = @_;
+
+    my $results = $args{results} || croak "results not specified\n";
+
+    croak "Can only merge repetitions with RAND_STREAMS set\n"
+      if ! $self->get_param ('RAND_STREAMS');
+
+    my $repetitions = $self->get_param ('REPETITIONS');
+    my @missing = grep {! exists $results->{$_}} (1 .. $repetitions);
+    croak "Missing results for repetitions @missing\n" if @missing;
+
+    foreach my $repetition (1 .. $repetitions) {
+        my $result = $results->{$repetition};
+        my $stats  = $result->{STATS};
+
+        foreach my $type (sort keys %$stats) {
+            my $by_model = $stats->{$type};
+            foreach my $model_iter (0 .. $#$by_model) {
+                my $by_timestep = $by_model->[$model_iter];
+                foreach my $timestep (0 .. $#$by_timestep) {
+                    my $by_state = $by_timestep->[$timestep] // next;
+                    foreach my $state (0 .. $#$by_state) {
+                        next if ! defined $by_state->[$state];
+                        $self->add_model_stats_data (
+                            type       => $type,
+                            model_iter => $model_iter,
+                            timestep   => $timestep,
+                            state      => $state,
+                            value      => $by_state->[$state],
+                            repetition => $repetition,
+                        );
+                    }
+                }
+            }
+        }
+
+        $self->{STORED_EVENTS}[$repetition] = $result->{EVENTS};
+        $self->store_rand_end_state (
+            repetition => $repetition,
+            state      => $result->{RAND_STATE},
+        );
+    }
+
+    return;
+}
+
 #  run one repetition on a set of clones
 sub run_one_repetition {
     my $self = shift;
     my %args = @_;
     
     my $model_run = $args{repetition};
+    my $progress_callback = $args{progress_callback};
     
     my $master_models       = $self->get_master_models;
     my $max_model_iter      = $#$master_models;
@@ -379,15 +666,28 @@ sub run_one_repetition {
     my $iterations = $self->get_param ('ITERATIONS');
     #my $model_controls = $self->get_param ('MODEL_CONTROLS');
 
-    #  generate the PRNG object from the end of the previous run
-    my $state = $self->get_rand_state_at_end (repetition => $model_run - 1);
-    if ($model_run and ! $state) {
-        warn "Missing rand state for repetition (",
-                $model_run - 1,
-                ") - have you tried to run a model out of the sequence?\n";
+    my $rand;
+    if ($self->get_param ('RAND_STREAMS')) {
+        #  each repetition has its own stream, so they can be run in any order
+        $rand = $self->initialise_rand (
+            seed => $self->get_repetition_seed (repetition => $model_run),
+        );
+    }
+    else {
+        #  generate the PRNG object from the end of the previous run
+        my $state = $self->get_rand_state_at_end (repetition => $model_run - 1);
+        if ($model_run and ! $state) {
+            warn "Missing rand state for repetition (",
+                    $model_run - 1,
+                    ") - have you tried to run a model out of the sequence?\n";
+        }
+        $rand = $self->initialise_rand (state => $state);  #  state overrides seed if defined
     }
-    my $rand = $self->initialise_rand (state => $state);  #  state overrides seed if defined
     
+    #  each timestep uses the neighbour table of every pair of models (and
+    #  of each model with itself), so they must all fit in the cache
+    Sirca::Population::reserve_cached (NBR_TABLES => ($max_model_iter + 1) ** 2);
+
     #  clone the master models and then start working on them
     my @models;
     foreach my $i (0 .. $max_model_iter) {
@@ -484,7 +784,7 @@ sub run_one_repetition {
             }
         }
 
-        my %stats_we_care_about = $self->update_model_stats;
+        my %stats_we_care_about = $self->update_model_stats (repetition => $model_run);
 
         #  stop processing if all the cells are immune or susceptible,
         #  but we need to pad the stats out with zeroes first
@@ -498,13 +798,36 @@ sub run_one_repetition {
                 #print "$j ";
                 foreach my $mdl_iter (0 .. $max_model_iter) {
                     foreach my $state (1..3) {  #  CHEATING
-                        $model_count_stats->[$mdl_iter][$j][$state]  ->add_data (0);
-                        $model_density_stats->[$mdl_iter][$j][$state]->add_data (0);
+                        foreach my $type (qw /COUNT DENSITY/) {
+                            $self->add_model_stats_data (
+                                type       => $type,
+                                model_iter => $mdl_iter,
+                                timestep   => $j,
+                                state      => $state,
+                                value      => 0,
+                                repetition => $model_run,
+                            );
+                        }
                     }
                 }
             }
+            if ($progress_callback) {
+                $progress_callback->(
+                    repetition => $model_run,
+                    from       => $iter,
+                    to         => $iterations,
+                );
+            }
             last INFECT;
         }
+
+        if ($progress_callback) {
+            $progress_callback->(
+                repetition => $model_run,
+                from       => $iter,
+                to         => $iter,
+            );
+        }
     }
     
     #  store the rand states to use in a subsequent model or a rebuild
@@ -597,32 +920,41 @@ sub interact_models {
     
     my $transmission_count = 0;
 
-    foreach my $mdl1_gp (keys %{$model1->get_groups_at_state (state => $states1->{propstate})}) {
+    my $propagating = $model1->get_groups_at_state (state => $states1->{propstate});
+    return $transmission_count if ! keys %$propagating;
+
+    #  the neighbours in model2 of all of model1's groups are found once, and
+    #  kept for later iterations and repetitions.  If there are none then
+    #  there is nothing to do (unless the random numbers must be drawn as
+    #  older versions did).
+    my $nbr_table = $model2->get_nbr_table (
+        centres => $model1,
+        label   => $model1->get_param ('LABEL'),
+    );
+    return $transmission_count
+      if ! $nbr_table->get_entry_count
+         && ! $model1->get_param ('LEGACY_NBR_SHUFFLE');
+
+    #  in id order, so a seed gives the same results in any process
+    foreach my $mdl1_gp (sort keys %$propagating) {
         #  snap the first model coord onto the second to determine what to interact with
-        #  does not cache the neighbours to reduce other interactions
         
         #  get the neighbours from model2
         my $infectious_gp_ref = $model1->get_group_ref (group => $mdl1_gp);
         #my $mdl1_coords = $infectious_gp_ref->get_coord_array;
-        my %nbrs = $model2->get_neighbouring_groups (
+        my ($nearest, $distances) = $model2->get_sorted_neighbours (
             group_ref => $infectious_gp_ref,
             label => $model1->get_param ('LABEL'),
+            rand  => $rand,
+        );
+        my %nbrs;
+        @nbrs{@$nearest} = @$distances;
+        my $next_nbr = $model1->get_random_order_iterator (
+            list => $nearest,
+            rand => $rand,
         );
         
         #  THE FOLLOWING IS MODIFIED FROM Population.pm - SHOULD PUT IN A UTILITY SUB
-        my @nearest = sort { $nbrs{$a} <=> $nbrs{$b} } keys %nbrs;
-        my $max_nbr_count_range =   $infectious_gp_ref->get_param ('MAX_NBR_COUNT') ||
-                                    $model1->get_param ('MAX_NBR_COUNT');
-        if (defined $max_nbr_count_range) {
-            my @range = (ref $max_nbr_count_range) =~ /ARRAY/
-                        ? @$max_nbr_count_range
-                        : (0, $max_nbr_count_range);
-            my $min = shift @range;
-            my $range = pop (@range) - $min;
-            my $num_nbrs_to_use = int ($min + $rand->rand ($range));
-            @nearest = splice (@nearest, 0, $num_nbrs_to_use);
-        }
-        my $nbr_rand_list_ref = $rand->shuffle (\@nearest);
         
         
         #  need to allow user to vary this per population
@@ -639,7 +971,7 @@ sub interact_models {
         my $mdl1_label = $model1->get_param ('LABEL');
         
         my $interactions = 0;
-        BY_NBR: foreach my $neighbour (@$nbr_rand_list_ref) {
+        BY_NBR: while (defined (my $neighbour = $next_nbr->())) {
             next if (! $model2->group_exists (group => $neighbour));  #  skip it if it does not exist
             my $nbr_gp_ref = $model2->get_group_ref (group => $neighbour);
             next if $nbr_gp_ref->get_density == 0;  #  skip it if it is dead
@@ -709,15 +1041,27 @@ sub update_model_stats {
 
         foreach my $state (@collate_dens_in_states) {
             my $dens = $models[$mdl_iter]->sum_densities_at_state (state => $state);
-            my $stats = $model_density_stats->[$mdl_iter][$time_step][$state];
-            $stats->add_data ($dens);
+            $self->add_model_stats_data (
+                type       => 'DENSITY',
+                model_iter => $mdl_iter,
+                timestep   => $time_step,
+                state      => $state,
+                value      => $dens,
+                repetition => $args{repetition},
+            );
             $density_sum_all += $dens;
         }
 
         foreach my $state (@collate_groups_in_states) {
             my $count = $models[$mdl_iter]->sum_groups_at_state (state => $state);
-            my $stats = $model_count_stats->[$mdl_iter][$time_step][$state];
-            $stats->add_data ($count);
+            $self->add_model_stats_data (
+                type       => 'COUNT',
+                model_iter => $mdl_iter,
+                timestep   => $time_step,
+                state      => $state,
+                value      => $count,
+                repetition => $args{repetition},
+            );
             $group_sum_all += $count;
             if ($care_about{$state}) {
                 $care_factor += $count;
@@ -0,0 +1,205 @@
+package Sirca::NeighbourTable;
+
+#  the neighbours of a set of groups, in compressed sparse row form.
+#  The neighbours of centre i are entries OFFSETS[i] .. OFFSETS[i+1]-1 of
+#  NBRS (indices into IDS) and DISTS, nearest first.  The columns are
+#  packed strings, so a table is a handful of scalars however many
+#  groups there are, and is quick to store, retrieve and clone.
+
+use 5.016;
+use strict;
+use warnings;
+use Carp;
+use File::Temp qw /tempfile/;
+use File::Basename;
+use Storable qw /nstore retrieve/;
+
+our $VERSION = 0.1;
+
+#  change if the layout changes, so old sidecar files are not used
+our $FORMAT_VERSION = 2;
+
+#  centres   => [ids of the centre groups]
+#  targets   => [ids of the groups that can be neighbours]
+#  neighbours => code ref returning {target id => distance} for a centre id
+sub new {
+    my $class = shift;
+    my %args = @_;
+
+    my $centres    = $args{centres}    || croak "centres not specified\n";
+    my $targets    = $args{targets}    || croak "targets not specified\n";
+    my $neighbours = $args{neighbours} || croak "neighbours not specified\n";
+
+    my %target_index;
+    @target_index{@$targets} = (0 .. $#$targets);
+    my %centre_index;
+    @centre_index{@$centres} = (0 .. $#$centres);
+
+    my (@offsets, @nbrs, @dists);
+    foreach my $centre (@$centres) {
+        push @offsets, scalar @nbrs;
+        my $nbr_dists = $neighbours->($centre);
+        #  ties are in id order, so the table does not depend on hash order
+        foreach my $nbr (sort {$nbr_dists->{$a} <=> $nbr_dists->{$b} || $a cmp $b}
+                         keys %$nbr_dists) {
+            croak "Neighbour $nbr of $centre is not a target\n"
+              if ! exists $target_index{$nbr};
+            push @nbrs,  $target_index{$nbr};
+            push @dists, $nbr_dists->{$nbr};
+        }
+    }
+    push @offsets, scalar @nbrs;
+
+    my $self = {
+        FORMAT_VERSION => $FORMAT_VERSION,
+        IDS            => [@$targets],
+        CENTRE_INDEX   => \%centre_index,
+        OFFSETS        => pack ('V*',  @offsets),
+        NBRS           => pack ('V*',  @nbrs),
+        DISTS          => pack ('d<*', @dists),
+    };
+
+    return bless $self, $class;
+}
+
+#  returns ([neighbour ids], [distances]), nearest first.
+#  Only the nearest count if that is given.
+sub get_neighbours {
+    my $self = shift;
+    my %args = @_;
+
+    my $centre = $args{centre} // croak "centre not specified\n";
+    my $i = $self->{CENTRE_INDEX}{$centre}
+      // croak "$centre is not in the neighbour table\n";
+
+    my ($start, $end) = unpack '@' . ($i * 4) . ' V V', $self->{OFFSETS};
+    my $count = $end - $start;
+    if (defined $args{count} && $args{count} < $count) {
+        $count = $args{count};
+    }
+    return ([], []) if $count <= 0;
+
+    my @indices = unpack '@' . ($start * 4) . " V$count",   $self->{NBRS};
+    my @dists   = unpack '@' . ($start * 8) . " d<$count", $self->{DISTS};
+    my @ids     = @{$self->{IDS}}[@indices];
+
+    return (\@ids, \@dists);
+}
+
+sub get_entry_count {
+    my $self = shift;
+    return length ($self->{NBRS}) / 4;
+}
+
+#  the sidecar files.  A table that can't be read, or is not for these
+#  centres and targets, is just rebuilt.
+#  The file must be the user's own and not writable by anyone else, and
+#  is stored as a plain hash so nothing in it is blessed when it is read.
+sub load {
+    my $class = shift;
+    my %args = @_;
+
+    my $file    = $args{file}    // croak "file not specified\n";
+    my $centres = $args{centres} || croak "centres not specified\n";
+    my $targets = $args{targets} || croak "targets not specified\n";
+
+    return if ! -e $file;
+
+    if (! is_private_file ($file)) {
+        warn "Ignoring neighbour table $file, as others could have written it\n";
+        return;
+    }
+
+    #  Storable 3.08 and later can refuse to bless or tie
+    my $flags = Storable->can ('BLESS_OK')
+        ? Storable::FLAGS_COMPAT() & ~(Storable::BLESS_OK() | Storable::TIE_OK())
+        : undef;
+    my $data = eval {
+        local $Storable::flags = $flags;
+        retrieve ($file);
+    };
+    if (! (ref ($data) eq 'HASH'
+           && ($data->{FORMAT_VERSION} // 0) == $FORMAT_VERSION
+           && ref ($data->{IDS}) eq 'ARRAY'
+           && ref ($data->{CENTRE_INDEX}) eq 'HASH'
+           && ! grep {! defined $data->{$_} || ref $data->{$_}} qw /OFFSETS NBRS DISTS/)) {
+        warn "Ignoring unreadable neighbour table $file\n";
+        return;
+    }
+
+    my $self = bless $data, $class;
+    if (! $self->matches (centres => $centres, targets => $targets)) {
+        warn "Ignoring neighbour table $file, as it is for other groups\n";
+        return;
+    }
+
+    return $self;
+}
+
+#  is the table for these centre and target ids, and consistent?
+sub matches {
+    my $self = shift;
+    my %args = @_;
+
+    my $centres = $args{centres};
+    my $targets = $args{targets};
+
+    my $ids = $self->{IDS};
+    return if @$ids != @$targets;
+    foreach my $i (0 .. $#$ids) {
+        return if $ids->[$i] ne $targets->[$i];
+    }
+
+    my $centre_index = $self->{CENTRE_INDEX};
+    return if keys %$centre_index != @$centres;
+    foreach my $centre (@$centres) {
+        my $i = $centre_index->{$centre};
+        return if ! defined $i || $i >= @$centres;
+    }
+
+    return if length ($self->{OFFSETS}) != 4 * (@$centres + 1);
+    my $entries = $self->get_entry_count;
+    return if length ($self->{DISTS}) != 8 * $entries;
+    return if unpack ('@' . (4 * @$centres) . ' V', $self->{OFFSETS}) != $entries;
+
+    return 1;
+}
+
+sub is_private_file {
+    my $file = shift;
+
+    return 1 if $^O eq 'MSWin32';  #  no unix permissions, and profiles are private
+
+    my @stat = lstat $file;
+    return if ! @stat || -l _ || ! -f _;
+    return if $stat[4] != $<;       #  owner
+    return if $stat[2] & oct (22);  #  group or other writable
+
+    return 1;
+}
+
+sub save {
+    my $self = shift;
+    my %args = @_;
+
+    my $file = $args{file} // croak "file not specified\n";
+
+    #  written then renamed, so other workers never read part of one
+    my ($fh, $tmp_file) = eval {tempfile (DIR => dirname ($file), UNLINK => 0)};
+    if (! $fh) {
+        warn "Could not save neighbour table to $file: $@\n";
+        return;
+    }
+    close $fh;
+
+    #  unblessed, see load
+    if (! (eval {nstore ({%$self}, $tmp_file)} && rename ($tmp_file, $file))) {
+        warn "Could not save neighbour table to $file\n";
+        unlink $tmp_file;
+        return;
+    }
+
+    return 1;
+}
+
+1;
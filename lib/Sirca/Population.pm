@@ -27,11 +27,13 @@ use List::Util qw /max/;
 use File::Spec;
 use Math::Trig;
 use Readonly;
+use Digest::MD5 qw /md5_hex/;
 
 
 use Biodiverse::Index;
 use Biodiverse::SpatialParams;
 use Sirca::Group 0.1;
+use Sirca::NeighbourTable;
 
 use base qw /Sirca::Utilities/;
 
@@ -40,6 +42,12 @@ our $VERSION = 0.1;
 Readonly my $comma       => q{,};
 Readonly my $null_string => q{};
 
+#  binary density files, written by SircaUI/density_convert.py
+Readonly my $binary_density_magic => 'SIRCADNS';
+Readonly my $binary_no_state      => -1;
+my %binary_density_types = (d => 'd<', l => 'l<');  #  unpack templates
+my %binary_density_sizes = (d => 8, l => 4);
+
 my %propagation_values = (  #  default state values for propagation
     propstate   => 2,  #  propagating state
     latentstate => 1,   #  new state after transmission/propagation
@@ -63,6 +71,23 @@ my %default_system_values = (  # default system values.  Needs to be fleshed out
     SNAP_STATE_COORDS => 1,  #  should we snap the coords in the state file to the nearest group?
 );
 
+#  Parsed density files, spatial indexes and search blocks, shared by the
+#  populations built by this process (eg the landscapes of a parameter sweep).
+#  Keyed by the digest of the file contents and the params used to build them,
+#  so an edited file or changed param is a cache miss.
+#  The cached data are read only.  Each population makes its own groups from
+#  the parsed rows, and copies a shared index before changing it.
+#  The least recently used entries are dropped first.
+Readonly my $default_max_cached => 8;  #  entries of each cache
+my %data_cache = (
+    DATA_FILES    => {},
+    SPATIAL_INDEX => {},
+    SEARCH_BLOCKS => {},
+    NBR_TABLES    => {},
+);
+my %data_cache_order = map {$_ => []} keys %data_cache;
+my %max_cached = map {$_ => $default_max_cached} keys %data_cache;
+
 sub new {  #  generate a new sirca population object
     my $class = shift;
     my %args = @_;
@@ -105,41 +130,62 @@ sub new {  #  generate a new sirca population object
     $self->process_args;  #  do some checks and setup based on the arguments
     #  now read in the population density files and start states
     my $dens_files = $args{density_files} || $self->get_param ('DENSITY_FILES');
-    $self->read_data_files (files => $dens_files);
+    my $data_keys  = $self->read_data_files (files => $dens_files);
+    $self->set_param (DATA_FILE_KEYS => $data_keys);
     
     
-    #  build the spatial index
+    #  build the spatial index, or share the one built from the same data
     my $b = $self->get_param ('BANDWIDTH');
-    my @res = ($b, $b);  #  CLUNKY
-    my $sp_index = Biodiverse::Index->new (
-        parent       => $self,
-        resolutions  => \@res,
-        element_hash => scalar $self->get_groups_as_hash,
-    );
+    my $index_key = join $;, @$data_keys, $b;
+    my $sp_index  = get_cached (SPATIAL_INDEX => $index_key);
+    if (! defined $sp_index) {
+        my @res = ($b, $b);  #  CLUNKY
+        $sp_index = Biodiverse::Index->new (
+            parent       => $self,
+            resolutions  => \@res,
+            element_hash => scalar $self->get_groups_as_hash,
+        );
+        set_cached (SPATIAL_INDEX => $index_key, $sp_index);
+    }
     
     $self->set_param (SPATIAL_INDEX => $sp_index);
+    $self->set_param (SPATIAL_INDEX_SHARED => 1);
     
     #  and now set up the search blocks
     #  (may remove later, but it depends on how complex we allow the nbrs to be)
     my $search_blocks = $self->get_param ('INDEX_SEARCH_BLOCKS');
     if (! defined $search_blocks) {
         my $max_nbrhood = $self->get_param ('MAXNBRHOOD');
-
-        my $log_text
-          = $self->get_param ('LABEL')
-          . ": Determining index search blocks using maximum search nbrhood, "
-          . "$max_nbrhood\n";
-        
-        $self->update_log (text => $log_text);
-        my $sp_params = Biodiverse::SpatialParams->new (conditions => $max_nbrhood);
-        #$sp_params->set_param (NO_PRINT_CONDITIONS_AFTER_PARSING => 1);
-        $search_blocks = $sp_index->predict_offsets (spatial_params => $sp_params);
+        my $blocks_key  = join $;, $index_key, $max_nbrhood;
+        $search_blocks  = get_cached (SEARCH_BLOCKS => $blocks_key);
+
+        if (! defined $search_blocks) {
+            my $log_text
+              = $self->get_param ('LABEL')
+              . ": Determining index search blocks using maximum search nbrhood, "
+              . "$max_nbrhood\n";
+            
+            $self->update_log (text => $log_text);
+            my $sp_params = Biodiverse::SpatialParams->new (conditions => $max_nbrhood);
+            #$sp_params->set_param (NO_PRINT_CONDITIONS_AFTER_PARSING => 1);
+            $search_blocks = $sp_index->predict_offsets (spatial_params => $sp_params);
+            set_cached (SEARCH_BLOCKS => $blocks_key, $search_blocks);
+        }
         $self->set_param (INDEX_SEARCH_BLOCKS => $search_blocks);  #  cache it
     }
     
     return $self;
 }
 
+#  a copy of the default system values (eg to restore a param dropped
+#  from the config)
+sub get_default_params {
+    my %params = %default_system_values;
+    $params{PROP_STATES} = {%propagation_values};
+
+    return wantarray ? %params : \%params;
+}
+
 #  run a cull over a set of groups
 #  may need a PC term for this...
 sub do_event_cull {
@@ -166,7 +212,7 @@ sub do_event_cull {
     my $max_y = $args{max_y};
 
     my $rand = $self->get_param ('RAND_OBJECT');  #  do them in random order
-    my $random_list_ref = [keys %{$self->get_groups_at_state (state => $target_state)}];
+    my $random_list_ref = $rand->shuffle ([sort keys %{$self->get_groups_at_state (state => $target_state)}]);
     my $available = scalar @$random_list_ref;
     $num_to_do = $available if ! defined $num_to_do;
     
@@ -277,7 +323,7 @@ sub do_event_state_change {
         );
     }
 
-    my @groups = $self->get_groups;
+    my @groups = sort $self->get_groups;  #  sorted, so the run does not depend on hash order
     my $available = scalar @groups;
     
     my $updated = 0;
@@ -347,7 +393,7 @@ sub do_event_rand_state_change {
     }
 
     my $rand = $self->get_param ('RAND_OBJECT');
-    my $random_list_ref = $rand->shuffle ([$self->get_groups]);
+    my $random_list_ref = $rand->shuffle ([sort $self->get_groups]);
     my $available = scalar @$random_list_ref;
 
     my $updated = 0;
@@ -512,7 +558,6 @@ sub run {  #  run the model for $some number of iterations
     
     my $transmissions_count = 0;
     my $bodycount = 0;
-    my @image_files;
     
     for (my $i = $start_iter; $i <= $end_iter; $i++) {
         #printf "TIMESTEP %4i", $i;
@@ -535,12 +580,8 @@ sub run {  #  run the model for $some number of iterations
 
         $self->print_state_stats;
         $self->write_state_stats;  #  NEED TO MODIFY FOR GUI
-        if ($self->get_param ('WRITE_IMAGE')) {  #  NEED TO MODIFY FOR GUI
-            push @image_files, $self->write_image (
-                timestep => $i,
-                image    => $self->to_image
-            );
-        }
+        #  no images are written here - they are rebuilt from the
+        #  stored group events by rerun, or by the GUI's frame_raster.py
         $self->clear_state_changed;
         $self->clear_changed_this_iter;
 
@@ -555,7 +596,6 @@ sub run {  #  run the model for $some number of iterations
     my %summary = (
         TRANSMISSION_COUNT => $transmissions_count,
         BODY_COUNT         => $bodycount,
-        IMAGE_FILES        => \@image_files,
     );
     return wantarray ? %summary : \%summary;
 }
@@ -673,29 +713,18 @@ sub run_interactions {
         
         #  get the associated object
         my $infectious_gp_ref = $self->get_group_ref_aa ($infectious_gp);
-        my %nbrs = $self->get_neighbouring_groups (
+        #  the nearest however many, sorted by distance from the infectious group
+        my ($nearest, $distances) = $self->get_sorted_neighbours (
             group_ref => $infectious_gp_ref,
-            cache     => $cache_nbrs
+            cache     => $cache_nbrs,
+            rand      => $rand,
+        );
+        my %nbrs;
+        @nbrs{@$nearest} = @$distances;
+        my $next_nbr = $self->get_random_order_iterator (
+            list => $nearest,
+            rand => $rand,
         );
-
-        #  sort by nbrs distance from the infectious group BROKEN FIXMEFIXMEFIXME
-        #  not broken now?
-        my @nearest = sort { $nbrs{$a} <=> $nbrs{$b} } keys %nbrs;
-        my $max_nbr_count_range
-          =  $infectious_gp_ref->get_param ('MAX_NBR_COUNT')
-          || $self->get_param ('MAX_NBR_COUNT');
-
-        #  ignore anything too far away
-        if (defined $max_nbr_count_range) {
-            my @range = (ref $max_nbr_count_range) =~ /ARRAY/
-                        ? @$max_nbr_count_range
-                        : (0, $max_nbr_count_range);
-            my $min = shift (@range);
-            my $range = (pop @range) - $min;
-            my $num_nbrs_to_use = int ($min + $rand->rand ($range));
-            @nearest = splice (@nearest, 0, $num_nbrs_to_use);
-        }
-        my $nbr_rand_list_ref = $rand->shuffle (\@nearest);
 
         my $max_interact_count
           =  $infectious_gp_ref->get_param('MAX_INTERACT_COUNT')
@@ -713,7 +742,7 @@ sub run_interactions {
         my $interactions = 0;
         #print "Starting check of neighbours\n";
         BY_NBR:
-        foreach my $neighbour (@$nbr_rand_list_ref) {
+        while (defined (my $neighbour = $next_nbr->())) {
             #print "Checking neighour $neighbour\n";
             next if (! $self->group_exists (group => $neighbour));  #  skip it if it does not exist
             my $nbr_gp_ref = $self->get_group_ref_aa ($neighbour);
@@ -1034,7 +1063,7 @@ sub run_mortality {
     my $groups_to_cark_it = $self->get_groups_at_state (state => $death_state);
     
     my $total_bodycount = 0;
-    foreach my $group_id (keys %$groups_to_cark_it) {
+    foreach my $group_id (sort keys %$groups_to_cark_it) {
         my $bodycount = $self->get_bodycount (
             group            => $group_id,
             use_orig_density => 1,
@@ -1131,8 +1160,7 @@ sub do_event_group_cull {
     
     $density -= $bodycount;
     $density = max (0, $density);
-    $gp_ref->set_param (DENSITY => $density);
-    $gp_ref->set_param (DENSITY_PCT => $self->convert_dens_to_pct (value => $density));
+    $self->set_group_density (group => $group_id, density => $density);
 
     $self->track_changed_this_iter (group => $group_id);
 
@@ -1179,8 +1207,7 @@ sub do_event_mortality {
     my $density = $gp_ref->get_density;
     $density -= $bodycount;
     $density = max (0,  $density);  #  snap to zero if negative
-    $gp_ref->set_param (DENSITY => $density);
-    $gp_ref->set_param (DENSITY_PCT => $self->convert_dens_to_pct (value => $density));
+    $self->set_group_density (group => $group_id, density => $density);
     
     $self->track_changed_this_iter (group => $group_id);
     
@@ -1284,9 +1311,9 @@ sub update_group_state {  #  Update the state of a group.
 
     #  update self's trackers
     if ($new_state != $default_state) {
-        $self->{STATES}{$new_state}{$group_id} ++;
+        $self->add_to_state_tracker (group => $group_id, state => $new_state);
     }
-    delete $self->{STATES}{$current_state}{$group_id};
+    $self->remove_from_state_tracker (group => $group_id, state => $current_state);
     $self->track_state_changed (group => $group_id);
     $self->track_changed_this_iter (group => $group_id);
 
@@ -1352,9 +1379,11 @@ sub delete_group {
     my $group = $self->get_group_ref_aa ($group_id);
     my $state = $group->get_state; 
 
+    if (defined $state) {
+        $self->remove_from_state_tracker (group => $group_id, state => $state);
+    }
     $self->{GROUPS}{$group_id} = undef;
     delete $self->{GROUPS}{$group_id}; 
-    delete $self->{STATES}{$state}{$group_id};
     
     #  delete it from the spatial index (a source of much debugging woe)
     $self->delete_from_spatial_index (group => $group_id);
@@ -1382,6 +1411,20 @@ sub delete_group {
     return 1;
 }
 
+#  A clone has its own copy of the spatial index (eg: the models of each
+#  repetition), so it can change it without copying it again
+sub clone {
+    my $self = shift;
+    my %args = @_;
+
+    my $clone = $self->SUPER::clone (%args);
+    if (! exists $args{data}) {  #  not cloning some other data
+        $clone->set_param (SPATIAL_INDEX_SHARED => 0);
+    }
+
+    return $clone;
+}
+
 sub delete_from_spatial_index {
     my $self = shift;
     my %args = @_;
@@ -1389,6 +1432,12 @@ sub delete_from_spatial_index {
     my $group_ref = $self->get_group_ref_aa ($group_id);
     
     my $index = $self->get_param ('SPATIAL_INDEX');
+    if ($self->get_param ('SPATIAL_INDEX_SHARED')) {
+        #  other populations use it, so change a copy
+        $index = $index->clone;
+        $self->set_param (SPATIAL_INDEX => $index);
+        $self->set_param (SPATIAL_INDEX_SHARED => 0);
+    }
     $index->delete_from_index (
         element       => $group_id,
         element_array => scalar $group_ref->get_coord_array,
@@ -1488,26 +1537,7 @@ sub get_neighbouring_groups {  #  uses the spatial index to accelerate the searc
 
     my $spatial_params = $central_gp_ref->get_spatial_params;
 
-    my $search_blocks = $self->get_param ('INDEX_SEARCH_BLOCKS');
-    if (! defined $search_blocks) {
-        my $max_nbrhood = $self->get_param ('MAXNBRHOOD');
-        $self->update_log (
-            text => $self->get_param ('LABEL')
-                  . ": Determining index search blocks using maximum "
-                  . "search nbrhood, $max_nbrhood\n",
-        );
-
-        my $max_nbrhood_sp_params = Biodiverse::SpatialParams->new (
-            params => $max_nbrhood,
-            no_log => 1,
-        );
-
-        $search_blocks =  $self->predict_offsets (
-            spatial_params => $max_nbrhood_sp_params,
-        );
-
-        $self->set_param ('INDEX_SEARCH_BLOCKS' => $search_blocks);  #  cache it
-    }
+    my $search_blocks = $self->get_index_search_blocks;
     
     my $central_coords = $central_gp_ref->get_param ('COORD_ARRAY');
     
@@ -1551,6 +1581,287 @@ sub get_neighbouring_groups {  #  uses the spatial index to accelerate the searc
     return wantarray ? %nbrs_with_dist : \%nbrs_with_dist;
 }
 
+sub get_index_search_blocks {
+    my $self = shift;
+
+    my $search_blocks = $self->get_param ('INDEX_SEARCH_BLOCKS');
+    if (! defined $search_blocks) {
+        my $max_nbrhood = $self->get_param ('MAXNBRHOOD');
+        $self->update_log (
+            text => $self->get_param ('LABEL')
+                  . ": Determining index search blocks using maximum "
+                  . "search nbrhood, $max_nbrhood\n",
+        );
+
+        my $max_nbrhood_sp_params = Biodiverse::SpatialParams->new (
+            params => $max_nbrhood,
+            no_log => 1,
+        );
+
+        $search_blocks =  $self->predict_offsets (
+            spatial_params => $max_nbrhood_sp_params,
+        );
+
+        $self->set_param ('INDEX_SEARCH_BLOCKS' => $search_blocks);  #  cache it
+    }
+
+    return $search_blocks;
+}
+
+
+#  returns ([neighbour ids], [distances]) of a group, nearest first.
+#  The group may be from another population (give its label, as for
+#  get_neighbouring_groups).  Looked up in the neighbour table of all the
+#  groups unless cache is false.
+#  If a rand object is given then only the nearest of them are returned,
+#  as many as drawn from the MAX_NBR_COUNT range of the group's population.
+sub get_sorted_neighbours {
+    my $self = shift;
+    my %args = (
+        cache => 1,
+        @_
+    );
+
+    my $central_gp_ref = $args{group_ref}
+      || croak "group not specified\n";
+    my $centres = $central_gp_ref->get_population;
+
+    #  the neighbours' MAX_NBR_COUNT is used to find them, the centres'
+    #  to limit how many are used (as for get_neighbouring_groups)
+    my $max_nbr_count = $central_gp_ref->get_param ('MAX_NBR_COUNT')
+                        || $self->get_param ('MAX_NBR_COUNT');
+    my $max_nbr_count_range = $central_gp_ref->get_param ('MAX_NBR_COUNT')
+                              || $centres->get_param ('MAX_NBR_COUNT');
+
+    #  ignore anything too far away
+    my $num_nbrs_to_use;
+    if (defined $args{rand} && defined $max_nbr_count_range) {
+        my @range = (ref $max_nbr_count_range) =~ /ARRAY/
+                    ? @$max_nbr_count_range
+                    : (0, $max_nbr_count_range);
+        my $min = shift (@range);
+        my $range = (pop @range) - $min;
+        $num_nbrs_to_use = int ($min + $args{rand}->rand ($range));
+    }
+
+    return ([], []) if ! $max_nbr_count;
+
+    if (! $args{cache}) {
+        my %nbrs = $self->get_neighbouring_groups (%args);
+        my @nearest = sort { $nbrs{$a} <=> $nbrs{$b} || $a cmp $b } keys %nbrs;
+        if (defined $num_nbrs_to_use) {
+            @nearest = splice (@nearest, 0, $num_nbrs_to_use);
+        }
+        return (\@nearest, [@nbrs{@nearest}]);
+    }
+
+    my $table = $self->get_nbr_table (
+        centres => $centres,
+        label   => $args{label},
+    );
+
+    return $table->get_neighbours (
+        centre => $central_gp_ref->get_param ('ID'),
+        count  => $num_nbrs_to_use,
+    );
+}
+
+#  returns a sub giving the items of list in random order, one per call
+#  (undef when they run out).  Each item is drawn when it is asked for (a
+#  partial Fisher-Yates shuffle of list, in place), so a loop that stops
+#  early doesn't pay for shuffling all of them.
+#  With LEGACY_NBR_SHUFFLE set the whole list is shuffled first, as older
+#  versions did, so results with the same seed can be reproduced.
+sub get_random_order_iterator {
+    my $self = shift;
+    my %args = @_;
+
+    my $list = $args{list} || croak "list not specified\n";
+    my $rand = $args{rand} || croak "rand not specified\n";
+    my $i = 0;
+
+    if ($self->get_param ('LEGACY_NBR_SHUFFLE')) {
+        my $shuffled = $rand->shuffle ($list);
+        return sub { $shuffled->[$i++] };
+    }
+
+    my $count = scalar @$list;
+    return sub {
+        return if $i >= $count;
+        my $j = $i + int ($rand->rand ($count - $i));
+        @$list[$i, $j] = @$list[$j, $i];
+        return $list->[$i++];
+    };
+}
+
+#  The neighbour table from the groups of the centres population (default
+#  this one) to those of this one.  Tables are built once for a set of
+#  coordinates and neighbourhoods, and kept by this process and, if
+#  NBR_TABLE_DIR is set, in a sidecar file there for later landscapes and
+#  runs.  The files are as big as the table, and are not cleaned up.
+sub get_nbr_table {
+    my $self = shift;
+    my %args = @_;
+
+    my $centres = $args{centres} // $self;
+    my $label   = $args{label}   // $null_string;
+
+    my $table_keys = $self->get_param ('NBR_TABLE_KEYS');
+    if (! defined $table_keys) {
+        $table_keys = {};
+        $self->set_param (NBR_TABLE_KEYS => $table_keys);
+    }
+
+    my $key = $table_keys->{$label};
+    if (! defined $key) {
+        $key = md5_hex (join $;,
+            $Sirca::NeighbourTable::FORMAT_VERSION,
+            $centres->get_coords_key,
+            $centres->get_param ('NBRHOOD') // $null_string,
+            $self->get_coords_key,
+            $self->get_param ('MAXNBRHOOD') // $null_string,
+        );
+        $table_keys->{$label} = $key;
+    }
+
+    my $table = get_cached (NBR_TABLES => $key);
+    return $table if defined $table;
+
+    my $dir = $self->get_param ('NBR_TABLE_DIR') // $null_string;
+    my $file = length $dir
+            ? File::Spec->catfile ($dir, "sirca_nbrs_$key.stor")
+            : undef;
+
+    my $centre_ids = [$centres->get_groups];
+    my $target_ids = [sort $self->get_groups];
+    $table = defined $file
+            ? Sirca::NeighbourTable->load (
+                file    => $file,
+                centres => $centre_ids,
+                targets => $target_ids,
+              )
+            : undef;
+
+    if (! defined $table) {
+        $self->update_log (
+            text => $self->get_param ('LABEL')
+                  . ": Building the neighbour table for "
+                  . $centres->get_param ('LABEL') . "\n",
+        );
+        my ($cell_centre_ids, $neighbours) = $self->get_spatial_join (centres => $centres);
+        $table = Sirca::NeighbourTable->new (
+            centres    => $cell_centre_ids,
+            targets    => $target_ids,
+            neighbours => $neighbours,
+        );
+        $self->update_log (
+            text => $self->get_param ('LABEL')
+                  . ": Neighbour table has "
+                  . $table->get_entry_count
+                  . " entries\n",
+        );
+        $table->save (file => $file) if defined $file;
+    }
+
+    set_cached (NBR_TABLES => $key, $table);
+
+    return $table;
+}
+
+#  Finds the neighbours in this population of all the groups of the centres
+#  population, as get_neighbouring_groups does for one.  The centres are
+#  taken an index cell at a time, so the possible neighbours around each
+#  cell are looked up in the index once for all the centres in it.
+#  Returns ([centre ids, by cell], code ref giving {id => distance} of
+#  each centre in turn)
+sub get_spatial_join {
+    my $self = shift;
+    my %args = @_;
+
+    my $centres       = $args{centres} // $self;
+    my $sp_index      = $self->get_param ('SPATIAL_INDEX');
+    my $search_blocks = $self->get_index_search_blocks;
+
+    my %cell_of;
+    foreach my $id ($centres->get_groups) {
+        my $coord = $centres->get_group_ref_aa ($id)->get_coord_array;
+        $cell_of{$id} = $sp_index->snap_to_index (element_array => $coord);
+    }
+    my %cell_key;
+    foreach my $id (keys %cell_of) {
+        my $cell = $cell_of{$id};
+        $cell_key{$id} = ref $cell ? join ($;, @$cell) : $cell;
+    }
+    my @centre_ids = sort {$cell_key{$a} cmp $cell_key{$b} || $a cmp $b} keys %cell_of;
+
+    my ($current_cell, @candidates);
+    my $neighbours = sub {
+        my $id = shift;
+
+        if (! defined $current_cell || $cell_key{$id} ne $current_cell) {
+            $current_cell = $cell_key{$id};
+            my %seen;
+            @candidates =
+                map  {[$_, $self->get_group_ref_aa ($_)->get_param ('COORD_ARRAY')]}
+                grep {defined $_ && ! $seen{$_}++}
+                map  {
+                    $sp_index->get_index_elements_as_array (
+                        element => $cell_of{$id},
+                        offset  => $_,
+                    )
+                } keys %$search_blocks;
+        }
+
+        my $central_gp_ref = $centres->get_group_ref_aa ($id);
+        my $sp_params = $central_gp_ref->get_spatial_params;
+        my $coord     = $central_gp_ref->get_param ('COORD_ARRAY');
+
+        my %nbrs;
+        foreach my $candidate (@candidates) {
+            my ($nbr, $nbr_coord) = @$candidate;
+            #  one cannot be one's own neighbour
+            next if $nbr eq $id;
+            next if ! $sp_params->evaluate (
+                coord_array1 => $coord,
+                coord_array2 => $nbr_coord,
+            );
+            $nbrs{$nbr} = $sp_params->get_param ('LAST_DISTS')->{D};
+        }
+
+        return \%nbrs;
+    };
+
+    return (\@centre_ids, $neighbours);
+}
+
+#  identifies the groups and their coordinates and neighbourhoods, for
+#  the keys of neighbour tables
+sub get_coords_key {
+    my $self = shift;
+
+    #  the groups are those of the density files
+    my $data_keys = $self->get_param ('DATA_FILE_KEYS');
+    return md5_hex (join $;, @$data_keys) if defined $data_keys;
+
+    #  eg a population saved before they were kept
+    my $key = $self->get_param ('COORDS_KEY');
+    if (! defined $key) {
+        my $digest = Digest::MD5->new;
+        foreach my $id (sort $self->get_groups) {
+            my $group = $self->get_group_ref_aa ($id);
+            $digest->add (join $;,
+                $id,
+                $group->get_coord_array,
+                $group->get_param ('NBRHOOD') // $null_string,
+                "\n",
+            );
+        }
+        $key = $digest->hexdigest;
+        $self->set_param (COORDS_KEY => $key);
+    }
+
+    return $key;
+}
 
 sub get_spatial_params {
     my $self = shift;
@@ -1735,7 +2046,7 @@ sub print_state_stats {
 
     $s .= sprintf "%s TIME STEP %4i", $self->get_param('LABEL'), $self->get_param('TIMESTEP');
     foreach my $i (0 .. $self->get_param('MAX_STATE')) {
-        $s .= sprintf " %6i :%2i", my $tmp = (keys %{$self->{STATES}{$i}}), $i;
+        $s .= sprintf " %6i :%2i", $self->sum_groups_at_state (state => $i), $i;
     }
     $s .= "\n";
     #print $s;
@@ -1761,7 +2072,7 @@ sub write_state_stats {
     open (my $fh, '>>', $file_name);
     print {$fh} $self->get_param('TIMESTEP');
     foreach my $i (0 .. $self->get_param('MAX_STATE')) {
-        printf {$fh} (",%i", my $tmp = (keys %{$self->get_groups_at_state (state => $i)}));
+        printf {$fh} (",%i", $self->sum_groups_at_state (state => $i));
         printf {$fh} (",%.1f", $self->sum_densities_at_state (state => $i));
     }
     print {$fh} "\n";
@@ -1770,19 +2081,14 @@ sub write_state_stats {
     return;
 }
 
-#  sum the original densities for one of the model states
+#  sum the current densities for one of the model states
 sub sum_densities_at_state {
     my $self = shift;
     my %args = @_;
     my $state = $args{state};
     croak "state not specified\n" if ! defined $state;
 
-    my $sum_in_state = 0;
-    foreach my $group_id (keys %{$self->get_groups_at_state (state => $state)}) {
-        my $gp_ref     = $self->get_group_ref_aa ($group_id);
-        $sum_in_state += $gp_ref->get_density;
-    }
-    return $sum_in_state;
+    return $self->get_state_density_sums->{$state} // 0;
 }
 
 #  return the count of GROUPS in a particular state
@@ -1793,11 +2099,94 @@ sub sum_groups_at_state {
     my $state = $args{state};
     croak "state not specified\n" if ! defined $state;
     
-    my $hash_ref = $self->get_groups_at_state (state => $state);
+    my $hash_ref = $self->{STATES}{$state}
+      || return 0;
     
-    my $count = scalar keys %$hash_ref;
-    
-    return $count;
+    return scalar keys %$hash_ref;
+}
+
+#  The density sums of the states are kept up to date as groups change
+#  state or density, so the stats for each timestep don't need to visit
+#  every group.  They are built from STATES when first needed (eg: for
+#  populations saved before they were tracked).
+sub get_state_density_sums {
+    my $self = shift;
+
+    return $self->{STATE_DENSITY_SUMS} //= $self->calc_state_density_sums;
+}
+
+sub calc_state_density_sums {
+    my $self = shift;
+
+    my %sums;
+    foreach my $state (keys %{$self->{STATES}}) {
+        my $sum = 0;
+        foreach my $group_id (keys %{$self->{STATES}{$state}}) {
+            $sum += $self->get_group_ref_aa ($group_id)->get_density // 0;
+        }
+        $sums{$state} = $sum;
+    }
+
+    return \%sums;
+}
+
+sub add_to_state_tracker {
+    my $self = shift;
+    my %args = @_;
+
+    my $group_id = $args{group} // croak "group not specified\n";
+    my $state    = $args{state} // croak "state not specified\n";
+
+    my $sums = $self->get_state_density_sums;
+    if (! exists $self->{STATES}{$state}{$group_id}) {
+        $sums->{$state} += $self->get_group_ref_aa ($group_id)->get_density // 0;
+    }
+    $self->{STATES}{$state}{$group_id} ++;
+
+    return;
+}
+
+sub remove_from_state_tracker {
+    my $self = shift;
+    my %args = @_;
+
+    my $group_id = $args{group} // croak "group not specified\n";
+    my $state    = $args{state} // croak "state not specified\n";
+
+    my $sums = $self->get_state_density_sums;
+    return if ! exists $self->{STATES}{$state}{$group_id};
+
+    delete $self->{STATES}{$state}{$group_id};
+    if (! keys %{$self->{STATES}{$state}}) {
+        $sums->{$state} = 0;  #  don't leave rounding error behind
+    }
+    else {
+        $sums->{$state} -= $self->get_group_ref_aa ($group_id)->get_density // 0;
+    }
+
+    return;
+}
+
+#  change the density of a group, keeping the density sum of its state
+sub set_group_density {
+    my $self = shift;
+    my %args = @_;
+
+    my $group_id = $args{group}   // croak "group not specified\n";
+    my $density  = $args{density} // croak "density not specified\n";
+
+    my $gp_ref = $self->get_group_ref_aa ($group_id);
+    my $state  = $gp_ref->get_state;
+
+    if (defined $state && exists $self->{STATES}{$state}{$group_id}) {
+        my $sums = $self->get_state_density_sums;
+        $sums->{$state} += $density - ($gp_ref->get_density // 0);
+    }
+
+    $gp_ref->set_param (DENSITY => $density);
+    $gp_ref->set_param (DENSITY_PCT => $self->convert_dens_to_pct (value => $density));
+
+    return;
 }
 
 sub process_args {  #  check we have the required arguments
@@ -1881,10 +2270,13 @@ sub read_data_files {
                 ? @{$args{files}}
                 : $args{files};
 
+    my @keys;
     foreach my $file (@files) {
-        $self->read_data_file (file => $file);
+        push @keys, $self->read_data_file (file => $file);
     }
     
+    #  the cache keys of the files, for those of anything built from them
+    return wantarray ? @keys : \@keys;
 }
 
 sub read_data_file {  #  nothing will happen if the file dos not exist, as we will assume all the GROUPS are dealt with through read_state_file()
@@ -1901,8 +2293,66 @@ sub read_data_file {  #  nothing will happen if the file dos not exist, as we wi
     croak "Density file $input_file does not exist.\n" if !(-e $input_file);
     open (my $data_fh, '<', $input_file)
       || croak "Could not open density file $input_file.\n";
+    my $data = do {local $/; <$data_fh>};
+    close $data_fh || croak "could not close $input_file\n";
+
+    #  the rows only depend on the file contents and these params
+    my $join_char = $self->get_param ('JOIN_CHAR') || ":";
+    my $dens_params = $self->get_param ('DENSITYPARAMS');
+    my $key = join $;,
+        md5_hex ($data),
+        $join_char,
+        (ref $dens_params ? @$dens_params : ());
+
+    my $rows = get_cached (DATA_FILES => $key);
+    if (defined $rows) {
+        $self->update_log (text => "Using the data already read from $input_file\n");
+    }
+    else {
+        my $parser = substr ($data, 0, length $binary_density_magic) eq $binary_density_magic
+                    ? 'parse_binary_data_file'
+                    : 'parse_data_file';
+        $rows = $self->$parser (
+            data      => \$data,
+            file      => $input_file,
+            join_char => $join_char,
+        );
+        set_cached (DATA_FILES => $key, $rows);
+    }
+    
+    my $default_state = $self->get_param ('DEFAULT_STATE');
+    foreach my $row (@$rows) {
+        my $group = Sirca::Group->new (
+            %$row,
+            COORD_ARRAY => [@{$row->{COORD_ARRAY}}],  #  the row is shared
+            population  => $self,
+        );
+        
+        $self->add_group (group => $group);
+        
+        #  add to the hash with this state (if non-zero)
+        if (defined $row->{STATE} && $row->{STATE} != $default_state) {
+            $self->{STATE}{$group->get_state} = $group;
+        }
+    }
 
-    my $header_line = <$data_fh>;
+    my $coord_count = scalar @$rows;
+    $self->update_log (text => "Read $coord_count valid lines from $input_file\n");
+    
+    return $key;
+}
+
+#  returns the params of the groups in a density file's contents
+sub parse_data_file {
+    my $self = shift;
+    my %args = @_;
+    
+    my $data_ref   = $args{data};
+    my $input_file = $args{file};
+    my $join_char  = $args{join_char};
+    
+    my @lines = split (/\n/, $$data_ref);
+    my $header_line = shift @lines // $null_string;
     $header_line =~ s/[\n|\r]$//;
     $header_line =~ s/"//g;  #  sort of cheating here to avoid using the text::CSV_XS module, since we don't really need it for this type of data
     $header_line = uc($header_line);  #  uppercase the lot to save trouble later (and hopefully not get into any as a consequence)
@@ -1927,11 +2377,9 @@ sub read_data_file {  #  nothing will happen if the file dos not exist, as we wi
     
 #    my $dens_column = $header_col{DENSITY};
     
-    my $join_char = $self->get_param ('JOIN_CHAR') || ":";
-    
-    my $coord_count = 0;
+    my @rows;
 
-    while (<$data_fh>) {
+    foreach (@lines) {
         $_ =~ s/[\n|\r]$//;  #  strip trailing linefeeds and newlines
         next if $_ eq $null_string;
         my @line = split (/[,\s;]/, $_);
@@ -1952,30 +2400,134 @@ sub read_data_file {  #  nothing will happen if the file dos not exist, as we wi
                         ? $self->convert_dens_to_pct (value => $params{DENSITY})
                         : undef;
         
-        my $group = Sirca::Group->new (
+        push @rows, {
             %params,
             DENSITY_PCT => $dens_pct,
             COORD_ARRAY => [$line[$header_col{X}], $line[$header_col{Y}]],
             ID          => $group_id,
-            population  => $self,
-        );
-        
-        $self->add_group (group => $group);
+        };
+    }
+
+    return \@rows;
+}
+
+#  returns the params of the groups in a binary density file's contents
+#  (see density_convert.py for the layout)
+sub parse_binary_data_file {
+    my $self = shift;
+    my %args = @_;
+    
+    my $data_ref   = $args{data};
+    my $input_file = $args{file};
+    my $join_char  = $args{join_char};
+    
+    my $offset = length $binary_density_magic;
+    my ($version, $row_count, $col_count) = unpack "\@$offset V V V", $$data_ref;
+    croak "Data file $input_file is version $version of the binary format, not 1\n"
+      if $version != 1;
+    $offset += 12;
+    
+    my (@header, $template);
+    my $row_size = 0;
+    foreach my $i (1 .. $col_count) {
+        my ($name, $type) = unpack "\@$offset Z16 a", $$data_ref;
+        croak "Data file $input_file has unknown column type $type\n"
+          if ! exists $binary_density_types{$type};
+        push @header, $name;
+        $template .= $binary_density_types{$type};
+        $row_size += $binary_density_sizes{$type};
+        $offset   += 17;
+    }
+    
+    croak "Data file $input_file is truncated\n"
+      if length ($$data_ref) < $offset + $row_count * $row_size;
+
+    $self->update_log (
+        text => "Reading binary data from $input_file\n"
+              . "Columns are:\n\t" . join ($comma, @header) . "\n",
+    );
+
+    #  all the values in one go
+    my @values = unpack "\@$offset ($template)$row_count", $$data_ref;
+    
+    my @rows;
+    my $last_col = $col_count - 1;
+    foreach my $i (0 .. $row_count - 1) {
+        my %params;
+        @params{@header} = @values[$i * $col_count .. $i * $col_count + $last_col];
         
-        #  add to the hash with this state (if non-zero)
-        if (defined $params{STATE} && $params{STATE} != $self->get_param ('DEFAULT_STATE')) {
-            $self->{STATE}{$group->get_state} = $group;
+        #  NaN is a missing value
+        foreach my $value (values %params) {
+            $value = undef if $value != $value;
         }
+        $params{STATE} = undef
+          if defined $params{STATE} && $params{STATE} == $binary_no_state;
+        delete @params{grep {! defined $params{$_}} keys %params};
+        
+        #  the converter drops these, but the file may have come from elsewhere
+        next if (defined $params{DENSITY} && $params{DENSITY} <= 0);
         
-        $coord_count++;
+        $params{DENSITY_PCT} = defined $params{DENSITY}
+                        ? $self->convert_dens_to_pct (value => $params{DENSITY})
+                        : undef;
+        $params{COORD_ARRAY} = [$params{X}, $params{Y}];
+        $params{ID} = join ($join_char, $params{X}, $params{Y});
+        
+        push @rows, \%params;
     }
+    
+    return \@rows;
+}
 
-    close $data_fh || croak "could not close $input_file\n";
-    $self->update_log (text => "Read $coord_count valid lines from $input_file\n");
+#  the process-wide caches of data built from density files
+sub get_cached {
+    my ($cache, $key) = @_;
+
+    return if ! exists $data_cache{$cache}{$key};
+
+    #  most recently used last
+    my $order = $data_cache_order{$cache};
+    if ($order->[-1] ne $key) {
+        @$order = ((grep {$_ ne $key} @$order), $key);
+    }
+
+    return $data_cache{$cache}{$key};
+}
+
+sub set_cached {
+    my ($cache, $key, $value) = @_;
+    
+    my $order = $data_cache_order{$cache};
+    push @$order, $key if ! exists $data_cache{$cache}{$key};
+    $data_cache{$cache}{$key} = $value;
+    while (scalar @$order > $max_cached{$cache}) {
+        delete $data_cache{$cache}{shift @$order};
+    }
     
     return;
 }
 
+#  make room for at least count entries in a cache (eg: the neighbour
+#  tables of every pair of models in a landscape, which are all used
+#  each timestep)
+sub reserve_cached {
+    my ($cache, $count) = @_;
+
+    croak "Unknown cache $cache\n" if ! exists $max_cached{$cache};
+    $max_cached{$cache} = max ($max_cached{$cache}, $count);
+
+    return;
+}
+
+#  frees the memory of the caches (eg when a saved landscape is loaded)
+sub clear_data_cache {
+    foreach my $cache (keys %data_cache) {
+        %{$data_cache{$cache}} = ();
+        @{$data_cache_order{$cache}} = ();
+    }
+    return;
+}
+
 sub add_group {
     my $self = shift;
     my %args = @_;
@@ -2089,7 +2641,7 @@ sub get_density_image {  #  create an image of the density surface to use as a b
 sub to_image {
     my $self = shift;
     
-    my $png = $self->get_param ('DENSITY_IMAGE');
+    my $png = $self->get_density_image;
     
     my $img = GD::Image->new ($png);
 
@@ -2333,7 +2885,7 @@ sub schedule_group_events {
     my $count = 0;
     #  unpack the events and schedule them
     #  just need to add the timestep to the schedule.  It is otherwise the same structure
-    foreach my $time_step (keys %$event_array) {
+    foreach my $time_step (sort numerically keys %$event_array) {
         foreach my $specs (@{$event_array->{$time_step}}) {
             $self->schedule_group_event (
                 timestep => $time_step,
@@ -2354,7 +2906,7 @@ sub schedule_global_events {
     my $count = 0;
     #  unpack the events and schedule them
     #  just need to add the timestep to the schedule.  It is otherwise the same structure
-    foreach my $time_step (keys %$event_array) {
+    foreach my $time_step (sort numerically keys %$event_array) {
         foreach my $specs (@{$event_array->{$time_step}}) {
             $self->schedule_global_event (
                 timestep => $time_step,
@@ -2571,7 +3123,8 @@ sub run_group_events {
     my %group_events = $self->get_group_events (timestep => $timestep);
     
     my $event_count = 0;
-    foreach my $group (keys %group_events) {
+    #  in id order, as the events can draw random numbers
+    foreach my $group (sort keys %group_events) {
         my $events_ref = $group_events{$group};
         if (! defined $events_ref) {
             warn "Cannot run group events.  Events not defined for $group, $timestep\n";
@@ -0,0 +1,373 @@
+# vim: set ts=4 sw=4 et :
+"""
+Headless export of map animations (no wx needed)
+
+Streams the frames of a repetition from frame_raster.FrameRasterizer
+straight into an encoder, with no intermediate image files (which is what
+extract_results.pl's generate_animations does).  Animated GIF and APNG are
+written natively, MP4 by piping raw frames to a local ffmpeg.
+
+The frames are rasterized in order in this process, which is cheap as
+only the cells that changed are updated.  Compressing them is the costly
+part, so that is spread over a pool of worker processes, and the results
+are written in order as they come back.  For GIF and APNG, only the
+region that changed since the previous frame is compressed.
+
+usage: python animation.py [options] --state FILE
+"""
+
+import os
+import sys
+import time
+import zlib
+import struct
+import logging
+import optparse
+import subprocess
+import multiprocessing
+from collections import deque
+from distutils.spawn import find_executable
+
+import numpy
+
+import frame_raster
+
+log = logging.getLogger('export.animation')
+
+FORMATS = ('gif', 'apng', 'mp4')
+EXTENSIONS = { 'gif' : 'gif', 'apng' : 'png', 'mp4' : 'mp4' }
+
+# frames queued per worker process (bounds the memory used)
+FRAMES_PER_PROCESS = 4
+
+
+class AnimationError(Exception):
+    pass
+
+# GIF and APNG frames are indexed, so the 255 density greys of
+# frame_raster.DENSITY_LUT are cut down to fit the state colours in
+GREY_LEVELS = 256 - 1 - len(frame_raster.STATE_COLOURS)
+
+# density raster value -> palette index (0 is no group)
+DENSITY_INDEX = numpy.zeros(256, dtype=numpy.uint8)
+DENSITY_INDEX[1:] = 1 + numpy.arange(255) * (GREY_LEVELS - 1) // 254
+
+# palette index -> colour
+PALETTE = numpy.zeros((256, 3), dtype=numpy.uint8)
+PALETTE[0] = frame_raster.DENSITY_LUT[0]
+PALETTE[1:GREY_LEVELS + 1] = frame_raster.DENSITY_LUT[
+    1 + numpy.arange(GREY_LEVELS) * 254 // (GREY_LEVELS - 1)]
+PALETTE[GREY_LEVELS + 1:] = frame_raster.RANK_LUT[1:]
+
+
+def to_indexed(rank, density):
+    """returns the palette indices for rank and density rasters"""
+    indexed = DENSITY_INDEX[density]
+    coloured = rank > 0
+    indexed[coloured] = GREY_LEVELS + rank[coloured]
+    return indexed
+
+def get_changed_box(previous, current):
+    """returns (top, left, bottom, right) of the pixels that differ
+    (a single pixel if none do, as a frame can't be empty)"""
+    changed = previous != current
+    rows = numpy.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return (0, 0, 1, 1)
+    cols = numpy.flatnonzero(changed.any(axis=0))
+    return (rows[0], cols[0], rows[-1] + 1, cols[-1] + 1)
+
+
+def lzw_compress(pixels, min_code_size=8):
+    """GIF flavoured LZW compression of a string of 8 bit pixels"""
+    clear_code = 1 << min_code_size
+    end_code = clear_code + 1
+
+    out = bytearray()
+    bits = clear_code   # bits waiting to be written (least significant first)
+    nbits = code_size = min_code_size + 1
+    next_code = end_code + 1
+    table = {}  # (prefix code << 8 | pixel) -> code
+
+    data = iter(bytearray(pixels))
+    prefix = next(data)
+    for pixel in data:
+        key = (prefix << 8) | pixel
+        code = table.get(key)
+        if code is not None:
+            prefix = code
+            continue
+
+        bits |= prefix << nbits
+        nbits += code_size
+        while nbits >= 8:
+            out.append(bits & 0xff)
+            bits >>= 8
+            nbits -= 8
+
+        if next_code < 4096:
+            table[key] = next_code
+            next_code += 1
+            # the decoder adds its entries a code later, so it
+            # widens its codes once it sees the next one
+            if next_code > (1 << code_size):
+                code_size += 1
+        else:
+            # table is full, so start again
+            bits |= clear_code << nbits
+            nbits += code_size
+            table = {}
+            code_size = min_code_size + 1
+            next_code = end_code + 1
+        prefix = pixel
+
+    for code in (prefix, end_code):
+        bits |= code << nbits
+        nbits += code_size
+    while nbits > 0:
+        out.append(bits & 0xff)
+        bits >>= 8
+        nbits -= 8
+    return str(out)
+
+
+def encode_frame(job):
+    """compresses a frame (or the part of it that changed) for the format.
+    Returns (left, top, width, height, data) in scaled pixels"""
+    (fmt, top, left, pixels, scale) = job
+    if scale > 1:
+        pixels = pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+    (height, width) = pixels.shape
+
+    if fmt == 'gif':
+        data = lzw_compress(numpy.ascontiguousarray(pixels).tostring())
+    elif fmt == 'apng':
+        # each row starts with its filter type (0, none)
+        rows = numpy.zeros((height, width + 1), dtype=numpy.uint8)
+        rows[:, 1:] = pixels
+        data = zlib.compress(rows.tostring())
+    else:
+        data = PALETTE[pixels].tostring()
+    return (left * scale, top * scale, width, height, data)
+
+
+class GifWriter:
+    """Writes an animated GIF, one (partial) frame at a time"""
+
+    def __init__(self, filename, width, height, fps, frames):
+        self.fh = open(filename, 'wb')
+        self.delay = int(round(100.0 / fps)) # in 1/100 seconds
+
+        self.fh.write('GIF89a')
+        # 256 colour global colour table
+        self.fh.write(struct.pack('<HHBBB', width, height, 0xf7, 0, 0))
+        self.fh.write(PALETTE.tostring())
+        # loop forever
+        self.fh.write('\x21\xff\x0bNETSCAPE2.0\x03\x01' + struct.pack('<H', 0) + '\x00')
+
+    def AddFrame(self, left, top, width, height, data):
+        # graphic control extension - leave the frame for the next to draw over
+        self.fh.write('\x21\xf9\x04' + struct.pack('<BHBB', 0x04, self.delay, 0, 0))
+        self.fh.write(',' + struct.pack('<HHHHB', left, top, width, height, 0))
+        self.fh.write('\x08')
+        for i in range(0, len(data), 255):
+            block = data[i:i + 255]
+            self.fh.write(chr(len(block)) + block)
+        self.fh.write('\x00')
+
+    def Close(self):
+        self.fh.write(';')
+        self.fh.close()
+
+
+class ApngWriter:
+    """Writes an animated PNG, one (partial) frame at a time"""
+
+    def __init__(self, filename, width, height, fps, frames):
+        self.fh = open(filename, 'wb')
+        self.sequence = 0
+        self.delay = (int(round(1000.0 / fps)), 1000) # seconds as a fraction
+
+        self.fh.write('\x89PNG\r\n\x1a\n')
+        self.WriteChunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 3, 0, 0, 0))
+        self.WriteChunk('PLTE', PALETTE.tostring())
+        self.WriteChunk('acTL', struct.pack('>II', frames, 0))
+
+    def WriteChunk(self, chunk_type, data):
+        self.fh.write(struct.pack('>I', len(data)))
+        self.fh.write(chunk_type + data)
+        self.fh.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+    def AddFrame(self, left, top, width, height, data):
+        # dispose none, blend source
+        self.WriteChunk('fcTL', struct.pack('>IIIIIHHBB', self.sequence, width, height,
+                                            left, top, self.delay[0], self.delay[1], 0, 0))
+        if self.sequence == 0:
+            # the first frame is also the image for viewers without APNG support
+            self.WriteChunk('IDAT', data)
+            self.sequence += 1
+        else:
+            self.WriteChunk('fdAT', struct.pack('>I', self.sequence + 1) + data)
+            self.sequence += 2
+
+    def Close(self):
+        self.WriteChunk('IEND', '')
+        self.fh.close()
+
+
+class Mp4Writer:
+    """Pipes RGB frames to ffmpeg"""
+
+    def __init__(self, filename, width, height, fps, frames, ffmpeg=None):
+        ffmpeg = ffmpeg or find_executable('ffmpeg')
+        if ffmpeg is None:
+            raise AnimationError("MP4 needs ffmpeg, which wasn't found")
+        args = [ffmpeg, '-y', '-loglevel', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                '-s', '%dx%d' % (width, height), '-r', str(fps), '-i', '-',
+                # H.264 needs even dimensions
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                '-pix_fmt', 'yuv420p', filename]
+        self.process = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def AddFrame(self, left, top, width, height, data):
+        self.process.stdin.write(data)
+
+    def Close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise AnimationError("ffmpeg failed (exit code %d)" % self.process.returncode)
+
+WRITERS = { 'gif' : GifWriter, 'apng' : ApngWriter, 'mp4' : Mp4Writer }
+
+
+def get_frame_jobs(rasterizer, fmt, scale=1, start=0, stop=None):
+    """yields the encode_frame jobs for the frames start..stop"""
+    previous = None
+    for (timestep, rank, density) in rasterizer.IterFrames(start, stop):
+        indexed = to_indexed(rank, density)
+        if previous is None or fmt == 'mp4':
+            (top, left, bottom, right) = (0, 0) + indexed.shape
+        else:
+            (top, left, bottom, right) = get_changed_box(previous, indexed)
+        yield (fmt, top, left, indexed[top:bottom, left:right], scale)
+        previous = indexed
+
+
+def write_animation(rasterizer, filename, fmt='gif', fps=5, scale=1,
+                    start=0, stop=None, pool=None, processes=1, **writer_args):
+    """Renders the frames of rasterizer to filename.  Frames are
+    compressed by pool, which has the given number of processes (or in
+    this process if there isn't one).  Returns the number of frames
+    written."""
+    if stop is None:
+        stop = rasterizer.GetIterations()
+    frames = stop - start + 1
+    (rows, cols) = rasterizer.GetShape()
+    writer = WRITERS[fmt](filename, cols * scale, rows * scale, fps, frames, **writer_args)
+
+    jobs = get_frame_jobs(rasterizer, fmt, scale, start, stop)
+    if pool is None:
+        for job in jobs:
+            writer.AddFrame(*encode_frame(job))
+        writer.Close()
+        return frames
+
+    # keep a window of jobs in the pool, and write the results in order
+    window = FRAMES_PER_PROCESS * processes
+    pending = deque()
+    for job in jobs:
+        pending.append(pool.apply_async(encode_frame, (job,)))
+        if len(pending) >= window:
+            writer.AddFrame(*pending.popleft().get())
+    while pending:
+        writer.AddFrame(*pending.popleft().get())
+    writer.Close()
+    return frames
+
+
+def load_map_data(filename, model_filter=None, repetition=1):
+    """runs a SIRCA perl worker to get the map data of the models of a
+    saved state.  Returns [map_data.MapData], in model order"""
+    import perl_interface
+    import perl_commands
+
+    sirca = perl_interface.SIRCAInstance()
+    try:
+        sirca.DoCommand(perl_commands.LoadFromSavedState(filename))
+        models_command = perl_commands.GetMapModels()
+        sirca.DoCommand(models_command)
+        if repetition > models_command.GetRepetitions():
+            raise AnimationError("%s has %d repetitions" % (filename, models_command.GetRepetitions()))
+
+        result = []
+        models = models_command.GetModels()
+        for i in range(len(models)):
+            if model_filter is not None and model_filter not in (models[i], str(i)):
+                continue
+            map_command = perl_commands.GetMapData(model=i, repetition=repetition)
+            sirca.DoCommand(map_command)
+            result.append(map_command.GetMapData())
+        return result
+    finally:
+        sirca.Close()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] --state FILE")
+    parser.add_option("--state", help="saved state (.scs) to animate")
+    parser.add_option("--model", default=None, help="label or index of the model to animate (default: all)")
+    parser.add_option("-r", "--repetition", type="int", default=1)
+    parser.add_option("-o", "--outdir", default=".", help="directory for the animations")
+    parser.add_option("-f", "--format", default="gif", help="one of %s" % ", ".join(FORMATS))
+    parser.add_option("--fps", type="float", default=5, help="frames per second")
+    parser.add_option("--scale", type="int", default=1, help="pixels per cell")
+    parser.add_option("--cellsize", type="float", default=None,
+                      help="map units per cell (default: the model's IMAGE_CELLSIZE)")
+    parser.add_option("--start", type="int", default=0, help="first timestep")
+    parser.add_option("--stop", type="int", default=None, help="last timestep")
+    parser.add_option("--ffmpeg", default=None, help="path to ffmpeg (for mp4)")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="number of worker processes (default: one per CPU)")
+    (options, args) = parser.parse_args(argv)
+
+    if options.state is None:
+        parser.error("need --state")
+    if options.format not in FORMATS:
+        parser.error("unsupported format: %s" % options.format)
+    writer_args = {}
+    if options.format == 'mp4':
+        writer_args['ffmpeg'] = options.ffmpeg
+
+    map_datas = load_map_data(options.state, options.model, options.repetition)
+    if not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    pool = None
+    processes = options.processes or multiprocessing.cpu_count()
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    try:
+        for map_data in map_datas:
+            rasterizer = frame_raster.FrameRasterizer(map_data, options.cellsize)
+            filename = os.path.join(options.outdir, "%s_rep%d.%s" % (
+                map_data.label, options.repetition, EXTENSIONS[options.format]))
+
+            start = time.time()
+            frames = write_animation(rasterizer, filename, options.format,
+                                     options.fps, options.scale,
+                                     options.start, options.stop,
+                                     pool, processes, **writer_args)
+            taken = time.time() - start
+            print "wrote %s: %d frames in %.2f seconds (%.1f frames/second)" % (
+                filename, frames, taken, frames / max(taken, 1e-6))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
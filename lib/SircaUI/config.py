@@ -3,7 +3,8 @@
 GUI class for configuring parameters
 
 The parameter file is in perl syntax and is
-imported/exported via the sirca interface
+imported/exported by perl_data (or via the sirca
+interface for what that can't parse)
 
 This module's ControlFile class then produces
 the UI:
@@ -28,47 +29,39 @@ import main
 import listedit
 import workspace
 import event_grid
+import event_io
+import table_grid
 import perl_commands
+import perl_data
 
 ScrolledPanel = wx.lib.scrolledpanel.ScrolledPanel
 
 g_openConfigPanels = {}
 
-def get_sorted_fields(metadata_root, config_fields):
+def get_sorted_fields(metadata_index, config_fields):
     """takes in a dictionary mapping config key -> config value
     returns a list of (key, value) ordered according to the XML file"""
+    return metadata_index.SortFields(config_fields)
 
+def create_field_presenter(view, metadata_index, key, value, log):
+    """returns an object to edit the config field key (with value),
+    or None if there isn't one for its metadata"""
+    fields = metadata_index.GetFields(key)
+    if len(fields) == 0:
+        log.warn('no metadata found for field ' + key)
+        return None
+    elif len(fields) > 1:
+        log.warn('multiple metadata items found for field ' + key)
+        return None
 
-    def __get_field_orders():
-        """returns hash: field name -> order as field appears in the xml file"""
-        hash = {}
-        i = 0
-        for field in metadata_root.getiterator('field'):
-            hash[field.attrib['name']] = i
-            i = i + 1
-        
-        return hash
-
+    class_type = metadata_index.GetPresenterClass(key, view.field_types)
+    if class_type is None:
+        log.warn('no control for field %s of type %s' % (key, fields[0].get('type')))
+        return None
 
-    dict_tuples = [ (key, value) for key, value in config_fields.iteritems() ]
-    dict_sort = __get_field_orders()
-
-    def sort_cmp(a,b):
-        try:
-            ia = dict_sort[a[0]]
-        except:
-            return 1
-
-        try:
-            ib = dict_sort[b[0]]
-        except:
-            return -1
-
-        return cmp(ia, ib)
-
-
-    dict_tuples.sort(cmp=sort_cmp)
-    return dict_tuples
+    field_presenter = class_type(key=key, metadata=ArgsWithMetadata(metadata=fields[0]))
+    field_presenter.SetConfigValue(value)
+    return field_presenter
 
 
 class GUITreeNode:
@@ -191,6 +184,8 @@ class ConfigPanel(wx.Panel):
         except AttributeError:
             pass
 
+EVENT_FILE_WILDCARD = "CSV files (*.csv)|*.csv|numpy files (*.npz)|*.npz"
+
 class EventsTableField:
     """Implements an event editor using a grid"""
     log = logging.getLogger('config.EventsTable')
@@ -199,15 +194,51 @@ class EventsTableField:
         self.metadata = kwargs['metadata']
         self.sirca_dict = None
         self.control = None
+        self.changed = False # whether sirca_dict is older than the grid
+        self.change_callbacks = []
 
     def CreateControl(self, fields_panel):
+        # the grid, with buttons for loading/saving the events as a file
+        vsizer = wx.BoxSizer(wx.VERTICAL)
+        hsizer = wx.BoxSizer(wx.HORIZONTAL)
+
         self.control = event_grid.EventsTableGrid(fields_panel)
+        self.control.GetTable().SetChangeCallback(self.OnEventsChanged)
+        import_button = wx.Button(fields_panel, -1, "Import...")
+        export_button = wx.Button(fields_panel, -1, "Export...")
+        import_button.Bind(wx.EVT_BUTTON, self.OnImport)
+        export_button.Bind(wx.EVT_BUTTON, self.OnExport)
+
+        hsizer.Add(import_button, 0)
+        hsizer.Add(export_button, 0)
+        vsizer.Add(self.control, 1, wx.EXPAND)
+        vsizer.Add(hsizer, 0)
+
         self.__set_value()
-        return self.control
+        return vsizer
 
+    def ReleaseControl(self):
+        # keeps any edits, as the grid is going
+        if self.control is not None:
+            self.GetConfigValue()
+        self.control = None
+
     def SetConfigValue(self, sirca_dict):
         self.sirca_dict = sirca_dict
+        self.changed = False
         self.__set_value()
+        self.__call_change_callbacks()
+
+    def RegisterChangeCallback(self, callback):
+        self.change_callbacks.append(callback)
+
+    def __call_change_callbacks(self):
+        for cb in self.change_callbacks:
+            cb()
+
+    def OnEventsChanged(self):
+        self.changed = True
+        self.__call_change_callbacks()
 
     def __set_value(self):
         sirca_dict = self.sirca_dict
@@ -231,29 +262,78 @@ class EventsTableField:
                     events.append( { 'time':int(t), 'type':typename, 'params':event} )
 
 
-            # load types as given by the metadata
-            types = {}
-            for type_node in self.metadata.GetNode():
-                typename = type_node.get('name')
+            # load the EventsDataTable
+            self.control.GetTable().InitData(events, self.__get_types())
 
-                params = {}
-                for field_node in type_node:
-                    params[field_node.get('name')] = field_node.get('default')
+    def __get_types(self):
+        """returns the event types as given by the metadata"""
+        types = {}
+        for type_node in self.metadata.GetNode():
+            typename = type_node.get('name')
 
-                # store this type
-                types[typename] = params                
-                        
-            # load the EventsDataTable
-            self.control.GetTable().InitData(events, types)
+            params = {}
+            for field_node in type_node:
+                params[field_node.get('name')] = field_node.get('default')
+
+            # store this type
+            types[typename] = params
+        return types
+
+    def OnImport(self, event):
+        dlg = wx.FileDialog(
+            None, message="Import events for " + self.key,
+            defaultFile="",
+            wildcard=EVENT_FILE_WILDCARD,
+            style=wx.OPEN)
+        try:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            filename = dlg.GetPath()
+        finally:
+            dlg.Destroy()
+
+        busy = wx.BusyCursor()
+        try:
+            event_types = event_io.get_event_types(self.metadata.GetNode())
+            events = event_io.read_events(filename, event_types)
+        except (event_io.EventIOError, IOError), value:
+            del busy
+            self.log.error(str(value))
+            wx.MessageBox(str(value), "Could not import events", wx.OK | wx.ICON_ERROR)
+            return
+
+        # replaces the events in the grid, which is updated once
+        self.control.GetTable().InitData(events, self.__get_types())
+        self.OnEventsChanged()
+        self.log.info("field %s: imported %d events from %s" % (self.key, len(events), filename))
+
+    def OnExport(self, event):
+        dlg = wx.FileDialog(
+            None, message="Export events of " + self.key,
+            defaultFile=self.key.lower() + ".csv",
+            wildcard=EVENT_FILE_WILDCARD,
+            style=wx.SAVE | wx.OVERWRITE_PROMPT)
+        try:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            filename = dlg.GetPath()
+        finally:
+            dlg.Destroy()
+
+        try:
+            event_io.write_events(filename, self.control.GetTable().GetEvents())
+        except IOError, value:
+            self.log.error(str(value))
+            wx.MessageBox(str(value), "Could not export events", wx.OK | wx.ICON_ERROR)
 
     def GetConfigKey(self):
         return self.key
 
     def GetConfigValue(self):
-        if self.control is None:
-            # not loaded yet - return raw data
+        if self.control is None or not self.changed:
+            # not loaded yet or not edited - return raw data
             if self.sirca_dict is None:
-                log.error('GetConfigValue called before SetConfigValue')
+                self.log.error('GetConfigValue called before SetConfigValue')
             return self.sirca_dict
         else:
             
@@ -275,6 +355,9 @@ class EventsTableField:
                 sirca_event['type'] = event['type']
                 sirca_dict[t].append(sirca_event)
             
+            # a new dict, so that earlier values (in snapshots) are unchanged
+            self.sirca_dict = sirca_dict
+            self.changed = False
             return sirca_dict
         
 
@@ -286,60 +369,54 @@ class GridField:
         self.key = kwargs['key']
         self.metadata = kwargs['metadata']
         self.grid_ref = None
+        self.value = None # copy of grid_ref as last returned
         self.control = None
+        self.change_callbacks = []
 
     def CreateControl(self, fields_panel):
-        self.control = wx.grid.Grid(fields_panel, -1)
-
-        self.control.SetColLabelAlignment(wx.ALIGN_LEFT, wx.ALIGN_BOTTOM)
-      
-        # events
-        self.control.Bind(wx.grid.EVT_GRID_CELL_CHANGE, self.__on_cell_changed)
-
+        # virtual, so that large tables open as quickly as small ones
+        self.control = table_grid.RowsTableGrid(fields_panel)
+        self.control.GetTable().SetChangeCallback(self.OnCellChanged)
         self.__set_value()
-
         return self.control
 
+    def ReleaseControl(self):
+        # edits are already in grid_ref
+        self.control = None
+
 
     def SetConfigValue(self, grid_ref):
-        self.grid_ref = grid_ref
+        # edits are made to a copy, so that the value given (which may be
+        # part of a snapshot) isn't changed
+        self.grid_ref = [list(row) for row in grid_ref]
+        self.value = grid_ref
         self.__set_value()
+        self.__call_change_callbacks()
+
+    def RegisterChangeCallback(self, callback):
+        self.change_callbacks.append(callback)
+
+    def __call_change_callbacks(self):
+        for cb in self.change_callbacks:
+            cb()
+
+    def OnCellChanged(self):
+        self.value = None
+        self.__call_change_callbacks()
 
     def __set_value(self):
-        grid_ref = self.grid_ref
-        if self.control is not None and grid_ref is not None:
-            rows = len(grid_ref)
-            cols = len(grid_ref[-1])
-
-            self.control.CreateGrid(rows, cols)
-            
-            # fill grid
-            for i in range(rows):
-                for j in range(cols):
-                    try:
-                        value = grid_ref[i][j]
-                        self.control.SetCellValue(i, j, str(value))
-                        #self.SetCellEditor(i, j, wx.grid.GridCellFloatEditor(0,1000))
-                    except IndexError:
-                        # empty rows readonly for now
-                        self.control.SetReadOnly(i, j, True)
-
-            #self.SetColLabelValue(0, "Custom")
-            #self.SetColLabelValue(1, "column")
-            #self.SetColLabelValue(2, "labels")
+        if self.control is not None and self.grid_ref is not None:
+            # edits are made to grid_ref
+            self.control.GetTable().SetRows(self.grid_ref)
 
 
     def GetConfigKey(self):
         return self.key
 
     def GetConfigValue(self):
-        return self.grid_ref
-        
-    def __on_cell_changed(self, evt):
-        row, col = evt.GetRow(), evt.GetCol()
-        value = self.control.GetCellValue(row, col)
-        self.log.debug( "field (%d,%d) changed to %s" % (row, col, str(value)))
-        self.grid_ref[row][col] = value
+        if self.value is None:
+            self.value = [list(row) for row in self.grid_ref]
+        return self.value
 
 
 class TextField:
@@ -357,10 +434,17 @@ class TextField:
         self.control.Bind(wx.EVT_TEXT, self.OnTextChanged)
         self.__set_value()
         return self.control
+
+    def ReleaseControl(self):
+        self.control = None
 
     def OnTextChanged(self, event):
-        self.value = event.GetString()
-        self.value = str(self.value) # no !!python/unicode pls
+        text = str(event.GetString()) # no !!python/unicode pls
+        if self.value is not None and text == str(self.value):
+            # eg: the value being shown.  Loaded numbers stay numbers,
+            # so showing a field doesn't change the config
+            return
+        self.value = text
         self.__call_change_callbacks()
         self.log.debug("field %s changed to %s" % (self.key, self.value))
 
@@ -385,9 +469,7 @@ class TextField:
         if self.control is not None:
             if self.value is None:
                 self.value = '[None!]'
-            else:
-                self.value = str(self.value)
-            self.control.SetValue(self.value)
+            self.control.SetValue(str(self.value))
             self.__call_change_callbacks()
 
 
@@ -407,6 +489,7 @@ class ListField:
         self.value = []
         self.control = None
         self.textbox = None
+        self.change_callbacks = []
 
     def CreateControl(self, fields_panel):
         # create a horizontal sizer for a readonly textbox and an edit button
@@ -423,11 +506,16 @@ class ListField:
 
         return hsizer
 
+    def ReleaseControl(self):
+        self.textbox = None
+        self.button = None
+
     def SetConfigValue(self, value):
         # only numeric lists are supported
         try:
             self.value = map(int, value) # try converting to ints
             self.__set_value()
+            self.__call_change_callbacks()
             
         except TypeError:
             self.log.error( "item: %s: only numeric lists are currently supported" % (self.key))
@@ -435,6 +523,13 @@ class ListField:
     def __set_value(self):
         if self.textbox is not None:
             self.textbox.SetValue(str(self.value))
+
+    def RegisterChangeCallback(self, callback):
+        self.change_callbacks.append(callback)
+
+    def __call_change_callbacks(self):
+        for cb in self.change_callbacks:
+            cb()
 
 
 
@@ -448,6 +543,7 @@ class ListField:
             self.log.debug( "field %s changed to %s" % (self.key, str(result)))
             self.value = result
             self.textbox.SetValue(str(result))
+            self.__call_change_callbacks()
         dlg.Destroy()
         
 
@@ -467,6 +563,7 @@ class FieldsPanel(ScrolledPanel, workspace.WorkspacePanel):
         self.SetupScrolling()
         self.caption = caption
         self.config_obj = config_obj
+        self.fields = [] # whose controls are on this panel
 
     # WorkspacePanel methods
     def GetCaption(self):
@@ -474,10 +571,21 @@ class FieldsPanel(ScrolledPanel, workspace.WorkspacePanel):
     def GetKey(self):
         return self.config_obj
 
+    def ReleaseResources(self):
+        # the controls go with the panel, so the fields keep only their
+        # values, and make new controls if the panel is opened again
+        for field in self.fields:
+            field.ReleaseControl()
+        self.fields = []
+
     def LoadFields(self, config_node):
+        # the old controls are deleted below
+        self.ReleaseResources()
+
         # create controls for each supported config items
         control_grid = []
         for field in config_node.IterateFields():
+            self.fields.append(field)
             
             control = field.CreateControl(self)
             label_ctl = wx.StaticText(self, -1, self.MakeFriendlyLabel(field.GetConfigKey()) )
@@ -563,6 +671,18 @@ class ConfigNode:
         self.key = args.get('key')
         self.control = None
         self.children = []
+        self.parent = None  # told of changes (see ControlFile.ChildChanged)
+        self.value = None   # the last config value, until a child changes
+
+    def SetParent(self, parent):
+        self.parent = parent
+
+    def ChildChanged(self, node, key):
+        """called when field key of node (under this one) changes, or with
+        key None when nodes or fields are added or removed"""
+        self.value = None
+        if self.parent is not None:
+            self.parent.ChildChanged(node, key)
 
     def LoadControl(self, control):
         """loads this node into the presentation control"""
@@ -581,15 +701,26 @@ class ConfigNode:
 
         if self.control is not None:
             self.__add_child_control(self.control, child_item)
+        self.ChildChanged(child_item, None)
 
     def DeleteChildItem(self, child_item):
         self.children.remove(child_item)
+        self.ChildChanged(child_item, None)
 
     def GetConfigValue(self):
-        """returns this node's final configuration (including everything underneath it..."""
-        # get list of children's configuration values
-        child_vals = map(lambda child: child.GetConfigValue(), self.children)
-        return { self.key : child_vals }
+        """returns this node's final configuration (including everything underneath it...
+        It is shared with earlier values where the children haven't changed, so
+        mustn't be changed"""
+        if self.value is None:
+            # get list of children's configuration values
+            child_vals = map(lambda child: child.GetConfigValue(), self.children)
+            self.value = { self.key : child_vals }
+        return self.value
+
+    def RestoreValue(self, value):
+        """sets the children back to an earlier value (with the same children)"""
+        for (child, child_value) in zip(self.children, value[self.key]):
+            child.RestoreValue(child_value)
 
     def __add_child_control(self, control, child_item):
         child_control = control.CreateChild()
@@ -608,6 +739,12 @@ class ConfigFieldsNode:
             self.label_field_name = self.args.get('label_field_name')
         self.control = None
         self.fields = []
+
+        # the last config value, with the keys of the fields changed since
+        # then.  Values are shared by the snapshots of ControlFile, so a new
+        # dict is made when fields change rather than changing this one.
+        self.value = {}
+        self.dirty = set()
 
         # possible actions for popup menu
         self.allow_duplicate = args.get('allow_duplicate')
@@ -658,6 +795,12 @@ class ConfigFieldsNode:
 
     def AddField(self, field_control):
         self.fields.append(field_control)
+
+        key = field_control.GetConfigKey()
+        field_control.RegisterChangeCallback(lambda: self.__field_changed(key))
+        self.dirty.add(key)
+        self.__tell_parent(None)
+
         if self.label_mode == 'field':
             if self.label_field_name == field_control.GetConfigKey():
                 # pass field_control to __update_label so it doesn't have
@@ -670,6 +813,13 @@ class ConfigFieldsNode:
     def IterateFields(self):
         for field in self.fields:
             yield field
+
+    def __field_changed(self, key):
+        self.dirty.add(key)
+        self.__tell_parent(key)
+
+    def __tell_parent(self, key):
+        self.config_parent.ChildChanged(self, key)
 
     def OnActivated(self):
         # try to open an existing panel
@@ -709,28 +859,20 @@ class ConfigFieldsNode:
         self.config_parent.AddChildItem(dup_node)
 
         # add each field
-        metadata_root = self.args.get('metadata_root')
+        metadata_index = self.args.get('metadata_index')
         view = self.args.get('view')
         label_field_name = self.args.get('label_field_name')
 
-        for key, value in get_sorted_fields(metadata_root, self.GetConfigValue()):
+        for key, value in get_sorted_fields(metadata_index, self.GetConfigValue()):
 
             # change label to indicate duplicate
             if key == label_field_name:
                 value = value + ' copy'
 
-            field_metadata = metadata_root.xpath('//field[@name="%s"]' % (key) )
-            if len(field_metadata) == 1:
-                # create a presenter object to edit the field
-                field_metadata = ArgsWithMetadata(metadata=field_metadata[0])
-                field_type = field_metadata.get('type')
-                field_presenter = view.MapFieldTypeToPresenter(field_type, key=key, metadata=field_metadata)
-
-                if field_presenter:
-                    field_presenter.SetConfigValue(value)
-                    dup_node.AddField(field_presenter)
-            else:
-                self.error('BUG: OnDuplicate: don\'t have one metadata entry for field ' + key)
+            # create a presenter object to edit the field
+            field_presenter = create_field_presenter(view, metadata_index, key, value, self.log)
+            if field_presenter:
+                dup_node.AddField(field_presenter)
 
 
     def OnDelete(self, event):
@@ -743,10 +885,27 @@ class ConfigFieldsNode:
 
 
     def GetConfigValue(self):
-        """returns this node's final configuration (including everything underneath it..."""
-        # get list of children's configuration values
-        child_vals = map(lambda child: (child.GetConfigKey(), child.GetConfigValue()), self.fields)
-        return dict(child_vals)
+        """returns this node's final configuration (including everything underneath it...
+        Only the fields that changed since the last call are asked for their values"""
+        if self.dirty:
+            value = dict(self.value)
+            for field in self.fields:
+                key = field.GetConfigKey()
+                if key in self.dirty:
+                    value[key] = field.GetConfigValue()
+            self.value = value
+            self.dirty = set()
+        return self.value
+
+    def RestoreValue(self, value):
+        """sets the fields that differ from value back to it"""
+        current = self.GetConfigValue()
+        if value is current:
+            return
+        for field in self.fields:
+            key = field.GetConfigKey()
+            if key in value and value[key] is not current.get(key):
+                field.SetConfigValue(value[key])
 
 
 class GUIConfigView:
@@ -782,25 +941,6 @@ class GUIConfigView:
         """
         return self.main_frame.GetWorkspace()
 
-    def MapFieldTypeToPresenter(self, t, **kwargs):
-        """
-        Returns an object that will display/edit a field
-        of the given type. None if unhandled.
-        """
-
-        class_type = None
-        try:
-            class_type = self.field_types[t]
-        except KeyError:
-            self.log.warn("couldn't find control mapping for " + t)
-            return None
-
-        if class_type is None:
-            self.log.warn('control not yet implemented for ' + t)
-            return None
-        else:
-            return class_type(**kwargs)
-
 
     field_types = {
             'text' : TextField,
@@ -816,21 +956,54 @@ class GUIConfigView:
             'directory' : TextField, # FIXME
            }
 
+# changes that can be undone
+MAX_UNDO = 100
+
+def get_changed_keys(old, new):
+    """returns the keys that differ between two snapshots, with those of
+    models as MODEL_CONTROLS[i].KEY.  Values that are shared are skipped
+    without comparing them."""
+    changed = []
+    for key in sorted(set(old.keys()) | set(new.keys())):
+        (old_value, new_value) = (old.get(key), new.get(key))
+        if old_value is new_value:
+            continue
+        if key == 'MODEL_CONTROLS' and old_value is not None and new_value is not None \
+                and len(old_value) == len(new_value):
+            for (i, (old_model, new_model)) in enumerate(zip(old_value, new_value)):
+                if old_model is not new_model:
+                    changed.extend(['%s[%d].%s' % (key, i, k)
+                                    for k in get_changed_keys(old_model, new_model)])
+        elif old_value != new_value:
+            changed.append(key)
+    return changed
+
 class ControlFile:
     """loads a control file into the GUI"""
     log = logging.getLogger('config.ControlFile')
 
     def __init__(self, **args):
         self.config_dict = args['loader'].GetConfigDict()
-        self.metadata_root = args['metadata']
-
+        self.metadata_index = args['metadata']  # metadata_index.MetadataIndex
+
+        # snapshots of the config (see GetConfigDict)
+        self.snapshot = None
+        self.current = None     # the snapshot after the last change
+        self.loading = False
+        self.undo_stack = []    # snapshots from before each change
+        self.redo_stack = []
+        self.last_change = None # (node, key) of the last field changed
+        self.submitted = None   # the snapshot last run
+
 
     def LoadView(self, view):
+        self.loading = True
         try:
             # root
             view.ClearTree()
             root_control = view.GetTreeRoot()
             root_item = ConfigNode( ArgsWithMetadata(key='', label='root') )
+            root_item.SetParent(self)
             root_item.LoadControl(root_control)
 
             # models
@@ -842,28 +1015,19 @@ class ControlFile:
                 fields_node = ConfigFieldsNode(
                         self.config_models,
                         ArgsWithMetadata(
-                            view=view,metadata_root=self.metadata_root,
+                            view=view,metadata_index=self.metadata_index,
                             label_mode='field',label_field_name='LABEL',
                             allow_duplicate=True,allow_delete=True,min_children=1) )
                 self.config_models.AddChildItem(fields_node)
 
                 # add each field
-                for key, value in get_sorted_fields(self.metadata_root, model_config):
-
-                    field_metadata = self.metadata_root.xpath('//field[@name="%s"]' % (key) )
-                    if len(field_metadata) == 0:
-                        self.log.warn('no metadata found for field ' + key)
-                    elif len(field_metadata) > 1:
-                        self.log.warn('multiple metadata items found for field ' + key)
-                    else:
-                        # create a presenter object to edit the field
-                        field_metadata = ArgsWithMetadata(metadata=field_metadata[0])
-                        field_type = field_metadata.get('type')
-                        field_presenter = view.MapFieldTypeToPresenter(field_type, key=key, metadata=field_metadata)
-
-                        if field_presenter:
-                            field_presenter.SetConfigValue(value)
-                            fields_node.AddField(field_presenter)
+                for key, value in get_sorted_fields(self.metadata_index, model_config):
+
+                    # create a presenter object to edit the field
+                    field_presenter = create_field_presenter(view, self.metadata_index,
+                                                             key, value, self.log)
+                    if field_presenter:
+                        fields_node.AddField(field_presenter)
 
             # misc fields (in top-level dict)
             self.config_misc = ConfigFieldsNode(
@@ -872,25 +1036,15 @@ class ControlFile:
                             allow_duplicate=False,allow_delete=False,min_children=1) )
             root_item.AddChildItem(self.config_misc)
 
-            for key, value in get_sorted_fields(self.metadata_root, self.config_dict):
+            for key, value in get_sorted_fields(self.metadata_index, self.config_dict):
 
                 if type(value) != dict:
 
-                    field_metadata = self.metadata_root.xpath('//field[@name="%s"]' % (key) )
-                    if len(field_metadata) == 0:
-                        self.log.warn('no metadata found for field ' + key)
-                    elif len(field_metadata) > 1:
-                        self.log.warn('multiple metadata items found for field ' + key)
-                    else:
-                        # create a presenter object to edit the field
-                        field_metadata = field_metadata[0]
-                        field_metadata = ArgsWithMetadata(metadata=field_metadata)
-                        field_type = field_metadata.get('type')
-                        field_presenter = view.MapFieldTypeToPresenter(field_type, key=key, metadata=field_metadata)
-
-                        if field_presenter:
-                            field_presenter.SetConfigValue(value)
-                            self.config_misc.AddField(field_presenter)
+                    # create a presenter object to edit the field
+                    field_presenter = create_field_presenter(view, self.metadata_index,
+                                                             key, value, self.log)
+                    if field_presenter:
+                        self.config_misc.AddField(field_presenter)
 
         except Exception, value:
             # FIXME FIXME FIXME and similar..
@@ -900,29 +1054,99 @@ class ControlFile:
             self.log.error('exception whilst calling LoadView: ' + s)
         except:
             self.log.error('unknown exception whilst calling LoadView')
+        finally:
+            self.loading = False
+
+        self.__clear_history()
 
     def GetConfigDict(self):
-        config_dict = {}
+        """returns a snapshot of the config
 
-        # add both models and misc data
-        models = self.config_models.GetConfigValue()
-        misc = self.config_misc.GetConfigValue()
+        Snapshots share the values (and the dicts of models) that haven't
+        changed with earlier ones, so making one only costs as much as the
+        fields that changed.  They mustn't be changed."""
+        if self.snapshot is None:
+            config_dict = {}
 
-        config_dict.update(models)
-        config_dict.update(misc)
-        return config_dict
-
-    def SaveAsPerl(self, sirca_instance, filename):
+            # add both models and misc data
+            models = self.config_models.GetConfigValue()
+            misc = self.config_misc.GetConfigValue()
+
+            config_dict.update(models)
+            config_dict.update(misc)
+            self.snapshot = config_dict
+        return self.snapshot
+
+    def ChildChanged(self, node, key):
+        """called when field key of a node changes, or with key None when
+        nodes or fields are added or removed"""
+        self.snapshot = None
+        if self.loading:
+            return
+        if key is None:
+            # undo can't put back nodes
+            self.__clear_history()
+            return
+
+        # a run of changes to one field (eg: typing) is undone at once, and
+        # changes that leave the value as it was (eg: showing a field) are
+        # ignored.  The previous snapshot still has the value before the change.
+        previous = self.current
+        before = node.value.get(key)
+        self.current = self.GetConfigDict()
+        if node.GetConfigValue().get(key) == before:
+            return
+        if (node, key) != self.last_change or not self.undo_stack:
+            self.undo_stack.append(previous)
+            del self.undo_stack[:-MAX_UNDO]
+            self.redo_stack = []
+        self.last_change = (node, key)
+
+    def __clear_history(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.last_change = None
+        self.current = self.GetConfigDict()
+
+    def CanUndo(self):
+        return len(self.undo_stack) > 0
+
+    def CanRedo(self):
+        return len(self.redo_stack) > 0
+
+    def Undo(self):
+        if self.CanUndo():
+            self.redo_stack.append(self.current)
+            self.__restore(self.undo_stack.pop())
+
+    def Redo(self):
+        if self.CanRedo():
+            self.undo_stack.append(self.current)
+            self.__restore(self.redo_stack.pop())
+
+    def __restore(self, snapshot):
+        """sets the fields that differ from snapshot back to it"""
+        self.loading = True
+        try:
+            self.config_models.RestoreValue(snapshot)
+            self.config_misc.RestoreValue(snapshot)
+        finally:
+            self.loading = False
+        self.last_change = None
+        self.current = self.GetConfigDict()
+
+    def SetSubmitted(self, snapshot):
+        """records the snapshot that was run, and returns the changes
+        since the previous one (as from get_changed_keys)"""
+        previous = self.submitted
+        self.submitted = snapshot
+        if previous is None:
+            return None
+        return get_changed_keys(previous, snapshot)
+
+    def SaveAsPerl(self, filename):
         # convert our config into control file data (Perl hash format)
-        config = self.GetConfigDict()
-        command = perl_commands.WriteParametersAsControlFile(config)
-        sirca_instance.StartCommand(command)
-        control_file_data = command.GetControlFileData()
-
-        # save into file
-        f = open(filename, 'w')
-        f.write(control_file_data)
-        f.close()
+        perl_data.dump_file(filename, self.GetConfigDict())
 
 
 class PerlControlFile:
@@ -935,8 +1159,8 @@ class PerlControlFile:
             # load a perl config file
             filename = kwargs['filename']
             sirca_instance = kwargs['sirca_instance']
-            self.config_dict = self.__load_config(sirca_instance, filename)
-            self.__expand_paramsfiles(filename)
+            self.config_dict = read_parameter_files(sirca_instance, [filename])[0]
+            self.__expand_paramsfiles(sirca_instance, filename)
         elif 'config_dict' in kwargs:
            self.config_dict = kwargs['config_dict']
         else:
@@ -946,39 +1170,99 @@ class PerlControlFile:
     def GetConfigDict(self):
         return self.config_dict
 
-    def __expand_paramsfiles(self, filename):
-        """recursively find and expand all external parameter files"""
-                
-        dirname = os.path.dirname(filename)
-        def helper(obj):
+    def __expand_paramsfiles(self, sirca_instance, filename):
+        """recursively find and expand all external parameter files
+
+        The files at each level of nesting are read together in one job.
+        A file's PARAMSFILES are relative to its own directory."""
+        filename = os.path.abspath(filename)
+        pending = self.__find_paramsfiles(self.config_dict, self.config_dict, (filename,))
+
+        while pending:
+            paramsfiles = []
+            for (target, filenames, chain) in pending:
+                paramsfiles.extend([x for x in filenames if x not in paramsfiles])
+            loaded = dict(zip(paramsfiles, read_parameter_files(sirca_instance, paramsfiles)))
+
+            next_pending = []
+            for (target, filenames, chain) in pending:
+                for x in filenames:
+                    if x in chain:
+                        raise ParamsFilesException("PARAMSFILES cycle: %s" % ' -> '.join(chain + (x,)))
+                    # the same file may be included more than once
+                    d = copy.deepcopy(loaded[x])
+                    next_pending.extend(self.__find_paramsfiles(d, target, chain + (x,)))
+                    # merge
+                    target.update(d)
+            pending = next_pending
+
+    def __find_paramsfiles(self, obj, target, chain):
+        """removes the PARAMSFILES from obj and the dicts and lists in it
+        returns a list of (dict to merge them into, [filename], chain of
+        files they were included through).  The files in obj itself are
+        merged into target."""
+        dirname = os.path.dirname(chain[-1])
+        found = []
+        def helper(obj, target):
             if type(obj) == dict:
                 if "PARAMSFILES" in obj:
                     paramsfiles = obj["PARAMSFILES"]
                     del obj["PARAMSFILES"]
                     # add directory name
-                    paramsfiles = [os.path.join(dirname,x) for x in paramsfiles]
-                    # load
-                    loaded_dicts = [self.__load_config(x) for x in paramsfiles]
-                    # merge
-                    for d in loaded_dicts:
-                        obj.update(d)
-                else:
-                    # run recursively
-                    for val in obj.values():
-                        helper(val)
+                    paramsfiles = [os.path.abspath(os.path.join(dirname,x)) for x in paramsfiles]
+                    found.append( (target, paramsfiles, chain) )
+                # run recursively
+                for val in obj.values():
+                    helper(val, val)
             if type(obj) == list:
                 for val in obj:
-                    helper(val)
+                    helper(val, val)
 
-        helper(self.config_dict)
-                                        
+        helper(obj, target)
+        return found
 
-    def __load_config(self, sirca_instance, filename):
-        command = perl_commands.ReadParameters(filename)
+
+class ParamsFilesException(Exception):
+    pass
+
+log = logging.getLogger('config.ParameterFiles')
+
+# filename -> ((mtime, size), parameters), shared by all PerlControlFiles
+g_parameter_files = {}
+
+def read_parameter_files(sirca_instance, filenames):
+    """returns the parameters of each file (copies, that can be changed).
+    Files that haven't changed since they were last read come from the
+    cache, and the rest are parsed by perl_data.  Any it can't parse are
+    read by Perl in a single job."""
+    filenames = [os.path.abspath(x) for x in filenames]
+    keys = {}
+    for x in filenames:
+        stat = os.stat(x)
+        keys[x] = (stat.st_mtime, stat.st_size)
+
+    unread = []
+    for x in filenames:
+        cached = g_parameter_files.get(x)
+        if (cached is None or cached[0] != keys[x]) and x not in unread:
+            unread.append(x)
+
+    exotic = []
+    for x in unread:
+        try:
+            g_parameter_files[x] = (keys[x], perl_data.load_file(x))
+        except perl_data.PerlDataError, value:
+            log.info('%s: %s, reading it with Perl' % (x, value))
+            exotic.append(x)
+
+    if exotic:
+        command = perl_commands.ReadParametersMulti(exotic)
         sirca_instance.StartCommand(command)
-        config_dict = command.GetConfigDict()
-        return config_dict
-        
+        for (x, params) in zip(exotic, command.GetConfigDicts()):
+            g_parameter_files[x] = (keys[x], params)
+
+    return [copy.deepcopy(g_parameter_files[x][1]) for x in filenames]
+
 
 if __name__ == "__main__":
     import sys, pprint
@@ -0,0 +1,254 @@
+# vim: set ts=4 sw=4 et :
+"""
+Converts density files from CSV to the binary format read by
+Sirca::Population (no wx needed)
+
+    python density_convert.py [--cellsize SIZE] densities.csv densities.sdb
+
+The CSV is read as read_data_file does: a header row (case and quotes
+ignored) then one group per row, split on commas, semicolons and
+whitespace.  It is streamed in chunks of rows, and each chunk is checked a
+column at a time: X, Y, DENSITY and any other columns must be numbers and
+STATE a whole number.  Rows with a density of zero or less are dropped
+(they usually denote nodata), and coordinates can be snapped to the nearest
+multiple of a cell size.
+
+The binary file (all little-endian) is:
+
+    'SIRCADNS'              magic
+    uint32                  format version (1)
+    uint32                  number of rows
+    uint32                  number of columns
+    per column:
+        char[16]            name, NUL padded
+        char                type, 'd' (float64) or 'l' (int32)
+    the rows, each the packed values of the columns in order
+
+The columns are X, Y, DENSITY and STATE, then the others in file order.
+Missing values are NaN, or -1 for STATE.
+"""
+
+import os
+import sys
+import struct
+import string
+import logging
+import optparse
+import itertools
+
+import numpy
+
+from event_io import to_float
+
+log = logging.getLogger('config.DensityConvert')
+
+MAGIC = 'SIRCADNS'
+VERSION = 1
+NAME_SIZE = 16
+
+CHUNK_ROWS = 100000
+
+# the errors reported when a file can't be converted
+MAX_ERRORS = 20
+
+FIXED_COLUMNS = [('X', '<f8'), ('Y', '<f8'), ('DENSITY', '<f8'), ('STATE', '<i4')]
+EXTRA_TYPE = '<f8'
+TYPE_CODES = { '<f8' : 'd', '<i4' : 'l' }
+NO_STATE = -1
+
+# read_data_file splits on any of these
+SEPARATORS = string.maketrans(' \t;', ',,,')
+
+
+class DensityConvertError(Exception):
+    pass
+
+
+def convert(csv_filename, out_filename, cellsize=None, origin=(0, 0), chunk_rows=CHUNK_ROWS):
+    """writes a CSV density file in the binary format.  Returns the number
+    of rows written.  Raises DensityConvertError if any are invalid (and
+    then no file is left)."""
+    f = open(csv_filename, 'rU')
+    try:
+        lines = (line.rstrip('\r\n') for line in f)
+        try:
+            header = read_header(lines.next())
+        except StopIteration:
+            raise DensityConvertError("%s is empty" % csv_filename)
+        check_header(header, csv_filename)
+        dtype = get_dtype(header)
+
+        out = open(out_filename, 'wb')
+        try:
+            write_header(out, dtype, 0)
+            (nrows, dropped, coords) = write_rows(out, lines, header, dtype,
+                                                  cellsize, origin, chunk_rows)
+            check_duplicates(coords)
+            # now the rows are counted
+            out.seek(0)
+            write_header(out, dtype, nrows)
+        finally:
+            out.close()
+    except DensityConvertError, value:
+        if os.path.exists(out_filename):
+            os.remove(out_filename)
+        raise DensityConvertError("%s: %s" % (csv_filename, value))
+    finally:
+        f.close()
+
+    log.info('wrote %d groups to %s (dropped %d with densities <= 0)',
+             nrows, out_filename, dropped)
+    return nrows
+
+def read_header(line):
+    line = line.replace('"', '').upper()
+    return [name.strip() for name in line.translate(SEPARATORS).split(',')]
+
+def check_header(header, filename):
+    for name in ('X', 'Y'):
+        if name not in header:
+            raise DensityConvertError("%s has no %s column" % (filename, name))
+    for name in header:
+        if len(name) > NAME_SIZE:
+            raise DensityConvertError("column name %s is longer than %d characters" % (name, NAME_SIZE))
+    names = [name for name in header if name]
+    if len(set(names)) != len(names):
+        raise DensityConvertError("%s has repeated column names" % filename)
+    if 'DENSITY' not in header:
+        log.warn('%s has no DENSITY column', filename)
+
+def get_dtype(header):
+    fixed = [name for (name, type) in FIXED_COLUMNS]
+    extras = [(name, EXTRA_TYPE) for name in header if name and name not in fixed]
+    return numpy.dtype(FIXED_COLUMNS + extras)
+
+def write_header(out, dtype, nrows):
+    out.write(MAGIC)
+    out.write(struct.pack('<III', VERSION, nrows, len(dtype.names)))
+    for name in dtype.names:
+        out.write(struct.pack('%ds' % NAME_SIZE, name))
+        out.write(TYPE_CODES[dtype[name].str])
+
+def write_rows(out, lines, header, dtype, cellsize, origin, chunk_rows):
+    """writes the rows of the CSV in chunks.  Returns (rows written,
+    rows dropped, [coordinates of the rows as X + iY])"""
+    nrows = dropped = 0
+    coords = []
+    first_line = 2
+    while True:
+        chunk = list(itertools.islice(lines, chunk_rows))
+        if not chunk:
+            break
+        (rows, line_numbers) = split_rows(chunk, first_line)
+        first_line += len(chunk)
+        if not rows:
+            continue
+
+        (records, errors) = get_records(rows, line_numbers, header, dtype)
+        if errors:
+            raise DensityConvertError("invalid rows:\n%s" % '\n'.join(errors))
+
+        keep = ~(records['DENSITY'] <= 0)  # NaN (no density) is kept
+        dropped += len(records) - keep.sum()
+        records = records[keep]
+        if cellsize:
+            records['X'] = snap(records['X'], cellsize, origin[0])
+            records['Y'] = snap(records['Y'], cellsize, origin[1])
+
+        records.tofile(out)
+        coords.append(records['X'] + 1j * records['Y'])
+        nrows += len(records)
+    return (nrows, dropped, coords)
+
+def split_rows(chunk, first_line):
+    """returns (rows as lists of fields, their line numbers), skipping
+    blank lines"""
+    rows = []
+    line_numbers = []
+    for (i, line) in enumerate(chunk):
+        if line:
+            rows.append(line.translate(SEPARATORS).split(','))
+            line_numbers.append(first_line + i)
+    return (rows, numpy.array(line_numbers))
+
+def get_records(rows, line_numbers, header, dtype):
+    """returns (structured array of the rows, error messages)"""
+    errors = []
+    def add_errors(bad, message):
+        for i in numpy.flatnonzero(bad)[:MAX_ERRORS]:
+            errors.append( (line_numbers[i], message) )
+
+    # short rows are padded, as read_data_file leaves their values undefined
+    ncols = len(header)
+    lengths = numpy.array([len(row) for row in rows])
+    add_errors(lengths > ncols, "more than %d columns" % ncols)
+    columns = numpy.char.strip(numpy.array([(row + [''] * ncols)[:ncols] for row in rows], dtype=str))
+
+    records = numpy.zeros(len(rows), dtype=dtype)
+    records['DENSITY'] = numpy.nan
+    records['STATE'] = NO_STATE
+    for (i, name) in enumerate(header):
+        if not name:
+            continue
+        values = columns[:, i]
+        given = values != ''
+        numbers = to_float(values, given)  # blanks are masked, not converted
+        if name in ('X', 'Y'):
+            add_errors(~given, "no %s" % name)
+        add_errors(given & numpy.isnan(numbers), "%s isn't a number" % name)
+        if name == 'STATE':
+            add_errors(given & (numbers != numpy.floor(numbers)) & ~numpy.isnan(numbers),
+                       "STATE isn't a whole number")
+            add_errors(given & (numbers < 0), "STATE is below 0")
+            numbers = numpy.where(given, numbers, NO_STATE)
+            numbers[numpy.isnan(numbers)] = NO_STATE
+        records[name] = numbers
+
+    errors.sort()
+    return (records, ["line %d: %s" % error for error in errors[:MAX_ERRORS]])
+
+def snap(values, cellsize, origin):
+    """values moved to the nearest multiple of cellsize from origin"""
+    return numpy.round((values - origin) / cellsize) * cellsize + origin
+
+def check_duplicates(coords):
+    """groups are identified by their coordinates, so they must be unique
+    (which snapping may have broken)"""
+    if not coords:
+        return
+    coords = numpy.concatenate(coords)
+    coords.sort()
+    repeated = numpy.unique(coords[1:][coords[1:] == coords[:-1]])
+    if len(repeated):
+        examples = ', '.join(['%r,%r' % (c.real, c.imag) for c in repeated[:MAX_ERRORS]])
+        raise DensityConvertError("%d coordinates are repeated: %s" % (len(repeated), examples))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] CSV_FILE OUT_FILE")
+    parser.add_option("--cellsize", type="float", default=None,
+                      help="snap coordinates to the nearest multiple of this")
+    parser.add_option("--origin", default="0,0",
+                      help="X,Y of a cell centre, when snapping (default: 0,0)")
+    (options, args) = parser.parse_args(argv)
+
+    if len(args) != 2:
+        parser.error("need a CSV file and an output file")
+    try:
+        origin = tuple([float(v) for v in options.origin.split(',')])
+    except ValueError:
+        origin = ()
+    if len(origin) != 2:
+        parser.error("--origin should be X,Y")
+
+    try:
+        convert(args[0], args[1], options.cellsize, origin)
+    except (DensityConvertError, IOError), value:
+        print >> sys.stderr, value
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,143 @@
+# vim: set ts=4 sw=4 et :
+"""
+Shape preserving downsampling of long series for plotting
+
+SeriesPyramid keeps min/max buckets of a series at successively halved
+resolutions (built on demand), so a view of any range can be produced
+with roughly a fixed number of points however long the series is.  The
+min and max of each bucket are both kept, in the order they occur, so
+peaks are never lost when zoomed out.
+
+lttb() (largest triangle three buckets) is also provided for smoother
+looking curves, at the cost of working on the raw values each time.
+"""
+
+import numpy
+
+# levels are not built below this many buckets
+MIN_LEVEL_BUCKETS = 256
+
+
+class SeriesPyramid:
+    """Cached min/max levels of a single series
+
+    level 0 is the raw series, level k has buckets of 2**k values, each
+    holding the position and value of its minimum and maximum.
+    """
+
+    def __init__(self, values):
+        self.values = numpy.asarray(values)
+        self.levels = [] # level k-1 -> (min_pos, min_val, max_pos, max_val)
+
+    def GetLength(self):
+        return len(self.values)
+
+    def __get_level(self, level):
+        while len(self.levels) < level:
+            if len(self.levels) == 0:
+                previous = self.__raw_level()
+            else:
+                previous = self.levels[-1]
+            self.levels.append(self.__halve(previous))
+        return self.levels[level - 1]
+
+    def __raw_level(self):
+        positions = numpy.arange(len(self.values))
+        return (positions, self.values, positions, self.values)
+
+    def __halve(self, level):
+        """combines each pair of buckets of a level into one"""
+        (min_pos, min_val, max_pos, max_val) = level
+        if len(min_pos) % 2:
+            # odd number of buckets - repeat the last one
+            (min_pos, min_val, max_pos, max_val) = [
+                numpy.concatenate((a, a[-1:])) for a in level]
+
+        # take the smaller of each pair of minimums
+        take_second = min_val[1::2] < min_val[0::2]
+        new_min_pos = numpy.where(take_second, min_pos[1::2], min_pos[0::2])
+        new_min_val = numpy.where(take_second, min_val[1::2], min_val[0::2])
+
+        # and the larger of the maximums
+        take_second = max_val[1::2] > max_val[0::2]
+        new_max_pos = numpy.where(take_second, max_pos[1::2], max_pos[0::2])
+        new_max_val = numpy.where(take_second, max_val[1::2], max_val[0::2])
+
+        return (new_min_pos, new_min_val, new_max_pos, new_max_val)
+
+    def GetView(self, start, stop, max_points):
+        """returns (x, y) covering values [start, stop) with at most about
+        max_points points.  The end points of the range are always included.
+        """
+        length = len(self.values)
+        start = max(0, int(start))
+        stop = min(length, int(stop) + 1)
+        if stop <= start:
+            return (numpy.zeros(0), numpy.zeros(0))
+
+        # each bucket contributes two points
+        level = 0
+        while ((stop - start) >> level) * 2 > max_points \
+                and (length >> level) > MIN_LEVEL_BUCKETS:
+            level += 1
+
+        if level == 0:
+            x = numpy.arange(start, stop)
+            return (x, self.values[start:stop])
+
+        (min_pos, min_val, max_pos, max_val) = self.__get_level(level)
+        first = start >> level
+        last = ((stop - 1) >> level) + 1
+        min_pos = min_pos[first:last]
+        max_pos = max_pos[first:last]
+
+        # interleave the minimums and maximums in the order they occur
+        positions = numpy.empty(2 * len(min_pos), dtype=min_pos.dtype)
+        min_first = min_pos <= max_pos
+        positions[0::2] = numpy.where(min_first, min_pos, max_pos)
+        positions[1::2] = numpy.where(min_first, max_pos, min_pos)
+
+        # make sure the line reaches both ends of the range
+        positions = numpy.concatenate(([start], positions, [stop - 1]))
+        positions = positions[(positions >= start) & (positions < stop)]
+
+        return (positions, self.values[positions])
+
+
+def lttb(x, y, threshold):
+    """Largest triangle three buckets downsampling of (x, y) to
+    threshold points.  Returns (x, y) unchanged if already short enough.
+    """
+    length = len(y)
+    if threshold >= length or threshold < 3:
+        return (x, y)
+
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+
+    # bucket boundaries, excluding the first and last points
+    edges = numpy.linspace(1, length - 1, threshold - 1).astype(int)
+
+    selected = numpy.zeros(threshold, dtype=int)
+    selected[-1] = length - 1
+    a = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], max(edges[i + 1], edges[i] + 1)
+
+        # average of the next bucket (or the last point)
+        if i + 2 < len(edges):
+            next_lo, next_hi = edges[i + 1], edges[i + 2]
+        else:
+            next_lo, next_hi = length - 1, length
+        next_hi = max(next_hi, next_lo + 1)
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+
+        # the point in this bucket making the largest triangle with the
+        # previously selected point and the next bucket's average
+        areas = numpy.abs((x[a] - avg_x) * (y[lo:hi] - y[a])
+                          - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(areas.argmax())
+        selected[i + 1] = a
+
+    return (x[selected], y[selected])
@@ -10,7 +10,7 @@ parameters for each type.
 import wx
 import wx.grid as gridlib
 import logging
-import copy
+import bisect
 
 #---------------------------------------------------------------------------
 
@@ -37,18 +37,23 @@ class EventsDataTable(gridlib.PyGridTableBase):
 
         #                  gridlib.GRID_VALUE_CHOICE + ':only in a million years!,wish list,minor,normal,major,critical',
 
-        self.rows = []      # rows[index] -> event
         self.events = []    # events ordered sequentially by time
+        self.row_starts = [0] # first row of each event, then the number of rows
         self.types = {}     # type name -> { parameter name -> default value }
         self.current_nrows = 0
+        self.change_callback = None # called after an event is edited
         
     #--------------------------------------------------
     # data access
 
     def GetEvents(self):
         """return copy of the list of events, sorted by time"""
-        # don't return 'new' psuedo-event
-        return copy.deepcopy(self.events[:-1])
+        # don't return 'new' psuedo-event.  The params are lists of
+        # tuples of strings, so only the lists need copying
+        return [dict(e, params=list(e['params'])) for e in self.events[:-1]]
+
+    def SetChangeCallback(self, callback):
+        self.change_callback = callback
 
     def __get_test_events(self):
         return [
@@ -80,7 +85,7 @@ class EventsDataTable(gridlib.PyGridTableBase):
         if 'new' in typenames:
             raise "'new' is special and not allowed as a type name"
         typenames.sort()
-        self.data_types[1] += ','.join(typenames)
+        self.data_types[1] = gridlib.GRID_VALUE_CHOICE + ':' + ','.join(typenames)
 
         # sort events
         self.events.sort( key = lambda e: e['time'] )
@@ -105,7 +110,7 @@ class EventsDataTable(gridlib.PyGridTableBase):
         self.__rebuild_event_rows()
 
         # add any rows
-        rows_added = len(self.rows) - self.current_nrows
+        rows_added = self.row_starts[-1] - self.current_nrows
         self.__signal_rows_changed(0, rows_added)
 
         # refresh
@@ -113,27 +118,36 @@ class EventsDataTable(gridlib.PyGridTableBase):
 
     def __rebuild_event_rows(self):
         """allocate and keep track of rows"""
-        self.rows = []
         for e in self.events:
             # set number of rows needed for each event ('nrows')
-            nrows = max(1, e['nparams'])
-            e['nrows'] = nrows
-
-            # set 'start_row'
-            e['start_row'] = len(self.rows)
+            e['nrows'] = max(1, e['nparams'])
+        self.__update_row_starts(0)
+
+    def __update_row_starts(self, first, last=None):
+        """recomputes where the rows of events first..last start, from
+        their 'nrows'.  If last is None, all the events from first are
+        done, otherwise the events after last must not have moved."""
+        starts = self.row_starts
+        if last is None:
+            del starts[first + 1:]
+            for i in range(first, len(self.events)):
+                starts.append(starts[i] + self.events[i]['nrows'])
+        else:
+            for i in range(first, last + 1):
+                starts[i + 1] = starts[i] + self.events[i]['nrows']
 
-            # initialise event reference for each row
-            for i in range(nrows):
-                self.rows.append(e)        
+    def __find_event(self, row):
+        """returns the index of the event with row"""
+        return bisect.bisect_right(self.row_starts, row) - 1
 
     def __append_new_event(self):
-        self.events.append( { 'time':None, 'type':'new', 'nparams':0, 'params':{} } )
+        self.events.append( { 'time':None, 'type':'new', 'nparams':0, 'nrows':1, 'params':{} } )
     
     #--------------------------------------------------
     # required methods for the wxPyGridTableBase interface
 
     def GetNumberRows(self):
-        nrows = len(self.rows)
+        nrows = self.row_starts[-1]
         self.log.debug('--> GetNumberRows: %d', nrows)
         self.current_nrows = nrows
         return nrows
@@ -147,14 +161,13 @@ class EventsDataTable(gridlib.PyGridTableBase):
         Validates coords and returns (event, event_row),
           where event_row is the given rows position for that event (eg: 0th row for this event)
         """
-        assert(row >= 0 and row < len(self.rows) )
+        assert(row >= 0 and row < self.row_starts[-1] )
         assert(col >= 0 and col < 4)
 
-        event = self.rows[row]
-        event_row = row - event['start_row']
-        assert(event_row >= 0)
+        index = self.__find_event(row)
+        event_row = row - self.row_starts[index]
         
-        return (event, event_row)
+        return (self.events[index], event_row)
 
     def IsEmptyCell(self, row, col):
         """
@@ -241,7 +254,8 @@ class EventsDataTable(gridlib.PyGridTableBase):
             event['time'] = new_time
 
             # insert event into its new position
-            self.events.remove(event)
+            old_index = self.__find_event(row)
+            self.events.pop(old_index)
             hi = len(self.events)
             lo = 0
             while lo < hi:
@@ -256,10 +270,10 @@ class EventsDataTable(gridlib.PyGridTableBase):
                     lo = mid + 1
             self.events.insert(lo, event)
             self.log.debug('event time changed to %d for %s', new_time, event)
-            self.log.debug('sorted event list: %s', self.events)
 
-            # re-allocate rows            
-            self.__rebuild_event_rows()
+            # re-allocate the rows of the events that moved (the
+            # rows of the others are unchanged)
+            self.__update_row_starts(min(old_index, lo), max(old_index, lo))
             self.__refresh()
 
 
@@ -301,12 +315,13 @@ class EventsDataTable(gridlib.PyGridTableBase):
                 self.__append_new_event()
                 new_row = 1
                 
-            # re-allocate rows            
-            self.__rebuild_event_rows()
+            # re-allocate the rows of this event and those after it
+            self.__update_row_starts(self.__find_event(row))
 
-            # tell grid that if we added/removed any rows
+            # tell grid that if we added/removed any rows (at the
+            # end of this event's rows)
             rows_added = new_nrows - cur_nrows + new_row
-            self.__signal_rows_changed(event_row, rows_added)
+            self.__signal_rows_changed(row - event_row + min(cur_nrows, new_nrows), rows_added)
 
             self.__refresh()
             
@@ -321,6 +336,9 @@ class EventsDataTable(gridlib.PyGridTableBase):
         else:
             assert(false) # col out-of-bounds
 
+        if self.change_callback is not None:
+            self.change_callback()
+
     def GetColLabelValue(self, col):
         """Called when the grid needs to display labels"""
         return self.col_labels[col]
@@ -361,13 +379,9 @@ class EventsDataTable(gridlib.PyGridTableBase):
 
 
     def __refresh(self):
-        self.log.debug('loading events: %s', self.events)
-        self.log.debug('          rows: %s', self.rows)
-        self.__tell_grid(gridlib.GRIDTABLE_REQUEST_VIEW_GET_VALUES)
-
-    def __refresh(self):
-        self.log.debug('loading events: %s', self.events)
-        self.log.debug('          rows: %s', self.rows)
+        # only the counts, as the lists can be very long
+        self.log.debug('refreshing %d events in %d rows',
+                       len(self.events), self.row_starts[-1])
         self.__tell_grid(gridlib.GRIDTABLE_REQUEST_VIEW_GET_VALUES)
 
     def __signal_rows_changed(self, pos, rows_added):
@@ -0,0 +1,294 @@
+# vim: set ts=4 sw=4 et :
+"""
+Bulk import and export of events (GLOBAL_EVENTS, GROUP_EVENTS) (no wx needed)
+
+Events are stored one per row, as CSV with a header row:
+
+    time,type,<parameter>,<parameter>,...
+
+or as the same columns in a numpy .npz file.  A parameter that isn't used
+by an event's type is left blank.  Files are read in chunks of rows, and
+each chunk is checked against the event types of the metadata (known
+type, known parameters, numbers in range) a column at a time.  Blank
+parameters get the type's default, except the group of group events.
+
+The events are in the format used by event_grid.EventsDataTable:
+    { 'time' : 40, 'type' : 'CULL', 'params' : {'fraction' : '0.5', ...} }
+(params may also be a list of (name, value) tuples when writing)
+"""
+
+import csv
+import logging
+import itertools
+
+import numpy
+
+log = logging.getLogger('config.EventIO')
+
+CHUNK_ROWS = 10000
+
+# the errors reported when a file can't be read
+MAX_ERRORS = 20
+
+NUMERIC_TYPES = ('integer', 'float')
+
+# parameters that must be given (events without them can't be run)
+REQUIRED_PARAMS = ('group',)
+
+
+class EventIOError(Exception):
+    pass
+
+
+class ParamSpec:
+    """a parameter of an event type (from a <field> of the metadata)"""
+    def __init__(self, field_node):
+        self.name = field_node.get('name')
+        self.type = field_node.get('type')
+        self.default = field_node.get('default') or ''
+        self.min = self.max = None
+        if field_node.get('min') is not None:
+            self.min = float(field_node.get('min'))
+        if field_node.get('max') is not None:
+            self.max = float(field_node.get('max'))
+
+def get_event_types(type_nodes):
+    """returns {type name -> [ParamSpec]} from the <type> nodes of an
+    eventstable field in the metadata"""
+    types = {}
+    for type_node in type_nodes:
+        types[type_node.get('name')] = [ParamSpec(f) for f in type_node]
+    return types
+
+
+# Reading
+
+def read_events(filename, event_types, chunk_rows=CHUNK_ROWS):
+    """returns the events in a .csv or .npz file, in file order.
+    Raises EventIOError if any are invalid."""
+    if filename.lower().endswith('.npz'):
+        chunks = iter_npz_chunks(filename, chunk_rows)
+    else:
+        chunks = iter_csv_chunks(filename, chunk_rows)
+
+    events = []
+    errors = []
+    for (first_line, columns) in chunks:
+        errors.extend(check_chunk(columns, first_line, event_types))
+        if len(errors) >= MAX_ERRORS:
+            break
+        if not errors:
+            events.extend(get_chunk_events(columns, event_types))
+
+    if errors:
+        raise EventIOError("%s has invalid events:\n%s" % (filename, '\n'.join(errors[:MAX_ERRORS])))
+    log.info('read %d events from %s', len(events), filename)
+    return events
+
+def iter_csv_chunks(filename, chunk_rows):
+    """yields (line number of first row, {column name -> array of strings})"""
+    f = open(filename, 'rb')
+    try:
+        reader = csv.reader(f)
+        try:
+            header = [name.strip() for name in reader.next()]
+        except StopIteration:
+            raise EventIOError("%s is empty" % filename)
+        check_header(header, filename)
+
+        first_line = 2
+        while True:
+            rows = list(itertools.islice(reader, chunk_rows))
+            if not rows:
+                return
+            # pad short rows (eg: trailing blank parameters left off)
+            ncols = len(header)
+            rows = [(row + [''] * ncols)[:ncols] for row in rows]
+            columns = numpy.char.strip(numpy.array(rows, dtype=str))
+            yield (first_line, dict(zip(header, columns.T)))
+            first_line += len(rows)
+    finally:
+        f.close()
+
+def iter_npz_chunks(filename, chunk_rows):
+    data = numpy.load(filename)
+    header = data.files
+    check_header(header, filename)
+
+    columns = dict([(name, data[name].astype(str)) for name in header])
+    nrows = len(columns['time'])
+    for start in range(0, nrows, chunk_rows):
+        # "lines" counted as for CSV, for the error messages
+        yield (start + 2, dict([(name, values[start:start + chunk_rows])
+                                for (name, values) in columns.iteritems()]))
+
+def check_header(header, filename):
+    for name in ('time', 'type'):
+        if name not in header:
+            raise EventIOError("%s has no %s column" % (filename, name))
+
+def check_chunk(columns, first_line, event_types):
+    """returns error messages for a chunk of events"""
+    errors = []
+    def add_errors(bad, message):
+        for i in numpy.flatnonzero(bad)[:MAX_ERRORS]:
+            errors.append( (first_line + i, message) )
+
+    times = to_float(columns['time'])
+    add_errors(~is_integer(times) | (times < 0), "time isn't a whole number >= 0")
+
+    types = columns['type']
+    add_errors(~numpy.in1d(types, event_types.keys()), "unknown event type")
+
+    # the rows of each type, found once
+    type_rows = {}
+    for type_name in event_types.keys():
+        rows = types == type_name
+        if rows.any():
+            type_rows[type_name] = rows
+
+    for (type_name, rows) in type_rows.iteritems():
+        for spec in event_types[type_name]:
+            if spec.name not in REQUIRED_PARAMS:
+                continue
+            values = columns.get(spec.name)
+            missing = rows if values is None else rows & (values == '')
+            add_errors(missing, "%s isn't given" % spec.name)
+
+    for (name, values) in columns.iteritems():
+        if name in ('time', 'type'):
+            continue
+        given = values != ''
+        numbers = None # converted when first needed, for all the types
+        for (type_name, of_type) in type_rows.iteritems():
+            rows = given & of_type
+            if not rows.any():
+                continue
+            spec = [s for s in event_types[type_name] if s.name == name]
+            if not spec:
+                add_errors(rows, "%s isn't a parameter of %s" % (name, type_name))
+                continue
+            spec = spec[0]
+            if spec.type not in NUMERIC_TYPES:
+                continue
+
+            if numbers is None:
+                numbers = to_float(values, given)
+            if spec.type == 'integer':
+                bad = rows & ~is_integer(numbers)
+            else:
+                bad = rows & numpy.isnan(numbers)
+            add_errors(bad, "%s isn't a%s number" % (name, spec.type == 'integer' and ' whole' or ''))
+
+            if spec.min is not None:
+                add_errors(rows & ~bad & (numbers < spec.min), "%s is below %g" % (name, spec.min))
+            if spec.max is not None:
+                add_errors(rows & ~bad & (numbers > spec.max), "%s is above %g" % (name, spec.max))
+
+    errors.sort()
+    return ["line %d: %s" % error for error in errors]
+
+def to_float(values, given=None):
+    """values (strings) as floats, with NaN for blanks and those that
+    aren't numbers.  given is values != '', if the caller has it."""
+    values = numpy.asarray(values)
+    # blanks are common (parameters of other event types), so they are
+    # masked rather than failing the conversion
+    if given is None:
+        given = values != ''
+    try:
+        return numpy.where(given, values, 'nan').astype(float)
+    except ValueError:
+        # only when some aren't numbers, so the slow way is fine
+        result = numpy.empty(len(values))
+        for i in range(len(values)):
+            try:
+                result[i] = float(values[i])
+            except ValueError:
+                result[i] = numpy.nan
+        return result
+
+def is_integer(numbers):
+    """takes the result of to_float"""
+    return ~numpy.isnan(numbers) & (numbers == numpy.floor(numbers))
+
+def get_chunk_events(columns, event_types):
+    """returns the events of a (checked) chunk, in row order"""
+    times = columns['time'].astype(float).astype(int).tolist()
+    types = columns['type']
+    nrows = len(times)
+
+    indexed = []
+    for (type_name, specs) in event_types.iteritems():
+        rows = numpy.flatnonzero(types == type_name)
+        if len(rows) == 0:
+            continue
+        names = [s.name for s in specs]
+        # each parameter's values for these rows, blanks getting the default
+        params = []
+        for spec in specs:
+            values = columns.get(spec.name)
+            if values is None:
+                params.append([spec.default] * len(rows))
+            else:
+                values = values[rows]
+                params.append(numpy.where(values == '', spec.default, values).tolist())
+
+        for (i, row) in enumerate(rows):
+            event = { 'time' : times[row], 'type' : type_name,
+                      'params' : dict(zip(names, [p[i] for p in params])) }
+            indexed.append( (row, event) )
+
+    indexed.sort()
+    assert len(indexed) == nrows
+    return [event for (row, event) in indexed]
+
+
+# Writing
+
+def write_events(filename, events):
+    """writes events to a .csv or .npz file"""
+    header = ['time', 'type'] + get_param_names(events)
+    if filename.lower().endswith('.npz'):
+        write_npz(filename, header, events)
+    else:
+        write_csv(filename, header, events)
+    log.info('wrote %d events to %s', len(events), filename)
+
+def get_param_names(events):
+    names = set()
+    for event in events:
+        names.update(dict(event['params']).keys())
+    # events loaded from a config have their type among the params
+    names.difference_update(['time', 'type'])
+    return sorted(names)
+
+def get_rows(header, events):
+    for event in events:
+        params = dict(event['params'])
+        yield [event['time'], event['type']] + [params.get(name, '') for name in header[2:]]
+
+def write_csv(filename, header, events):
+    f = open(filename, 'wb')
+    try:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        rows = get_rows(header, events)
+        while True:
+            chunk = list(itertools.islice(rows, CHUNK_ROWS))
+            if not chunk:
+                break
+            writer.writerows(chunk)
+    finally:
+        f.close()
+
+def write_npz(filename, header, events):
+    rows = list(get_rows(header, events))
+    columns = {}
+    for (i, name) in enumerate(header):
+        values = [row[i] for row in rows]
+        if name == 'time':
+            columns[name] = numpy.array(values, dtype=int)
+        else:
+            columns[name] = numpy.array([str(v) for v in values], dtype=str)
+    numpy.savez(filename, **columns)
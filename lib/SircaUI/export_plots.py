@@ -0,0 +1,218 @@
+# vim: set ts=4 sw=4 et :
+"""
+Headless export of the epicurve plots (no wx needed)
+
+Renders the stats of a simulation to PNG/SVG/PDF files using matplotlib's
+Agg backend, spread over a pool of worker processes.  Each worker builds
+the figure template once and only replaces the lines and title for each
+plot, which is most of the cost saved over drawing fresh figures.
+
+The stats can come from a YAML stats file (as returned by get_stats),
+or from a saved state (.scs) loaded into a SIRCA perl worker.
+
+usage: python export_plots.py [options] (--stats FILE | --state FILE)
+"""
+
+import os
+import sys
+import time
+import fnmatch
+import logging
+import optparse
+import multiprocessing
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+import numpy
+
+import sirca_get_stats
+
+log = logging.getLogger('export.plots')
+
+FORMATS = ('png', 'svg', 'pdf')
+
+# same order as matplotlib's default colour cycle (which the GUI uses)
+COLOURS = ('b', 'g', 'r', 'c', 'm', 'y', 'k')
+
+
+class FigureTemplate:
+    """Figure, canvas and axes set up once per worker and reused for
+    every plot it renders"""
+
+    def __init__(self, width=8.0, height=6.0, dpi=100):
+        self.dpi = dpi
+        self.figure = Figure(figsize=(width, height), dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot(111)
+        self.axes.set_xlabel('timestep')
+
+    def Render(self, title, ylabel, series, filenames):
+        """plots the series [(label, values)] and saves to each filename"""
+        axes = self.axes
+
+        # reset what the previous plot left behind
+        del axes.lines[:]
+        axes.legend_ = None
+
+        for i in range(len(series)):
+            (label, values) = series[i]
+            axes.plot(numpy.arange(len(values)), values, label=label,
+                      color=COLOURS[i % len(COLOURS)])
+
+        axes.set_title(title)
+        axes.set_ylabel(ylabel)
+        axes.relim()
+        axes.autoscale_view()
+        if len(series) > 1:
+            axes.legend(loc='best')
+
+        for filename in filenames:
+            self.canvas.print_figure(filename, dpi=self.dpi)
+
+
+# the template of a worker process (set up by init_worker)
+g_template = None
+
+def init_worker(template_args):
+    global g_template
+    g_template = FigureTemplate(**template_args)
+
+def render_job(job):
+    (title, ylabel, series, filenames) = job
+    g_template.Render(title, ylabel, series, filenames)
+    return len(filenames)
+
+
+def get_plot_jobs(stat_series, outdir, formats, per_series=False,
+                  stat_filter='*', model_filter='*', state_filter='*'):
+    """Returns the jobs (title, ylabel, series, filenames) for render_job.
+
+    stat_series is a list of (stat name, dimension info, store) as from
+    sirca_get_stats.StatExtractor.GetStatSeries.  There is one plot per
+    stat, or one per stat/model/state if per_series is set.  The filters
+    are shell style patterns.
+    """
+    jobs = []
+    for (stat_name, (model_indices, state_indices), store) in stat_series:
+        if not fnmatch.fnmatch(stat_name, stat_filter):
+            continue
+
+        series = []
+        for model in sorted(model_indices.keys()):
+            if not fnmatch.fnmatch(model, model_filter):
+                continue
+            for state in sorted(state_indices.keys()):
+                if not fnmatch.fnmatch(state, state_filter):
+                    continue
+                key = (model_indices[model], state_indices[state])
+                values = store.GetSeries(key)
+                # not needed again, so no point keeping it loaded
+                store.Evict(key)
+                series.append( ("%s_%s" % (model, state), values) )
+
+        if per_series:
+            for (label, values) in series:
+                name = "%s_%s" % (stat_name, label)
+                jobs.append( (name, stat_name, [(label, values)],
+                              get_filenames(outdir, name, formats)) )
+        elif len(series) > 0:
+            jobs.append( (stat_name, stat_name, series,
+                          get_filenames(outdir, stat_name, formats)) )
+    return jobs
+
+def get_filenames(outdir, name, formats):
+    return [os.path.join(outdir, "%s.%s" % (name, fmt)) for fmt in formats]
+
+
+def export_plots(jobs, processes=None, template_args={}):
+    """Renders the jobs across a pool of processes.
+    Returns the number of files written."""
+    if processes == 1:
+        # no pool needed (eg: for debugging)
+        init_worker(template_args)
+        return sum(map(render_job, jobs))
+
+    pool = multiprocessing.Pool(processes, init_worker, (template_args,))
+    try:
+        count = sum(pool.imap_unordered(render_job, jobs, chunksize=8))
+    finally:
+        pool.close()
+        pool.join()
+    return count
+
+
+def load_stats_file(filename):
+    return sirca_get_stats.StatExtractor(file=filename).GetStatSeries()
+
+def load_saved_state(filename):
+    """runs a SIRCA perl worker to get the stats of a saved state"""
+    import perl_interface
+    import perl_commands
+
+    sirca = perl_interface.SIRCAInstance()
+    try:
+        sirca.DoCommand(perl_commands.LoadFromSavedState(filename))
+        stats_command = perl_commands.GetStats()
+        sirca.DoCommand(stats_command)
+        return stats_command.GetStatSeries()
+    finally:
+        sirca.Close()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] (--stats FILE | --state FILE)")
+    parser.add_option("--stats", help="YAML stats file to plot")
+    parser.add_option("--state", help="saved state (.scs) to get the stats from")
+    parser.add_option("-o", "--outdir", default=".", help="directory for the plots")
+    parser.add_option("-f", "--format", default="png",
+                      help="comma separated output formats (%s)" % ",".join(FORMATS))
+    parser.add_option("--per-series", action="store_true", default=False,
+                      help="one plot per stat/model/state rather than per stat")
+    parser.add_option("--stat", default="*", help="only plot stats matching this pattern")
+    parser.add_option("--model", default="*", help="only plot models matching this pattern")
+    parser.add_option("--state-filter", default="*", help="only plot states matching this pattern (eg: s2)")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="number of worker processes (default: one per CPU)")
+    parser.add_option("--dpi", type="int", default=100)
+    parser.add_option("--size", default="8x6", help="figure size in inches (WxH)")
+    (options, args) = parser.parse_args(argv)
+
+    formats = options.format.split(',')
+    for fmt in formats:
+        if fmt not in FORMATS:
+            parser.error("unsupported format: %s" % fmt)
+
+    if options.stats is not None:
+        stat_series = load_stats_file(options.stats)
+    elif options.state is not None:
+        stat_series = load_saved_state(options.state)
+    else:
+        parser.error("need either --stats or --state")
+    log.info("loaded %d stats", len(stat_series))
+
+    (width, height) = [float(x) for x in options.size.split('x')]
+    template_args = { 'width' : width, 'height' : height, 'dpi' : options.dpi }
+
+    if not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    jobs = get_plot_jobs(stat_series, options.outdir, formats,
+                         per_series=options.per_series,
+                         stat_filter=options.stat,
+                         model_filter=options.model,
+                         state_filter=options.state_filter)
+
+    start = time.time()
+    count = export_plots(jobs, options.processes, template_args)
+    taken = time.time() - start
+    print "wrote %d files for %d plots in %.2f seconds (%.1f plots/second)" % (
+        count, len(jobs), taken, len(jobs) / max(taken, 1e-6))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
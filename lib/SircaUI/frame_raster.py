@@ -0,0 +1,209 @@
+# vim: set ts=4 sw=4 et :
+"""
+Rebuilds map frames from the stored group events of a run (no wx needed)
+
+The groups of a model are mapped to the cells of a raster of any cell
+size.  Each frame is a pair of uint8 rasters: the rank of the top state
+in each cell (see STATE_COLOURS) and the highest density in it.  Rather
+than rasterizing every group for every timestep, the changes of each
+timestep are turned into a diff (the cells whose values changed, and
+their new values) that is applied to the previous frame.  Full copies
+are kept every keyframe_interval timesteps so that any frame can be had
+without replaying from the start.
+"""
+
+import numpy
+
+from map_data import add_by_index
+
+DEFAULT_KEYFRAME_INTERVAL = 32
+
+# as Sirca::Population::to_image.  Later states are drawn on top, so their
+# position in this list is also their rank when cells are combined
+STATE_COLOURS = [
+    (3, (0, 255, 255)),
+    (2, (255, 0, 0)),
+    (1, (255, 255, 0)),
+]
+
+# rank -> colour (rank 0 is no state, so the density is shown)
+RANK_LUT = numpy.array([(0, 0, 0)] + [c for (s, c) in STATE_COLOURS], dtype=numpy.uint8)
+
+# state -> rank
+STATE_RANKS = numpy.zeros(max([s for (s, c) in STATE_COLOURS]) + 1, dtype=numpy.uint8)
+for i in range(len(STATE_COLOURS)):
+    STATE_RANKS[STATE_COLOURS[i][0]] = i + 1
+
+# density raster value -> grey (0 is no group, 1-255 is density 0-100%)
+DENSITY_LUT = numpy.empty((256, 3), dtype=numpy.uint8)
+DENSITY_LUT[0] = 255
+DENSITY_LUT[1:] = (255 - numpy.arange(255) * 255 / 254)[:, numpy.newaxis]
+
+
+def to_rgb(rank, density):
+    """returns the RGB pixels (rows, cols, 3) for rank and density rasters"""
+    rgb = DENSITY_LUT[density]
+    coloured = rank > 0
+    rgb[coloured] = RANK_LUT[rank[coloured]]
+    return rgb
+
+def get_ranks(states):
+    """the rank of each state (0 for states that aren't drawn)"""
+    ranks = numpy.zeros(len(states), dtype=numpy.uint8)
+    drawn = (states >= 0) & (states < len(STATE_RANKS))
+    ranks[drawn] = STATE_RANKS[states[drawn]]
+    return ranks
+
+def get_density_values(density_pct):
+    """density raster values for densities as percentages (0-1)"""
+    return (density_pct * 254).astype(numpy.uint8) + 1
+
+def max_by_index(count, indices, values):
+    """result[i] is the largest of values[indices == i] (or 0)"""
+    result = numpy.zeros(count, dtype=values.dtype)
+    # assigned in ascending order, so the largest is written last
+    order = values.argsort(kind='mergesort')
+    result[indices[order]] = values[order]
+    return result
+
+
+class GroupRaster:
+    """Maps groups to the cells of a raster"""
+
+    def __init__(self, x, y, cellsize):
+        if len(x) == 0:
+            x = y = numpy.zeros(1)
+        self.cellsize = cellsize
+        self.min_x = x.min()
+        self.max_y = y.max()
+
+        cols = ((x - self.min_x) / cellsize).astype(numpy.int32)
+        rows = ((self.max_y - y) / cellsize).astype(numpy.int32)
+        self.shape = (rows.max() + 1, cols.max() + 1)
+        self.cells = rows * self.shape[1] + cols
+
+        # groups ordered by cell, for finding the groups in given cells
+        self.order = self.cells.argsort(kind='mergesort')
+        self.sorted_cells = self.cells[self.order]
+
+    def GetCellCount(self):
+        return self.shape[0] * self.shape[1]
+
+    def Rasterize(self, ranks, density_values):
+        """returns (rank raster, density raster) for values by group"""
+        count = self.GetCellCount()
+        rank = max_by_index(count, self.cells, ranks)
+        density = max_by_index(count, self.cells, density_values)
+        return (rank.reshape(self.shape), density.reshape(self.shape))
+
+    def GetGroupsInCells(self, cells):
+        """returns (groups, position) for all the groups in the (unique)
+        cells, where position is the index of each group's cell in cells"""
+        starts = self.sorted_cells.searchsorted(cells, side='left')
+        lengths = self.sorted_cells.searchsorted(cells, side='right') - starts
+        total = lengths.sum()
+        position = numpy.arange(len(cells)).repeat(lengths)
+        # start of each group's run, plus its offset within the run
+        offsets = numpy.arange(total) - (lengths.cumsum() - lengths).repeat(lengths)
+        return (self.order[starts.repeat(lengths) + offsets], position)
+
+
+class FrameRasterizer:
+    """Frames for each timestep of a map_data.MapData"""
+
+    def __init__(self, map_data, cellsize=None, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        if cellsize is None:
+            cellsize = map_data.cellsize
+        self.map_data = map_data
+        self.raster = GroupRaster(map_data.x, map_data.y, cellsize)
+        self.keyframe_interval = keyframe_interval
+
+        # before any events (ie: the master model's groups)
+        self.base_states = map_data.initial_states.copy()
+        self.base_density = map_data.density.copy()
+
+        self.diffs = None       # timestep -> (cells, rank, density)
+        self.keyframes = None   # timestep -> (rank, density) flat rasters
+
+    def GetShape(self):
+        return self.raster.shape
+
+    def GetIterations(self):
+        return self.map_data.iterations
+
+    def GetFrame(self, timestep):
+        """returns (rank, density) rasters for timestep"""
+        self.__build_diffs()
+        keyframe = timestep - timestep % self.keyframe_interval
+        (rank, density) = [r.copy() for r in self.keyframes[keyframe]]
+        for t in range(keyframe + 1, timestep + 1):
+            self.__apply(self.diffs[t], rank, density)
+        return (rank.reshape(self.raster.shape), density.reshape(self.raster.shape))
+
+    def IterFrames(self, start=0, stop=None):
+        """yields (timestep, rank, density) for timesteps start..stop,
+        applying each diff to the previous frame.  The rasters yielded
+        are updated in place, so copy them if they need to be kept."""
+        if stop is None:
+            stop = self.map_data.iterations
+        (rank, density) = self.GetFrame(start)
+        yield (start, rank, density)
+        for t in range(start + 1, stop + 1):
+            self.__apply(self.diffs[t], rank.reshape(-1), density.reshape(-1))
+            yield (t, rank, density)
+
+    def __apply(self, diff, rank, density):
+        (cells, diff_rank, diff_density) = diff
+        rank[cells] = diff_rank
+        density[cells] = diff_density
+
+    def __build_diffs(self):
+        """replays the events once, recording the diff of each timestep"""
+        if self.diffs is not None:
+            return
+
+        map_data = self.map_data
+        raster = self.raster
+        states = self.base_states.copy()
+        density = self.base_density.copy()
+        ranks = get_ranks(states)
+        density_values = get_density_values(map_data.GetDensityPct(density))
+
+        (rank_raster, density_raster) = [r.reshape(-1) for r in
+                                         raster.Rasterize(ranks, density_values)]
+
+        state_bounds = map_data.state_times.searchsorted(numpy.arange(map_data.iterations + 2))
+        dens_bounds = map_data.dens_times.searchsorted(numpy.arange(map_data.iterations + 2))
+
+        self.diffs = []
+        self.keyframes = {}
+        for t in range(map_data.iterations + 1):
+            (s_lo, s_hi) = state_bounds[t:t + 2]
+            (d_lo, d_hi) = dens_bounds[t:t + 2]
+
+            # apply this timestep's events to the groups
+            state_groups = map_data.state_groups[s_lo:s_hi]
+            states[state_groups] = map_data.state_values[s_lo:s_hi]
+            dens_groups = map_data.dens_groups[d_lo:d_hi]
+            (dens_changed, position) = numpy.unique(dens_groups, return_inverse=True)
+            bodycounts = add_by_index(numpy.zeros(len(dens_changed)), position,
+                                      map_data.dens_bodycounts[d_lo:d_hi])
+            density[dens_changed] = numpy.maximum(density[dens_changed] - bodycounts, 0)
+
+            changed = numpy.unique(numpy.concatenate((state_groups, dens_groups)))
+            ranks[changed] = get_ranks(states[changed])
+            density_values[changed] = get_density_values(
+                map_data.GetDensityPct(density[changed]))
+
+            # recalculate the cells of the changed groups (from all
+            # the groups in them)
+            cells = numpy.unique(raster.cells[changed])
+            (members, position) = raster.GetGroupsInCells(cells)
+            diff = (cells,
+                    max_by_index(len(cells), position, ranks[members]),
+                    max_by_index(len(cells), position, density_values[members]))
+            self.diffs.append(diff)
+
+            self.__apply(diff, rank_raster, density_raster)
+            if t % self.keyframe_interval == 0:
+                self.keyframes[t] = (rank_raster.copy(), density_raster.copy())
@@ -11,9 +11,10 @@ import sys
 from datetime import datetime
 
 import logging
-from lxml import etree
 
 import config
+import workspace
+import metadata_index
 import outputs, stat_outputs
 import perl_commands_for_gui as commands
 
@@ -101,6 +102,16 @@ class MainFrame(wx.Frame):
         self.config = wx.Config('Sirca', 'UNSW')
         self.fileHistory.Load(self.config)
 
+        # edit menu (changes to the loaded control file)
+        edit_menu = wx.Menu()
+        self.edit_undo = edit_menu.Append(-1, "&Undo\tCtrl+Z", "Undo the last change to the control file")
+        self.edit_redo = edit_menu.Append(-1, "&Redo\tCtrl+Y", "Redo the last change undone")
+
+        self.Bind(wx.EVT_MENU, self.OnUndo, self.edit_undo)
+        self.Bind(wx.EVT_MENU, self.OnRedo, self.edit_redo)
+        self.Bind(wx.EVT_UPDATE_UI, self.OnUpdateEditMenu, self.edit_undo)
+        self.Bind(wx.EVT_UPDATE_UI, self.OnUpdateEditMenu, self.edit_redo)
+
         # simulation menu
         sim_menu = wx.Menu()
         self.sim_run = sim_menu.Append(-1, "&Run simulation\tCtrl+R","Run SIRCA simulation using the loaded control file")
@@ -115,6 +126,7 @@ class MainFrame(wx.Frame):
         # menu bar
         menuBar = wx.MenuBar()
         menuBar.Append(filemenu,"&File")
+        menuBar.Append(edit_menu,"&Edit")
         menuBar.Append(sim_menu,"&Simulation")
         self.SetMenuBar(menuBar)
 
@@ -181,7 +193,8 @@ class MainFrame(wx.Frame):
         self._mgr.AddPane(self.workspace, wx.aui.AuiPaneInfo().
                           Name("workspace").Caption("Workspace").
                           CenterPane())
-        self.open_panels = {}
+        self.panel_manager = workspace.PanelManager(self.workspace,
+            self.config.ReadInt('WorkspacePanelLimit', workspace.DEFAULT_PANEL_LIMIT))
         self.Bind(wx.aui.EVT_AUINOTEBOOK_PAGE_CLOSE,
                 self.OnWorkspacePageClose, self.workspace)
         self.Bind(wx.aui.EVT_AUINOTEBOOK_PAGE_CHANGED,
@@ -217,19 +230,18 @@ class MainFrame(wx.Frame):
         Tries to show an existing object
         Returns whether successful
         """
-        try:
-            panel = self.open_panels[id(key)]
-            self._ActivateWorkPanel(panel)
-            return True
-        except KeyError:
+        panel = self.panel_manager.GetPanel(key)
+        if panel is None:
             return False
+        self._ActivateWorkPanel(panel)
+        return True
 
     def ShowPanel(self, panel, key):
         """
         Shows a panel on the central notebook (tab control)
         """
-        self.open_panels[id(key)] = panel
         self._ActivateWorkPanel(panel)
+        self.panel_manager.AddPanel(panel, key)
 
     def _ActivateWorkPanel(self, panel):
         # try to get ID (if panel is in the workspace already)
@@ -241,8 +253,7 @@ class MainFrame(wx.Frame):
             
     def OnWorkspacePageClose(self, event):
         closing_page = self.workspace.GetPage(event.Selection)
-        closing_key = closing_page.GetKey()
-        self.open_panels.pop(id(closing_key))
+        self.panel_manager.Closed(closing_page)
 
     def OnWorkspacePageChange(self, event):
         old_sel = event.OldSelection
@@ -252,6 +263,7 @@ class MainFrame(wx.Frame):
 
         new_page = self.workspace.GetPage(event.Selection)
         new_page.OnActivate()
+        self.panel_manager.Activated(new_page)
 
     #
     # Running
@@ -265,9 +277,18 @@ class MainFrame(wx.Frame):
         self.output.AppendText("\n---------------------------")
         self.output.AppendText("\nStarting simulation at %s using %s\n\n" % (time_str, "perl"))
 
-        # start simulating, creating a new landscape with our current parameters
+        # the config only needs rebuilding where it was edited
+        params = self.control_file.GetConfigDict()
+        changes = self.control_file.SetSubmitted(params)
+        if changes is not None:
+            self.output.AppendText("Changed since the last run: %s\n\n" % (', '.join(changes) or 'nothing'))
+
+        # start simulating, updating the landscape with our current parameters
         #  will get an event when finished
-        self.simulation_command = commands.AsyncSimulate(self, new_params = self.control_file.GetConfigDict())
+        #  the epicurves are shown (and updated) while it runs
+        self.outputPanel.StartLiveUpdates()
+        self.simulation_command = commands.AsyncSimulate(self,
+                new_params = params, live_stats = True)
         self.sirca_instance.StartCommand(self.simulation_command)
         self.UpdateSimulationUI()
         
@@ -275,6 +296,9 @@ class MainFrame(wx.Frame):
         """handles one of the events in simulation.py, eg: SimulationFinishedEvent"""
         evt.update_ui(self)
 
+    def OnStatsUpdate(self, update):
+        self.outputPanel.UpdateLiveStats(update)
+
     def OnSimulationFinished(self):
 
         # update log
@@ -341,7 +365,7 @@ class MainFrame(wx.Frame):
     #
     def SaveConfig(self):
         """Saving config into an existing file"""
-        self.control_file.SaveAsPerl(filename=self.save_filename, sirca_instance=self.sirca_instance)
+        self.control_file.SaveAsPerl(filename=self.save_filename)
         
     def OnSaveConfigAs(self, event):
         dlg = wx.FileDialog(
@@ -388,10 +412,10 @@ class MainFrame(wx.Frame):
 
         # find metadata xml file
         metadata_filename =os.path.join(SIRCADIR, 'lib', 'SircaUI', 'metadata', 'metadata.xml')
-        metadata_tree = etree.parse(metadata_filename)
+        metadata = metadata_index.get_metadata_index(metadata_filename)
 
         # load control file into our configuration-model objects
-        self.control_file = config.ControlFile(loader=loader, metadata=metadata_tree)
+        self.control_file = config.ControlFile(loader=loader, metadata=metadata)
 
         # load config data into the GUI view
         view = config.GUIConfigView(self)
@@ -427,6 +451,24 @@ class MainFrame(wx.Frame):
         self.LoadConfigFromFile(filename)
     
 
+    #
+    # Undo & redo of config changes
+    #
+    def OnUndo(self, event):
+        self.control_file.Undo()
+
+    def OnRedo(self, event):
+        self.control_file.Redo()
+
+    def OnUpdateEditMenu(self, event):
+        enable = False
+        if self.control_file is not None:
+            if event.GetId() == self.edit_undo.GetId():
+                enable = self.control_file.CanUndo()
+            else:
+                enable = self.control_file.CanRedo()
+        event.Enable(enable)
+
     #
     # MISC
     #
@@ -466,6 +508,7 @@ class MainFrame(wx.Frame):
 
             # save file history
             self.fileHistory.Save(self.config)
+            self.config.WriteInt('WorkspacePanelLimit', self.panel_manager.limit)
 
             # A little extra cleanup is required for the FileHistory control
             del self.fileHistory
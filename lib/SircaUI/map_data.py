@@ -0,0 +1,58 @@
+# vim: set ts=4 sw=4 et :
+"""
+The groups of a model and the state/density changes of one of its
+repetitions, as returned by the get_map_data job, as numpy arrays
+"""
+
+import base64
+import numpy
+
+
+def unpack_array(packed, dtype):
+    """decodes an array packed by sirca_jobs.pm's pack_array"""
+    if not packed:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.fromstring(base64.b64decode(packed), dtype=dtype)
+
+def add_by_index(counts, indices, weights):
+    """counts[indices] += weights, accumulating repeated indices"""
+    summed = numpy.bincount(indices, weights=weights)
+    counts[:len(summed)] += summed
+    return counts
+
+
+class MapData:
+    """Coordinates, densities and states of the groups of a model
+    (arrays indexed by group) and the changes to them by timestep"""
+
+    def __init__(self, result):
+        self.label = result['label']
+        self.iterations = int(result['iterations'])
+        self.cellsize = float(result['cellsize'])
+        self.default_state = int(result['default_state'])
+        self.density_params = [float(p) for p in result['density_params']]
+
+        self.x = unpack_array(result['x'], '<f8')
+        self.y = unpack_array(result['y'], '<f8')
+        self.density = unpack_array(result['density'], '<f8')
+        self.initial_states = unpack_array(result['states'], '<i4')
+
+        # sorted by time (and in the order they were applied)
+        self.state_times = unpack_array(result['state_times'], '<i4')
+        self.state_groups = unpack_array(result['state_groups'], '<i4')
+        self.state_values = unpack_array(result['state_values'], '<i4')
+
+        self.dens_times = unpack_array(result['dens_times'], '<i4')
+        self.dens_groups = unpack_array(result['dens_groups'], '<i4')
+        self.dens_bodycounts = unpack_array(result['dens_bodycounts'], '<f8')
+
+    def GetGroupCount(self):
+        return len(self.x)
+
+    def GetDensityPct(self, density):
+        """as Sirca::Population::convert_dens_to_pct, but for a whole array"""
+        (low, high) = self.density_params[:2]
+        pct = (density - low) / high
+        pct[density < low] = 0
+        pct[density > high] = 1
+        return pct
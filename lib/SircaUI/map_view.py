@@ -0,0 +1,332 @@
+# vim: set ts=4 sw=4 et :
+"""
+Map viewer for the groups of a model, showing their states (over their
+densities) at each timestep of a repetition
+
+Each frame is rebuilt from the stored group events by
+frame_raster.FrameRasterizer (one cell per IMAGE_CELLSIZE, as
+Sirca::Population::to_image does) and kept as a pyramid of halved
+resolutions, which is cut into tiles for display.  Coarse levels keep
+the top state and highest density of each block, so that isolated
+groups don't disappear when zoomed out.  Frames near the one being shown
+are built in a background thread, so that scrubbing through the
+timesteps doesn't have to wait for them.
+"""
+
+import threading
+import Queue
+import logging
+from collections import OrderedDict
+
+import numpy
+import wx
+
+import main
+import workspace
+import perl_commands
+import frame_raster
+
+TILE_SIZE = 256          # pixels
+FRAME_CACHE_SIZE = 8     # frames (pyramids) kept in memory
+TILE_CACHE_SIZE = 256    # bitmaps kept in memory
+PREFETCH_RADIUS = 3      # timesteps either side of the current one
+MAX_MAGNIFY = 16         # screen pixels per cell when zoomed all the way in
+
+class TilePyramid:
+    """The rasters of a frame at successively halved resolutions"""
+
+    def __init__(self, rank, density):
+        self.levels = [(rank, density)]
+        self.lock = threading.Lock() # levels are built from two threads
+
+    def GetLevel(self, level):
+        self.lock.acquire()
+        try:
+            while len(self.levels) <= level:
+                self.levels.append(self.__halve(*self.levels[-1]))
+            return self.levels[level]
+        finally:
+            self.lock.release()
+
+    def GetShape(self, level):
+        return self.GetLevel(level)[0].shape
+
+    def __halve(self, rank, density):
+        """each 2x2 block becomes the top state and highest density in it"""
+        (rows, cols) = rank.shape
+        (rows2, cols2) = ((rows + 1) // 2, (cols + 1) // 2)
+        halved = []
+        for raster in (rank, density):
+            padded = numpy.zeros((rows2 * 2, cols2 * 2), dtype=raster.dtype)
+            padded[:rows, :cols] = raster
+            halved.append(padded.reshape(rows2, 2, cols2, 2).max(axis=3).max(axis=1))
+        return tuple(halved)
+
+    def GetTile(self, level, tx, ty, magnify=1):
+        """returns the RGB pixels (rows, cols, 3) of a tile.  The tile covers
+        TILE_SIZE / magnify cells of the level in each direction, and may
+        be smaller at the edges of the raster."""
+        (rank, density) = self.GetLevel(level)
+        cells = TILE_SIZE // magnify
+        rank = rank[ty * cells:(ty + 1) * cells, tx * cells:(tx + 1) * cells]
+        density = density[ty * cells:(ty + 1) * cells, tx * cells:(tx + 1) * cells]
+
+        rgb = frame_raster.to_rgb(rank, density)
+
+        if magnify > 1:
+            rgb = rgb.repeat(magnify, axis=0).repeat(magnify, axis=1)
+        return rgb
+
+
+class FrameSource:
+    """Builds and caches the TilePyramid of each timestep.  The frames
+    around the one being viewed are prefetched in a background thread."""
+    log = logging.getLogger('map.FrameSource')
+
+    def __init__(self, map_data):
+        self.rasterizer = frame_raster.FrameRasterizer(map_data)
+        self.build_lock = threading.Lock() # the rasterizer isn't thread safe
+
+        self.frames = OrderedDict() # timestep -> TilePyramid (LRU order)
+        self.lock = threading.Lock()
+        self.requests = Queue.Queue()
+
+        self.thread = threading.Thread(target=self.__prefetch, name='MapPrefetch')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def Close(self):
+        self.requests.put( (None, None) )
+
+    def GetIterations(self):
+        return self.rasterizer.GetIterations()
+
+    def GetFrame(self, timestep):
+        frame = self.__get_cached(timestep)
+        if frame is None:
+            frame = self.__build(timestep)
+        return frame
+
+    def Prefetch(self, timestep, level):
+        """queues the neighbours of timestep (nearest first), replacing any
+        that were queued for a previous timestep"""
+        try:
+            while True:
+                self.requests.get_nowait()
+        except Queue.Empty:
+            pass
+
+        for offset in range(1, PREFETCH_RADIUS + 1):
+            for t in (timestep + offset, timestep - offset):
+                if 0 <= t <= self.rasterizer.GetIterations():
+                    self.requests.put( (t, level) )
+
+    def __get_cached(self, timestep):
+        self.lock.acquire()
+        try:
+            frame = self.frames.pop(timestep, None)
+            if frame is not None:
+                self.frames[timestep] = frame # now the most recently used
+            return frame
+        finally:
+            self.lock.release()
+
+    def __build(self, timestep):
+        self.build_lock.acquire()
+        try:
+            frame = TilePyramid(*self.rasterizer.GetFrame(timestep))
+        finally:
+            self.build_lock.release()
+
+        self.lock.acquire()
+        try:
+            self.frames[timestep] = frame
+            while len(self.frames) > FRAME_CACHE_SIZE:
+                self.frames.popitem(last=False)
+        finally:
+            self.lock.release()
+        return frame
+
+    def __prefetch(self):
+        while True:
+            (timestep, level) = self.requests.get()
+            if timestep is None:
+                return # closed
+            frame = self.__get_cached(timestep)
+            if frame is None:
+                self.log.debug('prefetching timestep %d', timestep)
+                frame = self.__build(timestep)
+            # the level being viewed is the one that will be needed
+            frame.GetLevel(level)
+
+
+class MapCanvas(wx.Window):
+    """Draws the tiles of a frame, with dragging to pan and the mouse
+    wheel to zoom"""
+
+    def __init__(self, parent, source):
+        wx.Window.__init__(self, parent, -1, style=wx.NO_FULL_REPAINT_ON_RESIZE)
+        self.source = source
+        self.timestep = 0
+        self.zoom = 0           # pyramid level, or negative to magnify level 0
+        self.offset = (0, 0)    # screen position of the raster's top left
+        self.drag_start = None
+        self.tiles = OrderedDict() # (timestep, zoom, tx, ty) -> wx.Bitmap
+
+        self.SetBackgroundStyle(wx.BG_STYLE_CUSTOM)
+        self.Bind(wx.EVT_PAINT, self.OnPaint)
+        self.Bind(wx.EVT_LEFT_DOWN, self.OnLeftDown)
+        self.Bind(wx.EVT_LEFT_UP, self.OnLeftUp)
+        self.Bind(wx.EVT_MOTION, self.OnMotion)
+        self.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheel)
+
+    def SetSource(self, source):
+        self.source = source
+        self.tiles.clear()
+        self.SetTimestep(min(self.timestep, source.GetIterations()))
+
+    def SetTimestep(self, timestep):
+        self.timestep = timestep
+        self.Refresh(False)
+        self.source.Prefetch(timestep, self.GetLevel())
+
+    def GetLevel(self):
+        return max(self.zoom, 0)
+
+    def GetMagnify(self):
+        return 2 ** max(-self.zoom, 0)
+
+    def OnPaint(self, event):
+        dc = wx.BufferedPaintDC(self)
+        dc.SetBackground(wx.WHITE_BRUSH)
+        dc.Clear()
+
+        frame = self.source.GetFrame(self.timestep)
+        level = self.GetLevel()
+        magnify = self.GetMagnify()
+        (rows, cols) = frame.GetShape(level)
+        cells = TILE_SIZE // magnify
+
+        # only the tiles that are on screen
+        (width, height) = self.GetClientSizeTuple()
+        (ox, oy) = self.offset
+        tx_first = max(0, -ox // TILE_SIZE)
+        ty_first = max(0, -oy // TILE_SIZE)
+        tx_last = min((cols - 1) // cells, (width - ox) // TILE_SIZE)
+        ty_last = min((rows - 1) // cells, (height - oy) // TILE_SIZE)
+
+        for ty in range(ty_first, ty_last + 1):
+            for tx in range(tx_first, tx_last + 1):
+                bitmap = self.GetTileBitmap(frame, level, magnify, tx, ty)
+                dc.DrawBitmap(bitmap, ox + tx * TILE_SIZE, oy + ty * TILE_SIZE)
+
+    def GetTileBitmap(self, frame, level, magnify, tx, ty):
+        key = (self.timestep, self.zoom, tx, ty)
+        bitmap = self.tiles.pop(key, None)
+        if bitmap is None:
+            rgb = frame.GetTile(level, tx, ty, magnify)
+            (rows, cols) = rgb.shape[:2]
+            bitmap = wx.BitmapFromBuffer(cols, rows, numpy.ascontiguousarray(rgb).tostring())
+            while len(self.tiles) >= TILE_CACHE_SIZE:
+                self.tiles.popitem(last=False)
+        self.tiles[key] = bitmap
+        return bitmap
+
+    def OnLeftDown(self, event):
+        self.drag_start = (event.GetPosition(), self.offset)
+        self.CaptureMouse()
+
+    def OnLeftUp(self, event):
+        if self.drag_start is not None:
+            self.drag_start = None
+            self.ReleaseMouse()
+
+    def OnMotion(self, event):
+        if self.drag_start is None or not event.Dragging():
+            return
+        (start, offset) = self.drag_start
+        position = event.GetPosition()
+        self.offset = (offset[0] + position.x - start.x, offset[1] + position.y - start.y)
+        self.Refresh(False)
+
+    def OnMouseWheel(self, event):
+        if event.GetWheelRotation() > 0:
+            new_zoom = self.zoom - 1 # in
+        else:
+            new_zoom = self.zoom + 1 # out
+        frame = self.source.GetFrame(self.timestep)
+        if 2 ** -new_zoom > MAX_MAGNIFY or \
+                (new_zoom > 0 and max(frame.GetShape(self.GetLevel())) <= 1):
+            return
+
+        # keep the point under the mouse where it is
+        scale = 2.0 ** (self.zoom - new_zoom)
+        position = event.GetPosition()
+        (ox, oy) = self.offset
+        self.offset = (int(position.x - (position.x - ox) * scale),
+                       int(position.y - (position.y - oy) * scale))
+        self.zoom = new_zoom
+        self.Refresh(False)
+        self.source.Prefetch(self.timestep, self.GetLevel())
+
+
+class MapPanel(wx.Panel, workspace.WorkspacePanel):
+    """Map of a model with a timestep scrubber, shown in the main workspace"""
+
+    def __init__(self, parent, key, model, map_data, repetitions=1):
+        wx.Panel.__init__(self, parent, -1)
+        self.key = key
+        self.model = model
+        self.caption = "%s map" % map_data.label
+
+        self.source = FrameSource(map_data)
+        self.canvas = MapCanvas(self, self.source)
+
+        self.slider = wx.Slider(self, -1, 0, 0, max(map_data.iterations, 1))
+        self.timestep_label = wx.StaticText(self, -1, "timestep 0")
+        self.repetition = wx.SpinCtrl(self, -1, min=1, max=max(repetitions, 1), initial=1)
+        self.Bind(wx.EVT_SLIDER, self.OnTimestep, self.slider)
+        self.Bind(wx.EVT_SPINCTRL, self.OnRepetition, self.repetition)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
+        controls = wx.BoxSizer(wx.HORIZONTAL)
+        controls.Add(self.timestep_label, 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 4)
+        controls.Add(self.slider, 1, wx.EXPAND | wx.ALL, 4)
+        controls.Add(wx.StaticText(self, -1, "repetition"), 0, wx.ALIGN_CENTER_VERTICAL | wx.ALL, 4)
+        controls.Add(self.repetition, 0, wx.ALL, 4)
+
+        self.sizer = wx.BoxSizer(wx.VERTICAL)
+        self.sizer.Add(self.canvas, 1, wx.EXPAND)
+        self.sizer.Add(controls, 0, wx.EXPAND)
+        self.SetSizer(self.sizer)
+
+        self.canvas.SetTimestep(0)
+
+    # WorkspacePanel methods
+
+    def GetCaption(self):
+        return self.caption
+    def GetKey(self):
+        return self.key
+
+    def ReleaseResources(self):
+        self.source.Close()
+        self.canvas.tiles.clear()
+
+    def OnTimestep(self, event):
+        timestep = self.slider.GetValue()
+        self.timestep_label.SetLabel("timestep %d" % timestep)
+        self.canvas.SetTimestep(timestep)
+
+    def OnRepetition(self, event):
+        command = perl_commands.GetMapData(model=self.model,
+                                           repetition=self.repetition.GetValue())
+        main.app.frame.sirca_instance.DoCommand(command)
+        self.source.Close()
+        self.source = FrameSource(command.GetMapData())
+        self.canvas.SetSource(self.source)
+
+    def OnDestroy(self, event):
+        if event.GetEventObject() is self:
+            self.source.Close()
+        event.Skip()
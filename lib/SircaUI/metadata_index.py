@@ -0,0 +1,223 @@
+# vim: set ts=4 sw=4 et :
+"""
+Index of the <field> elements of metadata.xml, for the config GUI
+
+The index is built once per process, and saved to a cache file that is
+used while the XML's mtime and size are unchanged.  Fields are looked up
+by name in a dictionary rather than by xpath, and each has its position
+in the file for sorting the fields of a config.
+
+The elements are copied into MetadataNode objects, which support the
+parts of the ElementTree API that the field presenters use.  The cache
+holds them as JSON lists (not pickles, so a bad file can't run code), in
+a directory of the user's that no one else can write to.
+"""
+
+import os
+import stat
+import json
+import hashlib
+import logging
+
+from lxml import etree
+
+log = logging.getLogger('config.MetadataIndex')
+
+# change if the layout of the cache changes
+CACHE_VERSION = 2
+
+CACHE_DIR = os.path.join('~', '.sirca', 'cache')
+
+class MetadataNode:
+    """A read-only copy of an element and its children"""
+
+    def __init__(self, tag, attrib, text, children):
+        self.tag = tag
+        self.attrib = attrib
+        self.text = text
+        self.children = children
+
+    def ToList(self):
+        """the node as plain lists, for the cache"""
+        return [self.tag, self.attrib, self.text,
+                [child.ToList() for child in self.children]]
+
+    def get(self, name, default=None):
+        return self.attrib.get(name, default)
+
+    def find(self, tag):
+        for child in self.children:
+            if child.tag == tag:
+                return child
+        return None
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+def node_from_element(element):
+    # skipping comments (whose tag isn't a string)
+    return MetadataNode(element.tag, dict(element.attrib), element.text,
+                        [node_from_element(child) for child in element
+                         if isinstance(child.tag, basestring)])
+
+def node_from_list(data):
+    (tag, attrib, text, children) = data
+    attrib = dict([(to_str(name), to_str(value)) for (name, value) in attrib.iteritems()])
+    return MetadataNode(to_str(tag), attrib, to_str(text),
+                        [node_from_list(child) for child in children])
+
+def to_str(value):
+    """json gives unicode, but lxml gives str (and unicode would reach
+    perl as !!python/unicode)"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+class MetadataIndex:
+    """The fields of the metadata by name, in the order they
+    appear in the file"""
+
+    def __init__(self, fields, order):
+        self.fields = fields # name -> [MetadataNode] (there may be several)
+        self.order = order   # name -> position of its last field in the file
+
+        self.presenters = {} # name -> presenter class (not cached)
+
+    def ToList(self):
+        """the index as plain lists, for the cache"""
+        return [[(name, [node.ToList() for node in nodes])
+                 for (name, nodes) in self.fields.iteritems()],
+                self.order.items()]
+
+    def GetFields(self, name):
+        """returns the metadata of each field with name"""
+        return self.fields.get(name, [])
+
+    def SortFields(self, config_fields):
+        """takes in a dictionary mapping config key -> config value
+        returns a list of (key, value) ordered according to the XML file
+        (keys that aren't in it go last)"""
+        last = len(self.order)
+        items = config_fields.items()
+        items.sort(key=lambda item: self.order.get(item[0], last))
+        return items
+
+    def GetPresenterClass(self, name, field_types):
+        """returns the class from field_types (type -> class) for the
+        field with name, or None.  Looked up once per field."""
+        try:
+            return self.presenters[name]
+        except KeyError:
+            pass
+
+        fields = self.GetFields(name)
+        presenter = None
+        if len(fields) == 1:
+            presenter = field_types.get(fields[0].get('type'))
+        self.presenters[name] = presenter
+        return presenter
+
+def index_from_root(root):
+    fields = {}
+    order = {}
+    i = 0
+    for element in root.getiterator('field'):
+        name = element.get('name')
+        fields.setdefault(name, []).append(node_from_element(element))
+        order[name] = i
+        i = i + 1
+    return MetadataIndex(fields, order)
+
+def index_from_list(data):
+    (fields, order) = data
+    return MetadataIndex(dict([(to_str(name), [node_from_list(node) for node in nodes])
+                               for (name, nodes) in fields]),
+                         dict([(to_str(name), i) for (name, i) in order]))
+
+
+# filename -> ((mtime, size), MetadataIndex)
+g_indices = {}
+
+def get_metadata_index(filename):
+    """returns the MetadataIndex of an XML file, from memory or from the
+    cache file if the XML hasn't changed since it was made"""
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (stat.st_mtime, stat.st_size)
+
+    cached = g_indices.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    cache_filename = get_cache_filename(filename)
+    index = None
+    if cache_filename is not None:
+        index = load_cache(cache_filename, filename, key)
+    if index is None:
+        log.info('indexing %s', filename)
+        index = index_from_root(etree.parse(filename).getroot())
+        if cache_filename is not None:
+            save_cache(cache_filename, filename, key, index)
+
+    g_indices[filename] = (key, index)
+    return index
+
+def get_cache_filename(filename):
+    """the cache file for an XML file (whose directory may not be writable),
+    or None if there is nowhere safe to put it"""
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, 'metadata_%s.idx' % hashlib.md5(filename).hexdigest())
+
+def get_cache_dir():
+    """returns the user's cache directory, made if need be, or None if it
+    can't be made or others could write to it"""
+    cache_dir = os.path.expanduser(CACHE_DIR)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0700)
+        info = os.lstat(cache_dir)
+    except OSError, value:
+        log.warn('not caching the metadata index: %s', value)
+        return None
+
+    if hasattr(os, 'getuid'): # not on Windows, where the profile is private anyway
+        if (stat.S_ISLNK(info.st_mode) or info.st_uid != os.getuid()
+                or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)):
+            log.warn('not caching the metadata index: %s is not private', cache_dir)
+            return None
+    return cache_dir
+
+def load_cache(cache_filename, filename, key):
+    """returns the cached index, or None if there isn't a valid one"""
+    try:
+        f = open(cache_filename, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            (version, cached_filename, cached_key, data) = json.load(f)
+            if (version, cached_filename, list(cached_key)) != (CACHE_VERSION, filename, list(key)):
+                return None
+            return index_from_list(data)
+        except Exception, value:
+            log.warn('ignoring bad metadata cache %s: %s', cache_filename, value)
+            return None
+    finally:
+        f.close()
+
+def save_cache(cache_filename, filename, key, index):
+    try:
+        f = open(cache_filename, 'wb')
+        try:
+            json.dump( (CACHE_VERSION, filename, key, index.ToList()), f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError), value:
+        # only slower next time
+        log.warn('could not write metadata cache %s: %s', cache_filename, value)
@@ -9,16 +9,38 @@ New data is appended by the simulator dynamically by outputting YAML documents a
 """
 
 import wx
+from wx.lib.mixins import treemixin
 
 import main
+import map_view
 import stat_outputs
 import perl_commands
+import sirca_get_stats
 
 class OutputTreeNode:
     """
-    base class for nodes in the output tree
+    base class for nodes in the output tree.  The tree is virtual
+    (see OutputTreeCtrl), so nodes only make their children when asked
     """
 
+    def GetText(self):
+        return self.text
+
+    def GetChildren(self):
+        return []
+
+    def GetChildrenCount(self):
+        return len(self.GetChildren())
+
+    def OnActivate(self):
+        pass
+
+    def OnExpanding(self):
+        pass
+
+    def OnRightClick(self):
+        pass
+
     def ShowExistingPanel(self, key):
         """ Tries to show an existing output
         Returns whether successful"""
@@ -43,88 +65,162 @@ class OutputRootNode(OutputTreeNode):
     """
     manages the root node of the outputs tree
     """
-    def __init__(self, tree, sirca_instance):
-        self.tree = tree
-        self.node = tree.AddRoot("outputs")
-        self.tree.SetPyData(self.node, self)
-
-        #self.tree.SetItemImage(self.node, fldridx, wx.TreeItemIcon_Normal)
-        #self.tree.SetItemImage(self.node, fldropenidx, wx.TreeItemIcon_Expanded)
-        
-        # add stat outputs
-        stat_node = self.tree.AppendItem(self.node, "Epicurves")
-        self.tree.SetPyData(stat_node, self)
-
-        # load stat data from SIRCA
-        stats_command = perl_commands.GetStats()
-        sirca_instance.DoCommand(stats_command)
-        stats = stats_command.GetStats()
+    def __init__(self, sirca_instance):
+        self.text = "outputs"
+
+        # stat outputs.  Only their names are loaded here - their data
+        # is loaded when needed (unless it is still running, in which
+        # case they are added by AddStats as they arrive)
+        self.stat_node = FolderNode("Epicurves")
+        if sirca_instance is not None:
+            manifest_command = perl_commands.GetStatsManifest()
+            sirca_instance.DoCommand(manifest_command)
+            for name in manifest_command.GetStatNames():
+                self.stat_node.children.append(StatNode(name))
+
+        # add density maps (one per model)
+        self.map_node = FolderNode("Density maps")
+        if sirca_instance is not None:
+            models_command = perl_commands.GetMapModels()
+            sirca_instance.DoCommand(models_command)
+            repetitions = models_command.GetRepetitions()
+            if repetitions > 0:
+                models = models_command.GetModels()
+                for i in range(len(models)):
+                    self.map_node.children.append(MapNode(models[i], i, repetitions))
+
+    def GetChildren(self):
+        return [self.stat_node, self.map_node]
+
+    def AddStats(self, stats):
         for stat_data in stats:
-            node = StatNode(self.tree, stat_node, stat_data)
+            self.stat_node.children.append(StatNode(stat_data.name, stat_data))
 
-        self.tree.Expand(stat_node)
+    def GetNode(self, indices):
+        node = self
+        for index in indices:
+            node = node.GetChildren()[index]
+        return node
 
-        # add density maps
-        map_node = self.tree.AppendItem(self.node, "Density maps")
-        self.tree.SetPyData(map_node, self)
 
+class FolderNode(OutputTreeNode):
+    """a node that just holds others"""
+    def __init__(self, text):
+        self.text = text
+        self.children = []
 
-    def OnActivate(self, activated):
-        pass
-    def OnRightClick(self, node):
-        pass
+    def GetChildren(self):
+        return self.children
 
 
 class MapNode(OutputTreeNode):
     """
-    manages a node with density plots
+    manages a node with the density/state map of a model
     in the outputs treee
     """
-    def __init__(self, tree, parent, stat_data):
-        self.tree = tree
-        self.parent = parent
+    def __init__(self, label, model, repetitions):
+        self.text = label
+        self.model = model # index of the model
+        self.repetitions = repetitions
 
-        self.node = self.tree.AppendItem(parent, stat_data.name)
-        self.tree.SetPyData(self.node, self)
-        #self.tree.SetItemImage(self.node, fldridx, wx.TreeItemIcon_Normal)
-        #self.tree.SetItemImage(self.node, fldropenidx, wx.TreeItemIcon_Expanded)
+    def OnActivate(self):
 
-        self.stat_data = stat_data
-        self.id = id(stat_data)
+        # check for existing panel
+        if (self.ShowExistingPanel(self)): return
 
-    def OnActivate(self, activated):
+        map_command = perl_commands.GetMapData(model=self.model)
+        main.app.frame.sirca_instance.DoCommand(map_command)
 
-        # check for existing panel
-        if (self.ShowExistingPanel(self.stat_data)): return
-        
-        plotPanel = stat_outputs.OutputPlotPanel(self.GetWorkspace(), self.stat_data)
-        self.ShowPanel(plotPanel, self.stat_data)
+        mapPanel = map_view.MapPanel(self.GetWorkspace(), self, self.model,
+                                     map_command.GetMapData(), self.repetitions)
+        self.ShowPanel(mapPanel, self)
         
 class StatNode(OutputTreeNode):
     """
     manages a node like "COUNT" or "DENSITY"
-    in the outputs treee
+    in the outputs treee.  The stat's data is loaded from SIRCA
+    when the node is first expanded or activated.
     """
-    def __init__(self, tree, parent, stat_data):
-        self.tree = tree
-        self.parent = parent
+    def __init__(self, name, stat_data=None):
+        self.text = name
+        self.stat_data = stat_data
 
-        self.node = self.tree.AppendItem(parent, stat_data.name)
-        self.tree.SetPyData(self.node, self)
-        #self.tree.SetItemImage(self.node, fldridx, wx.TreeItemIcon_Normal)
-        #self.tree.SetItemImage(self.node, fldropenidx, wx.TreeItemIcon_Expanded)
+    def GetStatData(self):
+        if self.stat_data is None:
+            stat_command = perl_commands.GetStat(self.text)
+            main.app.frame.sirca_instance.DoCommand(stat_command)
+            self.stat_data = stat_command.GetStat()
+        return self.stat_data
 
-        self.stat_data = stat_data
-        self.id = id(stat_data)
+    def GetChildren(self):
+        if self.stat_data is None:
+            return []
+        return [SeriesNode(self, (i,)) for i in range(self.stat_data.GetChildrenCount(()))]
+
+    def GetChildrenCount(self):
+        if self.stat_data is None:
+            return 1 # not known yet, but it has some (and can be expanded)
+        return self.stat_data.GetChildrenCount(())
 
-    def OnActivate(self, activated):
+    def OnExpanding(self):
+        self.GetStatData()
+
+    def OnActivate(self):
+        stat_data = self.GetStatData()
 
         # check for existing panel
-        if (self.ShowExistingPanel(self.stat_data)): return
+        if (self.ShowExistingPanel(stat_data)): return
         
-        plotPanel = stat_outputs.OutputPlotPanel(self.GetWorkspace(), self.stat_data)
-        self.ShowPanel(plotPanel, self.stat_data)
- 
+        plotPanel = stat_outputs.OutputPlotPanel(self.GetWorkspace(), stat_data)
+        self.ShowPanel(plotPanel, stat_data)
+
+class SeriesNode(OutputTreeNode):
+    """
+    a model, or a model's state, of a stat.  Activating it
+    shows the stat's plot with its series checked
+    """
+    def __init__(self, stat_node, indices):
+        self.stat_node = stat_node
+        self.indices = indices
+        self.text = stat_node.stat_data.GetText(indices)
+
+    def GetChildren(self):
+        stat_data = self.stat_node.stat_data
+        return [SeriesNode(self.stat_node, self.indices + (i,))
+                for i in range(stat_data.GetChildrenCount(self.indices))]
+
+    def OnActivate(self):
+        self.stat_node.OnActivate()
+        plots_tree = main.app.frame.GetPlotsPanel().tree
+        self.stat_node.stat_data.SetAllChecked(True, plots_tree, self.indices)
+
+
+class OutputTreeCtrl(treemixin.VirtualTree, wx.TreeCtrl):
+    """the outputs tree, with its items made from an OutputRootNode
+    as they are expanded"""
+    def __init__(self, *args, **kwargs):
+        self.root = OutputRootNode(None)
+        super(OutputTreeCtrl, self).__init__(*args, **kwargs)
+        # called before VirtualTree's handler (which adds the children)
+        self.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnExpanding)
+
+    def SetRoot(self, root):
+        self.root = root
+        self.RefreshItems()
+
+    def GetNode(self, item):
+        return self.root.GetNode(self.GetIndexOfItem(item))
+
+    def OnGetItemText(self, indices):
+        return self.root.GetNode(indices).GetText()
+
+    def OnGetChildrenCount(self, indices):
+        return self.root.GetNode(indices).GetChildrenCount()
+
+    def OnExpanding(self, event):
+        self.GetNode(event.GetItem()).OnExpanding()
+        event.Skip()
+
 class OutputPanel(wx.Panel):
     """
     represents the outputs panel on the main window
@@ -132,25 +228,43 @@ class OutputPanel(wx.Panel):
     def __init__(self, parent):
         wx.Panel.__init__(self, parent, -1, size=(150,300), style=wx.WANTS_CHARS)
 
-        tID = wx.NewId()
-        self.tree = wx.TreeCtrl(self, tID, wx.DefaultPosition, wx.DefaultSize,
+        self.tree = OutputTreeCtrl(self, -1, wx.DefaultPosition, wx.DefaultSize,
                                wx.TR_HAS_BUTTONS
                                | wx.TR_LINES_AT_ROOT
                                #| wx.TR_MULTIPLE
                                | wx.TR_HIDE_ROOT
                                 )
+        self.tree.RefreshItems()
         self.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnActivate, self.tree)
-        self.Bind(wx.EVT_RIGHT_UP, self.OnRightClick, self.tree)
+        self.Bind(wx.EVT_TREE_ITEM_RIGHT_CLICK, self.OnRightClick, self.tree)
        
         # expand tree to fill self
         sizer = wx.BoxSizer()
         sizer.Add(self.tree, 1, wx.EXPAND)
         self.SetSizer(sizer)        
 
+        self.live_stats = None # sirca_get_stats.LiveStats while simulating
+
     def Update(self, sirca_instance):
-        self.tree.DeleteAllItems()
-        self.root = OutputRootNode(self.tree, sirca_instance)
-        #self.tree.Expand(self.root.node)
+        # the items are reused where they are the same
+        self.tree.SetRoot(OutputRootNode(sirca_instance))
+        self.live_stats = None
+
+    def StartLiveUpdates(self):
+        """clears the tree, ready for the stats of a simulation
+        that is starting"""
+        self.tree.SetRoot(OutputRootNode(None))
+        self.live_stats = sirca_get_stats.LiveStats()
+
+    def UpdateLiveStats(self, update):
+        """applies a stats_update from the running simulation"""
+        if self.live_stats is None:
+            return # not expecting any
+        created = self.live_stats.Update(update)
+        if len(created) > 0:
+            self.tree.root.AddStats(created)
+            self.tree.RefreshItems()
+            self.tree.Expand(self.tree.GetItemByIndex((0,)))
         
     def OnSize(self, event):
         w,h = self.GetClientSizeTuple()
@@ -158,22 +272,12 @@ class OutputPanel(wx.Panel):
 
     def OnRightClick(self, event):
         # Pass down the right-click event to the python object representing the clicked on node
-        item = event.GetItem()
-        node = self.tree.GetPyData(item)
-        try:
-            node.OnRightClick(item)
-        except AttributeError:
-            pass
+        self.tree.GetNode(event.GetItem()).OnRightClick()
 
     def OnActivate(self, event):
         # Pass down the double-click event to the python object representing the clicked on node
-        item = event.GetItem()
-        node = self.tree.GetPyData(item)
-        try:
-            node.OnActivate(item)
-            event.Veto()
-        except AttributeError:
-            pass
+        self.tree.GetNode(event.GetItem()).OnActivate()
+        event.Veto()
 
 
 
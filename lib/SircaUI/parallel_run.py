@@ -0,0 +1,156 @@
+# vim: set ts=4 sw=4 et :
+"""
+Runs the repetitions of a control file in several SIRCA perl workers at
+once (no wx needed)
+
+The repetitions are run with RAND_STREAMS set, so each draws from its own
+PRNG stream derived from RAND_SEED and doesn't depend on the ones before
+it.  Each worker loads the landscape, then takes the next repetition to
+run as soon as it has finished one, saving the results of each to a
+file.  The results are merged into one landscape in repetition order and
+saved as a .scs file, so they are the same for a given seed whatever
+the number of workers.
+
+usage: python parallel_run.py [options] -c CONTROL_FILE -o STATE_FILE
+"""
+
+import os
+import sys
+import time
+import Queue
+import random
+import shutil
+import logging
+import optparse
+import tempfile
+import threading
+import multiprocessing
+
+import perl_data
+import perl_interface
+import perl_commands
+
+log = logging.getLogger('export.ParallelRun')
+
+DEFAULT_REPETITIONS = 10  # as Sirca::Landscape
+
+
+class ParallelRunError(Exception):
+    pass
+
+
+def run_repetitions(params, out_filename, processes=None, seed=None):
+    """runs the repetitions of a landscape's params in processes workers
+    (default: one per CPU), and saves the merged results to out_filename.
+    Returns the RAND_SEED used."""
+    params = dict(params)
+    params['RAND_STREAMS'] = 1
+    if seed is not None:
+        params['RAND_SEED'] = seed
+    if params.get('RAND_SEED') is None:
+        # every worker must derive the streams from the same seed
+        params['RAND_SEED'] = random.randint(1, 2 ** 31 - 1)
+    log.info('RAND_SEED is %s', params['RAND_SEED'])
+
+    repetitions = int(params.get('REPETITIONS', DEFAULT_REPETITIONS))
+    if repetitions < 1:
+        raise ParallelRunError("REPETITIONS must be at least 1, not %d" % repetitions)
+    processes = min(processes or multiprocessing.cpu_count(), repetitions)
+
+    work_dir = tempfile.mkdtemp(prefix='sirca_repetitions_')
+    instances = []
+    try:
+        for i in range(processes):
+            instances.append(perl_interface.SIRCAInstance(command_port=0, logging_port=0))
+
+        pending = Queue.Queue()
+        for repetition in range(1, repetitions + 1):
+            pending.put(repetition)
+        filenames = []
+        errors = []
+
+        threads = []
+        for instance in instances:
+            thread = threading.Thread(target=run_worker,
+                                      args=(instance, params, pending, work_dir, filenames, errors))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise ParallelRunError("a worker failed: %s" % errors[0])
+
+        # the first worker's process has the density files, indexes and
+        # neighbour tables cached, so a new landscape there is quick
+        merger = instances[0]
+        merger.DoCommand(perl_commands.LoadFromParameters(params))
+        merger.DoCommand(perl_commands.MergeRepetitions(sorted(filenames)))
+        merger.DoCommand(perl_commands.SaveState(os.path.abspath(out_filename)))
+    finally:
+        for instance in instances:
+            instance.Close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return params['RAND_SEED']
+
+def run_worker(instance, params, pending, work_dir, filenames, errors):
+    """runs repetitions from the pending queue until it is empty (or any
+    worker has failed)"""
+    try:
+        instance.DoCommand(perl_commands.LoadFromParameters(params))
+        while not errors:
+            try:
+                repetition = pending.get_nowait()
+            except Queue.Empty:
+                return
+            start = time.time()
+            filename = os.path.join(work_dir, 'repetition_%06d.stor' % repetition)
+            instance.DoCommand(perl_commands.SimulateRepetitions([repetition], filename))
+            filenames.append(filename)
+            log.info('repetition %d took %.1f seconds', repetition, time.time() - start)
+    except Exception, value:
+        log.error('worker failed: %s', value)
+        errors.append(value)
+
+def read_control_file(filename):
+    try:
+        return perl_data.load_file(filename)
+    except perl_data.PerlDataError:
+        # more than the Python reader handles
+        sirca = perl_interface.SIRCAInstance(command_port=0, logging_port=0)
+        try:
+            command = perl_commands.ReadParameters(filename)
+            sirca.DoCommand(command)
+            return command.GetConfigDict()
+        finally:
+            sirca.Close()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] -c CONTROL_FILE -o STATE_FILE")
+    parser.add_option("-c", "--control_file", help="the control file to run")
+    parser.add_option("-o", "--output", help="saved state (.scs) to write")
+    parser.add_option("-j", "--processes", type="int", default=None,
+                      help="number of workers (default: one per CPU)")
+    parser.add_option("--seed", type="int", default=None,
+                      help="RAND_SEED (default: the control file's, or a random one)")
+    (options, args) = parser.parse_args(argv)
+
+    if options.control_file is None or options.output is None:
+        parser.error("need --control_file and --output")
+
+    params = read_control_file(options.control_file)
+    start = time.time()
+    try:
+        seed = run_repetitions(params, options.output, options.processes, options.seed)
+    except (ParallelRunError, perl_interface.CommandException), value:
+        print >> sys.stderr, value
+        return 1
+    print "wrote %s in %.1f seconds (RAND_SEED %s)" % (options.output, time.time() - start, seed)
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
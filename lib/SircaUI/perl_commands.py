@@ -5,6 +5,7 @@ and return the results
 """
 import logging
 import sirca_get_stats
+import map_data
 
 from perl_interface import CommandException, SIRCACommand
 
@@ -42,6 +43,41 @@ class ReadParameters(SIRCACommand):
     def get_command(self):
         return { 'type' : 'read_parameters', 'data' : self.perl_data }
 
+class ReadParametersMulti(SIRCACommand):
+    """Reads several parameter files in one job"""
+    log = logging.getLogger('command.ReadParametersMulti')
+
+    def __init__(self, filenames):
+        SIRCACommand.__init__(self)
+
+        self.files = []
+        for filename in filenames:
+            f = open(filename, 'r')
+            self.files.append( { 'name' : filename, 'data' : f.read() } )
+            f.close()
+        self.log.debug('read configuration files: %s' % ', '.join(filenames))
+
+    def GetName(self):
+        return "ReadParametersMulti"
+
+    def GetConfigDicts(self):
+        """returns the parameters of each file, in the order given"""
+        self.WaitTillCompleted()
+        return self.params
+
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'read_parameters_multi':
+                self.params = obj['parameters']
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't read_parameters_multi but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(obj))
+
+    def get_command(self):
+        return { 'type' : 'read_parameters_multi', 'files' : self.files }
+
 class WriteParametersAsControlFile(SIRCACommand):
     log = logging.getLogger('command.WriteParametersAsControlFile')
 
@@ -157,9 +193,10 @@ class SaveState(SIRCACommand):
 class Simulate(SIRCACommand):
     log = logging.getLogger('command.Simulate')
 
-    def __init__(self, new_params=None):
+    def __init__(self, new_params=None, live_stats=False):
         SIRCACommand.__init__(self)
         self.new_params = new_params
+        self.live_stats = live_stats # have stats_update results sent while running
     
     def GetName(self):
         return "Simulate"
@@ -177,10 +214,61 @@ class Simulate(SIRCACommand):
                
     # returns command that is send to the GUI (usually a dictionary)
     def get_command(self):
-        if self.new_params is None:
-            return { 'type' : 'simulate' }
+        command = { 'type' : 'simulate' }
+        if self.new_params is not None:
+            command['new_params'] = self.new_params
+        if self.live_stats:
+            command['live_stats'] = 1
+        return command
+
+class SimulateRepetitions(SIRCACommand):
+    """Runs some of the repetitions of the loaded landscape (which needs
+    RAND_STREAMS set), saving their results to a file for MergeRepetitions"""
+    log = logging.getLogger('command.SimulateRepetitions')
+
+    def __init__(self, repetitions, filename):
+        SIRCACommand.__init__(self)
+        self.repetitions = list(repetitions)
+        self.filename = filename
+
+    def GetName(self):
+        return "SimulateRepetitions"
+
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'simulate_repetitions':
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't simulate_repetitions but %s" % obj['finished'])
         else:
-            return { 'type' : 'simulate', 'new_params' : self.new_params }
+            raise CommandException("unexpected message: %s" % repr(obj))
+
+    def get_command(self):
+        return { 'type' : 'simulate_repetitions', 'repetitions' : self.repetitions,
+                 'filename' : self.filename }
+
+class MergeRepetitions(SIRCACommand):
+    """Merges the files of SimulateRepetitions into the loaded landscape"""
+    log = logging.getLogger('command.MergeRepetitions')
+
+    def __init__(self, filenames):
+        SIRCACommand.__init__(self)
+        self.filenames = list(filenames)
+
+    def GetName(self):
+        return "MergeRepetitions"
+
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'merge_repetitions':
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't merge_repetitions but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(obj))
+
+    def get_command(self):
+        return { 'type' : 'merge_repetitions', 'filenames' : self.filenames }
 
 class GetStats(SIRCACommand):
     log = logging.getLogger('command.GetStats')
@@ -197,6 +285,13 @@ class GetStats(SIRCACommand):
         extractor = sirca_get_stats.StatExtractor(stats_dict=self.stats)
         return extractor.GetStats()
 
+    def GetStatSeries(self):
+        """returns a list of (stat name, dimension info, StatSeriesStore)
+        (ie: the stats without needing wx)"""
+        self.WaitTillCompleted()
+        extractor = sirca_get_stats.StatExtractor(stats_dict=self.stats)
+        return extractor.GetStatSeries()
+
     # called when an object is received from SIRCA
     # if have final result, should call SetCompleted()
     def handle_result(self, obj):
@@ -213,6 +308,134 @@ class GetStats(SIRCACommand):
     def get_command(self):
         return { 'type' : 'get_stats' }
 
+class GetStatsManifest(SIRCACommand):
+    log = logging.getLogger('command.GetStatsManifest')
+
+    def __init__(self):
+        SIRCACommand.__init__(self)
+    
+    def GetName(self):
+        return "GetStatsManifest"
+
+    def GetStatNames(self):
+        """returns the names of the stats (sorted)"""
+        self.WaitTillCompleted()
+        return self.names
+
+    # called when an object is received from SIRCA
+    # if have final result, should call SetCompleted()
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'get_stats_manifest':
+                self.names = obj['stats']
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't get_stats_manifest but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(job))
+               
+    # returns command that is send to the GUI (usually a dictionary)
+    def get_command(self):
+        return { 'type' : 'get_stats_manifest' }
+
+class GetStat(GetStats):
+    """gets a single stat (see GetStatsManifest for their names)"""
+    log = logging.getLogger('command.GetStat')
+
+    def __init__(self, name):
+        GetStats.__init__(self)
+        self.name = name
+    
+    def GetName(self):
+        return "GetStat"
+
+    def GetStat(self):
+        """returns a StatPlotData object"""
+        return self.GetStats()[0]
+
+    # called when an object is received from SIRCA
+    # if have final result, should call SetCompleted()
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'get_stat':
+                self.stats = obj['stats']
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't get_stat but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(job))
+               
+    # returns command that is send to the GUI (usually a dictionary)
+    def get_command(self):
+        return { 'type' : 'get_stat', 'name' : self.name }
+
+class GetMapModels(SIRCACommand):
+    log = logging.getLogger('command.GetMapModels')
+
+    def __init__(self):
+        SIRCACommand.__init__(self)
+    
+    def GetName(self):
+        return "GetMapModels"
+
+    def GetModels(self):
+        """returns the model labels, in model index order"""
+        self.WaitTillCompleted()
+        return self.models
+
+    def GetRepetitions(self):
+        self.WaitTillCompleted()
+        return self.repetitions
+
+    # called when an object is received from SIRCA
+    # if have final result, should call SetCompleted()
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'get_map_models':
+                self.models = obj['models']
+                self.repetitions = obj['repetitions']
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't get_map_models but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(job))
+               
+    # returns command that is send to the GUI (usually a dictionary)
+    def get_command(self):
+        return { 'type' : 'get_map_models' }
+
+class GetMapData(SIRCACommand):
+    log = logging.getLogger('command.GetMapData')
+
+    def __init__(self, model=0, repetition=1):
+        SIRCACommand.__init__(self)
+        self.model = model
+        self.repetition = repetition
+    
+    def GetName(self):
+        return "GetMapData"
+
+    def GetMapData(self):
+        """returns a map_data.MapData object"""
+        self.WaitTillCompleted()
+        return map_data.MapData(self.result)
+
+    # called when an object is received from SIRCA
+    # if have final result, should call SetCompleted()
+    def handle_result(self, obj):
+        if obj['type'] == 'finished':
+            if obj['finished'] == 'get_map_data':
+                self.result = obj
+                self.SetCompleted()
+            else:
+                raise CommandException("finished job isn't get_map_data but %s" % obj['finished'])
+        else:
+            raise CommandException("unexpected message: %s" % repr(job))
+               
+    # returns command that is send to the GUI (usually a dictionary)
+    def get_command(self):
+        return { 'type' : 'get_map_data', 'model' : self.model, 'repetition' : self.repetition }
+
 class GetParameters(SIRCACommand):
     log = logging.getLogger('command.GetParameters')
 
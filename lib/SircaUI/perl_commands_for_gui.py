@@ -48,14 +48,31 @@ class SimulationFinishedEvent(GUIEvent):
         main_win.OnSimulationFinished()
 
 
+class StatsUpdateEvent(GUIEvent):
+    """Event carrying the stats of a simulation that is still running"""
+    def __init__(self, update):
+        GUIEvent.__init__(self)
+        self.update = update
+
+    def update_ui(self, main_win):
+        main_win.OnStatsUpdate(self.update)
+
+
 class AsyncSimulate(Simulate):
     """Just like simulate but sends a wxPython event when
-    the simulation is complete"""
+    the simulation is complete, and (with live_stats) whenever
+    updated stats arrive"""
 
     def __init__(self, main_win, **kwargs):
         Simulate.__init__(self, **kwargs)
         self.main_win = main_win
 
+    def handle_result(self, obj):
+        if obj['type'] == 'stats_update':
+            wx.PostEvent(self.main_win, StatsUpdateEvent(obj) )
+        else:
+            Simulate.handle_result(self, obj)
+
     def SetCompleted(self):
         Simulate.SetCompleted(self)
         wx.PostEvent(self.main_win, SimulationFinishedEvent() )
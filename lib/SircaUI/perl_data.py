@@ -0,0 +1,230 @@
+# vim: set ts=4 sw=4 et :
+"""
+Reads and writes Sirca control files without a Perl worker
+
+Control files are Perl data as written by Data::Dumper:
+
+    $VAR1 = {
+              'MODEL_RUNS' => '10',
+              'MODELS' => [ ... ],
+            };
+
+This handles the subset of Perl they use: hashes, arrays, single and
+double quoted strings (without interpolation), numbers, undef, bareword
+hash keys and comments.  Anything else (expressions, variables, shared
+references, heredocs, ...) raises PerlDataError, and such files are read
+by Perl instead (sirca_jobs.pm's read_parameters).
+
+dumps() writes the layout of Data::Dumper with Sortkeys set, so saving
+a file that was loaded gives the same bytes.  Quoted strings load as
+str, and bare numbers as int or float.
+"""
+
+import re
+
+class PerlDataError(Exception):
+    pass
+
+
+# Reading
+
+TOKEN = re.compile(r"""
+     (?P<space>\s+|\#[^\n]*)
+    |(?P<punct>=>|[{}\[\],;=])
+    |(?P<squote>'(?:[^'\\]|\\.)*')
+    |(?P<dquote>"(?:[^"\\]|\\.)*")
+    |(?P<number>-?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?(?![\w.]))
+    |(?P<var>\$\w+)
+    |(?P<word>-?[A-Za-z_]\w*)
+    """, re.VERBOSE | re.DOTALL)
+
+DQUOTE_ESCAPES = { 'n' : '\n', 't' : '\t', 'r' : '\r',
+                   '\\' : '\\', '"' : '"', "'" : "'", '$' : '$', '@' : '@' }
+
+def load_file(filename):
+    f = open(filename, 'r')
+    try:
+        return loads(f.read())
+    finally:
+        f.close()
+
+def loads(text):
+    """returns the data of a control file"""
+    return Parser(text).ParseDocument()
+
+class Parser:
+    def __init__(self, text):
+        self.text = text
+        self.tokens = self.__tokenize(text)
+        self.pos = 0
+
+    def __tokenize(self, text):
+        """returns a list of (kind, text, offset)"""
+        tokens = []
+        offset = 0
+        while offset < len(text):
+            match = TOKEN.match(text, offset)
+            if match is None:
+                self.offset_error(offset, "unsupported syntax")
+            if match.lastgroup != 'space':
+                tokens.append( (match.lastgroup, match.group(), offset) )
+            offset = match.end()
+        tokens.append( ('end', '', len(text)) )
+        return tokens
+
+    def offset_error(self, offset, message):
+        line = self.text.count('\n', 0, offset) + 1
+        raise PerlDataError("line %d: %s" % (line, message))
+
+    def error(self, message):
+        (kind, text, offset) = self.tokens[self.pos]
+        self.offset_error(offset, "%s at %r" % (message, text))
+
+    def peek(self):
+        return self.tokens[self.pos][:2]
+
+    def expect(self, text):
+        if self.peek()[1] != text:
+            self.error("expected %r" % text)
+        self.pos += 1
+
+    def ParseDocument(self):
+        # $VAR1 = ... ; or just the value
+        if self.peek()[0] == 'var':
+            self.pos += 1
+            self.expect('=')
+        value = self.ParseValue()
+        if self.peek() == ('punct', ';'):
+            self.pos += 1
+        if self.peek()[0] != 'end':
+            self.error("unexpected")
+        return value
+
+    def ParseValue(self):
+        (kind, text) = self.peek()
+        if text == '{':
+            return self.ParseHash()
+        if text == '[':
+            return self.ParseArray()
+        if kind == 'word' and text == 'undef':
+            self.pos += 1
+            return None
+        return self.ParseScalar()
+
+    def ParseScalar(self):
+        (kind, text) = self.peek()
+        if kind == 'squote':
+            value = re.sub(r"\\([\\'])", r"\1", text[1:-1])
+        elif kind == 'dquote':
+            value = self.__unescape(text[1:-1])
+        elif kind == 'number':
+            if re.match(r'-?0\d', text):
+                self.error("octal numbers aren't supported")
+            if re.match(r'-?\d+$', text):
+                value = int(text)
+            else:
+                value = float(text)
+        else:
+            self.error("unsupported value")
+        self.pos += 1
+        return value
+
+    def __unescape(self, body):
+        if re.search(r'(?<!\\)(?:\\\\)*[$@]', body):
+            self.error("interpolation isn't supported")
+        def replace(match):
+            try:
+                return DQUOTE_ESCAPES[match.group(1)]
+            except KeyError:
+                self.error("unsupported escape \\%s" % match.group(1))
+        return re.sub(r'\\(.)', replace, body)
+
+    def ParseItems(self, close):
+        """returns the values of a list up to the closing bracket,
+        allowing bareword keys (before =>)"""
+        self.pos += 1
+        items = []
+        while self.peek()[1] != close:
+            (kind, text) = self.peek()
+            if kind == 'word' and self.tokens[self.pos + 1][1] == '=>':
+                self.pos += 1
+                items.append(text)
+            else:
+                items.append(self.ParseValue())
+            # commas (and =>) separate items, and may be repeated or trail
+            if self.peek()[1] not in (',', '=>', close):
+                self.error("expected ',' or %r" % close)
+            while self.peek()[1] in (',', '=>'):
+                self.pos += 1
+        self.pos += 1
+        return items
+
+    def ParseHash(self):
+        items = self.ParseItems('}')
+        if len(items) % 2:
+            self.error("odd number of elements in hash")
+        hash = {}
+        for i in range(0, len(items), 2):
+            key = items[i]
+            if key is None or isinstance(key, (dict, list)):
+                self.error("unsupported hash key")
+            if not isinstance(key, basestring):
+                key = str(key)
+            hash[key] = items[i + 1]
+        return hash
+
+    def ParseArray(self):
+        return self.ParseItems(']')
+
+
+# Writing
+
+# the integers that Data::Dumper leaves unquoted
+DUMPER_INTEGER = re.compile(r'(?:0|-?[1-9]\d{0,8})$')
+
+def dumps(data, name='VAR1'):
+    """returns data as Perl, laid out as Data::Dumper does (with Sortkeys)"""
+    prefix = '$%s = ' % name
+    return prefix + emit(data, len(prefix)) + ';\n'
+
+def dump_file(filename, data):
+    f = open(filename, 'w')
+    try:
+        f.write(dumps(data))
+    finally:
+        f.close()
+
+def emit(value, column):
+    """returns value as Perl, when it starts at column.  The items of a
+    hash or array are indented two past its opening bracket."""
+    indent = ' ' * (column + 2)
+    if isinstance(value, dict):
+        if not value:
+            return '{}'
+        lines = []
+        for key in sorted(value.keys()):
+            start = indent + quote(key) + ' => '
+            lines.append(start + emit(value[key], len(start)))
+        return '{\n' + ',\n'.join(lines) + '\n' + ' ' * column + '}'
+    if isinstance(value, (list, tuple)):
+        if not value:
+            return '[]'
+        lines = [indent + emit(item, column + 2) for item in value]
+        return '[\n' + ',\n'.join(lines) + '\n' + ' ' * column + ']'
+    if value is None:
+        return 'undef'
+    if isinstance(value, (bool, int, long)):
+        text = str(int(value))
+        if DUMPER_INTEGER.match(text):
+            return text
+        return quote(text)
+    if isinstance(value, float):
+        return quote(repr(value))
+    return quote(value)
+
+def quote(value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
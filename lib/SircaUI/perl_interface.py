@@ -251,34 +251,44 @@ class SIRCAInstance():
     command_port = 6181
     logging_port = 6182
 
-    def __init__(self):
+    def __init__(self, command_port=None, logging_port=None):
+        """ports of 0 are chosen by the system, eg to run several instances at once"""
+        if command_port is None:
+            command_port = self.command_port
+        if logging_port is None:
+            logging_port = self.logging_port
             
         # create socket server for perl app to connect to
+        command_sock = self.listen(command_port)
+        logging_sock = self.listen(logging_port)
         
         # start the perl application, telling it where to connect
         self.closed = False
-        commandline = 'perl sirca_client.pl localhost %d %d' % (self.command_port, self.logging_port)
+        commandline = 'perl sirca_client.pl localhost %d %d' % (command_sock.getsockname()[1],
+                                                                logging_sock.getsockname()[1])
 
         # must create in self so these stdin/stdout objects don't get close()d when __init__ finishes,
         # causing an infinite loop as close() tries to wait for sirca_client.pl to exit
         (self.child_stdin, self.child_stdout_and_stderr) = os.popen4(commandline)
         
-        self.command_conn = self.accept_connection(self.command_port, timeout=30)
-        self.logging_conn = self.accept_connection(self.logging_port, timeout=30)
+        self.command_conn = self.accept_connection(command_sock, timeout=30)
+        self.logging_conn = self.accept_connection(logging_sock, timeout=30)
         self.runningCommand = None
 
         log_collector = self.get_log_collector_job()
         log_collector.Start(self) # launches thread
 
 
-    def accept_connection(self, port, timeout):
+    def listen(self, port):
         HOST = ''   # means localhost
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.bind((HOST, port))
         sock.listen(1)
-        self.log.debug('listening on port %d', port)
+        self.log.debug('listening on port %d', sock.getsockname()[1])
+        return sock
 
-        sock.settimeout(30)
+    def accept_connection(self, sock, timeout):
+        sock.settimeout(timeout)
         try:
             conn, addr = sock.accept()
             self.log.debug('got connection from %s', addr)
@@ -114,7 +114,10 @@ while (defined ($buf = $sock->getline()) ) {
 
 		# execute the command - attempting to handle errors
 		my $result;
-	    eval { $result = SircaUI::sirca_jobs::handle_job($command) };
+		#  jobs can send intermediate results (eg: stats during a simulation)
+		#  through the writer before returning their final result
+		my $writer = sub { write_object($sock, shift) };
+	    eval { $result = SircaUI::sirca_jobs::handle_job($command, $writer) };
 		if ($@) {
             my $err = $@;
 			$log->error($err);
@@ -8,7 +8,22 @@ import yaml
 import sets
 import numpy
 
-from stat_outputs import StatPlotData
+import stat_store
+
+def assign_indices(labelSet):
+    """assigns each label to an index (in sorted order)"""
+    # convert to sorted lists
+    labels = list(labelSet)
+    labels.sort()
+
+    # assign indices
+    indices = {}
+    i = 0
+    for l in labels:
+        indices[l] = i
+        i = i + 1
+
+    return indices
 
 class StatExtractor:
     """Loads epicurves into StatPlotData from a saved sirca state file"""
@@ -30,16 +45,28 @@ class StatExtractor:
         else:
             raise "expected either 'file' or 'yaml_str' arguments"
 
+        # element type of the loaded series (float32 halves the memory)
+        self.dtype = kwargs.get("dtype", stat_store.DEFAULT_DTYPE)
+
     def GetStats(self):
         """Returns a list of StatPlotData objects"""
+        # imported here so that the series can be had without wx
+        from stat_outputs import StatPlotData
+
+        outputs = []
+        for (stat_name, dimension_info, store) in self.GetStatSeries():
+            outputs.append( StatPlotData(stat_name, dimension_info, store) )
+        return outputs
+
+    def GetStatSeries(self):
+        """Returns a list of (stat name, dimension info, StatSeriesStore)"""
         if not hasattr(self, 'stats_dict'):
             yaml_events = yaml.parse(self.yaml_str, Loader=yaml.CLoader)
             stats_dict = self.__load_stats_dict(  yaml_events )
         else:
             stats_dict = self.stats_dict
 
-        outputs = self.__get_stat_outputs(stats_dict)
-        return outputs
+        return self.__get_stat_outputs(stats_dict)
 
 
     def __load_stats_dict(self, yaml_event_generator):
@@ -166,27 +193,29 @@ class StatExtractor:
         stats = doc["MODEL_STATS"]
         outputs = []
 
-        # form each stat into a StatOutput object
+        # form each stat into its dimensions and series
         for (stat_name, stat_values) in stats.iteritems():
-            (dimension_info, data_array) = self.__get_data_array(stat_values)
-            outputs.append( StatPlotData(stat_name, dimension_info, data_array) )
+            (dimension_info, store) = self.__get_series_store(stat_name, stat_values)
+            outputs.append( (stat_name, dimension_info, store) )
 
         return outputs
 
-    def __get_data_array(self, stats):
+    def __get_series_store(self, stat_name, stats):
 
         # available dimensions for the data to get their range
-        # and unique values
-        models = sets.Set()
-        states = sets.Set()
+        # and unique values.  The times and means of each series are
+        # kept in compact arrays for the store's loader, so the parsed
+        # stats (a dict and label per point) aren't kept
+        models = {} # model name -> position in the stats list
+        states = {} # state name -> position in each timestep's list
         times = sets.Set()
+        points = {} # (model pos, state pos) -> ([times], [means])
 
-        data = {} # maps label to mean
-
-        # read the data and load the dimension variables above
-        for lModel in stats:
-            for lTime in lModel:
-                for lState in lTime:
+        # read the labels and load the dimension variables above
+        for model_pos in range(len(stats)):
+            for lTime in stats[model_pos]:
+                for state_pos in range(len(lTime)):
+                    lState = lTime[state_pos]
                     if lState is not None and lState != "~":
 
                         label = lState["label"]
@@ -195,58 +224,97 @@ class StatExtractor:
                         # strip of 't' prefix and convert to integer
                         time = int(time[1:])
 
-
-                        models.add(model)
-                        states.add(state)
+                        models.setdefault(model, model_pos)
+                        states.setdefault(state, state_pos)
                         times.add(time)
 
-                        data[label] = float(lState["mean"])
-
-        # assign each label to an index
-        def assignIndices(labelSet):
-            # convert to sorted lists
-            labels = list(labelSet)
-            labels.sort()
+                        (series_times, means) = points.setdefault((model_pos, state_pos), ([], []))
+                        series_times.append(time)
+                        means.append(float(lState["mean"]))
 
-            # assign indices
-            indices = {}
-            i = 0
-            for l in labels:
-                indices[l] = i
-                i = i + 1
-
-            return indices
-        (models, states, times) = map(assignIndices, (models, states, times) )
+        (model_indices, state_indices) = map(assign_indices, (models, states) )
 
         # now we have something like
         # { counts : 0, densities : 1}
         # { s1 : 0, s2 : 1, s3 : 2} etc...
-        #   making it easy to populate the numpy array
 
-        # form a blank array
         # for times we include all integers in the range regardless of
         # whether there are data points for them
-        dims = ( len(models), len(states), max(times) - min(times) + 1)
-        array = numpy.zeros(dims, dtype=float)
+        min_time = min(times)
+        length = max(times) - min_time + 1
+
+        model_positions = [None] * len(model_indices)
+        for (model, index) in model_indices.iteritems():
+            model_positions[index] = models[model]
+        state_positions = [None] * len(state_indices)
+        for (state, index) in state_indices.iteritems():
+            state_positions[index] = states[state]
+
+        for (key, (series_times, means)) in points.items():
+            points[key] = (numpy.array(series_times, dtype=numpy.int32) - min_time,
+                           numpy.array(means, dtype=float))
+
+        def load_series(indices):
+            """returns the means for one (model, state) series"""
+            (model, state) = indices
+            series = numpy.zeros(length, dtype=float)
+            key = (model_positions[model], state_positions[state])
+            if key in points:
+                (offsets, means) = points[key]
+                series[offsets] = means
+            return series
+
+        store = stat_store.StatSeriesStore(stat_name, length,
+                loader=load_series, dtype=self.dtype)
+
+        # actually, don't treat time as a dimension that will be displayed
+        # to the user
+        return ( (model_indices, state_indices), store)
+        
+
+class LiveStats:
+    """Collects the stats_update results sent while a simulation runs
+    into StatPlotData objects, which are updated in place"""
 
+    def __init__(self, dtype=stat_store.DEFAULT_DTYPE):
+        self.dtype = dtype
+        self.stats = {} # stat name -> StatPlotData
 
-        # fill the array..
-        for (label, value) in data.iteritems():
-            (model, state, time) = label.split('_')
-            # map to indicies
-            model = models[model]
-            state = states[state]
+    def GetStats(self):
+        """Returns a list of StatPlotData objects"""
+        return self.stats.values()
+
+    def Update(self, update):
+        """applies a stats_update result.  Returns any StatPlotData
+        objects that were created for it"""
+        created = []
+        start = update['from']
+        for (stat_name, by_model) in update['stats'].iteritems():
+            plot_data = self.stats.get(stat_name)
+            if plot_data is None:
+                plot_data = self.__create(stat_name, by_model, update['iterations'] + 1)
+                self.stats[stat_name] = plot_data
+                created.append(plot_data)
+
+            (model_indices, state_indices) = plot_data.dimension_info
+            for (model, by_state) in by_model.iteritems():
+                for (state, means) in by_state.iteritems():
+                    indices = (model_indices[model], state_indices[state])
+                    plot_data.UpdateSeries(indices, start, means)
+        return created
+
+    def __create(self, stat_name, by_model, length):
+        from stat_outputs import StatPlotData
 
-            # strip of 't' and convert to int
-            time = int(time[1:])
-            time = time - min(times)
+        states = sets.Set()
+        for by_state in by_model.values():
+            states.update(by_state.keys())
+        dimension_info = (assign_indices(by_model.keys()), assign_indices(states))
 
-            array[model,state,time] = value
+        # nothing to load from - the series are filled in as updates arrive
+        store = stat_store.StatSeriesStore(stat_name, length, dtype=self.dtype)
+        return StatPlotData(stat_name, dimension_info, store)
 
-        # actually, don't treat time as a dimension that will be displayed
-        # to the user
-        return ( (models, states), array)
-        
 
 if __name__ == "__main__":
     # TEST
@@ -10,6 +10,8 @@ use warnings;
 use Sirca::Landscape;
 
 use Carp;
+use Time::HiRes qw{time};
+use MIME::Base64 qw{encode_base64};
 use Storable qw /nstore retrieve freeze thaw dclone nstore_fd fd_retrieve /;
 use Clone qw/clone/;
 use Data::Structure::Util qw /unbless/;
@@ -24,9 +26,16 @@ my $handlers = {
     load_from_saved_state => \&load_from_saved_state,
     save_state => \&save_state,
     read_parameters => \&read_parameters,
+    read_parameters_multi => \&read_parameters_multi,
     simulate => \&simulate,
+    simulate_repetitions => \&simulate_repetitions,
+    merge_repetitions => \&merge_repetitions,
     get_stats => \&get_stats,
+    get_stats_manifest => \&get_stats_manifest,
+    get_stat => \&get_stat,
     get_parameters => \&get_parameters,
+    get_map_models => \&get_map_models,
+    get_map_data => \&get_map_data,
     write_parameters_as_control_file => \&write_parameters_as_control_file,
 };
 
@@ -34,12 +43,13 @@ my $handlers = {
 ### EXPORTED
 sub handle_job {
 	my $command = shift;
+	my $writer = shift;  #  optional, sends intermediate results to the GUI
 	my $type = $$command{'type'};
 	my $handler = $$handlers{$type};
 
 	if (defined $handler) {
 		$log->info("running command $type");
-		return &$handler($command);
+		return &$handler($command, $writer);
 	} else {
 		$log->warn("unknown command $type");
 		return handle_unknown_command($command);
@@ -82,6 +92,9 @@ sub load_from_saved_state {
     } else {
         return { type => 'error', message => 'invalid parameters (no filename or saved_state)' }
     }
+    #  a saved landscape has its own groups and indexes, so the cached
+    #  files and indexes of the one it replaced only take up memory
+    Sirca::Population::clear_data_cache ();
 
 	return { type => 'finished', finished => 'load_from_saved_state' }
 }
@@ -104,22 +117,157 @@ sub save_state {
 }
 
 # optionally loads a new landscape, and runs it
+#  if live_stats is set, stats_update results are sent as it runs
 sub simulate {
     my $command = shift;
+    my $writer = shift;
 
     my $new_params = $$command{'new_params'};
     if (defined $new_params) {
-        $landscape = Sirca::Landscape -> new (config => $new_params);
+        #  patch the loaded landscape if there is one, so that the density
+        #  files, indexes and neighbours are only rebuilt if they changed
+        my $updated = defined $landscape
+            && eval { $landscape -> update_params (config => $new_params); 1 };
+        if (not $updated) {
+            $log->warn("could not update the landscape, building a new one: $@") if $@;
+            $landscape = Sirca::Landscape -> new (config => $new_params);
+        }
     }
 
     if (not defined $landscape) {
     	return { type => 'error', message => "landscape not loaded" };
     }
 
-    $landscape -> run();
+    my %run_args;
+    if ($$command{'live_stats'} and defined $writer) {
+        $run_args{progress_callback} = get_live_stats_callback (
+            landscape => $landscape,
+            writer    => $writer,
+            interval  => $$command{'live_stats_interval'},
+        );
+    }
+
+    $landscape -> run(%run_args);
     return { type => 'finished', finished => 'simulate' }
 }
 
+#  runs some of the repetitions of the loaded landscape (which needs
+#  RAND_STREAMS set), and saves their results in a Storable file
+#  for merge_repetitions
+sub simulate_repetitions {
+    my $command = shift;
+
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my $repetitions = $$command{'repetitions'};
+    my $filename    = $$command{'filename'};
+    if (not (defined $repetitions and defined $filename)) {
+        return { type => 'error', message => 'invalid parameters (need repetitions and filename)' };
+    }
+
+    my $results = eval {
+        $landscape -> run (repetitions => $repetitions);
+        $landscape -> get_repetition_results (repetitions => $repetitions);
+    };
+    if ($@) {
+        return { type => 'error', message => "simulate_repetitions: $@" };
+    }
+
+    nstore $results, $filename;
+    return { type => 'finished', finished => 'simulate_repetitions' }
+}
+
+#  merges the results saved by simulate_repetitions (by any number of
+#  workers) into the loaded landscape, in repetition order
+sub merge_repetitions {
+    my $command = shift;
+
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my %results;
+    foreach my $filename (@{$$command{'filenames'}}) {
+        my $file_results = retrieve ($filename);
+        @results{keys %$file_results} = values %$file_results;
+    }
+
+    eval { $landscape -> merge_repetition_results (results => \%results) };
+    if ($@) {
+        return { type => 'error', message => "merge_repetitions: $@" };
+    }
+
+    return { type => 'finished', finished => 'merge_repetitions' }
+}
+
+#  returns a progress callback for Sirca::Landscape::run that sends
+#  the updated means to the GUI.  Updates are batched so that at most
+#  one is sent per interval (seconds), plus one at the end of each
+#  repetition.
+sub get_live_stats_callback {
+    my %args = @_;
+    my $landscape = $args{landscape};
+    my $writer    = $args{writer};
+    my $interval  = $args{interval} // 0.5;
+
+    my $iterations = $landscape->get_param ('ITERATIONS');
+    my $last_sent  = 0;
+    my ($from, $to);
+
+    return sub {
+        my %progress = @_;
+
+        $from = $progress{from} if ! defined $from or $progress{from} < $from;
+        $to   = $progress{to}   if ! defined $to   or $progress{to}   > $to;
+
+        my $now = time();
+        return if $to < $iterations and $now - $last_sent < $interval;
+
+        $writer->(get_stats_update (
+            landscape  => $landscape,
+            repetition => $progress{repetition},
+            from       => $from,
+            to         => $to,
+        ));
+        $last_sent = $now;
+        $from = $to = undef;
+    };
+}
+
+#  the current means of each stat for timesteps from..to, as
+#  {stat => {model label => {s1 => [means], ...}}}
+sub get_stats_update {
+    my %args = @_;
+    my $landscape = $args{landscape};
+    my ($from, $to) = ($args{from}, $args{to});
+
+    my $model_stats   = $landscape->get_model_stats_ref;
+    my $master_models = $landscape->get_master_models;
+
+    my %update;
+    foreach my $stat_name (keys %$model_stats) {
+        foreach my $i (0 .. $#$master_models) {
+            my $label   = $master_models->[$i]->get_param ('LABEL');
+            my $by_time = $model_stats->{$stat_name}[$i];
+            foreach my $state (1 .. 3) {  #  CHEATING, as in Sirca::Landscape::init_models
+                my @means = map { $by_time->[$_][$state]->mean // 0 } ($from .. $to);
+                $update{$stat_name}{$label}{"s$state"} = \@means;
+            }
+        }
+    }
+
+    return {
+        type       => 'stats_update',
+        repetition => $args{repetition},
+        iterations => $landscape->get_param ('ITERATIONS'),
+        from       => $from,
+        to         => $to,
+        stats      => \%update,
+    };
+}
+
 # returns stats ('epicurve') data for a simulated landscape
 sub get_stats {
     if (not defined $landscape) {
@@ -139,6 +287,143 @@ sub get_stats {
     return { type => 'finished', finished => 'get_stats', stats => $stats }
 }
 
+# returns the names of the stats, for listing them without
+# sending all their data (get_stat sends the data of one)
+sub get_stats_manifest {
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my @names = sort keys %{$$landscape{'MODEL_STATS'} // {}};
+
+    return { type => 'finished', finished => 'get_stats_manifest', stats => \@names };
+}
+
+# returns one stat, in the same form as get_stats
+sub get_stat {
+    my $command = shift;
+
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my $name = $$command{'name'};
+    my $stat = $$landscape{'MODEL_STATS'}{$name};
+    if (not defined $stat) {
+    	return { type => 'error', message => "no stat $name" };
+    }
+
+    my $stats = clone ({MODEL_STATS => {$name => $stat}});
+    unbless ($stats);
+
+    return { type => 'finished', finished => 'get_stat', stats => $stats }
+}
+
+# returns the labels of the models (in model_iter order) that
+# get_map_data can be asked for, and the number of repetitions run
+sub get_map_models {
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my @labels = map { $_->get_param ('LABEL') } @{$landscape->get_master_models};
+
+    return { type => 'finished', finished => 'get_map_models',
+        models => \@labels,
+        repetitions => scalar @{$$landscape{'STORED_EVENTS'} // []} - 1 };
+}
+
+# returns a model's groups (coordinates, densities and initial states)
+# and the state and density changes from the stored group events of a
+# repetition.  The arrays are packed (see pack_array) so that large
+# landscapes don't need huge YAML documents.
+sub get_map_data {
+    my $command = shift;
+
+    if (not defined $landscape) {
+    	return { type => 'error', message => "landscape not loaded" };
+    }
+
+    my $model_iter = $$command{'model'} // 0;
+    my $repetition = $$command{'repetition'} // 1;
+
+    my $model = $landscape->get_master_models->[$model_iter];
+    if (not defined $model) {
+    	return { type => 'error', message => "no model $model_iter" };
+    }
+    my $default_state = $model->get_param ('DEFAULTSTATE');
+
+    my @group_ids = sort keys %{$model->get_groups_as_hash};
+    my %index;
+    @index{@group_ids} = (0 .. $#group_ids);
+
+    my (@x, @y, @density, @states);
+    foreach my $gp_id (@group_ids) {
+        my $gp_ref = $model->get_group_ref_aa ($gp_id);
+        my ($gx, $gy) = $gp_ref->get_coord_array;
+        push @x, $gx;
+        push @y, $gy;
+        push @density, $gp_ref->get_density;
+        push @states, $gp_ref->get_state // $default_state;
+    }
+
+    my $events = $landscape->get_stored_model_events (
+        repetition => $repetition,
+        model_iter => $model_iter,
+    );
+    my $by_time = $$events{'GROUPS'}{'BY_TIME'} // {};
+
+    #  in the same order as run_group_events would apply them
+    my (@state_times, @state_groups, @state_values);
+    my (@dens_times, @dens_groups, @dens_bodycounts);
+    foreach my $time_step (sort { $a <=> $b } keys %$by_time) {
+        my $by_group = $$by_time{$time_step};
+        foreach my $gp_id (sort keys %$by_group) {
+            next if ! exists $index{$gp_id};
+            my $gp_events = $$by_group{$gp_id};
+            foreach my $type (sort keys %$gp_events) {
+                my $event = $$gp_events{$type};
+                if (defined $$event{'state'}) {
+                    push @state_times,  $time_step;
+                    push @state_groups, $index{$gp_id};
+                    push @state_values, $$event{'state'};
+                }
+                if (defined $$event{'bodycount'}) {
+                    push @dens_times,      $time_step;
+                    push @dens_groups,     $index{$gp_id};
+                    push @dens_bodycounts, $$event{'bodycount'};
+                }
+            }
+        }
+    }
+
+    return { type => 'finished', finished => 'get_map_data',
+        label          => $model->get_param ('LABEL'),
+        iterations     => $landscape->get_param ('ITERATIONS'),
+        cellsize       => $model->get_param ('IMAGE_CELLSIZE'),
+        default_state  => $default_state,
+        density_params => $model->get_param ('DENSITYPARAMS'),
+        count          => scalar @group_ids,
+        x              => pack_array ('d', @x),
+        y              => pack_array ('d', @y),
+        density        => pack_array ('d', @density),
+        states         => pack_array ('l', @states),
+        state_times    => pack_array ('l', @state_times),
+        state_groups   => pack_array ('l', @state_groups),
+        state_values   => pack_array ('l', @state_values),
+        dens_times     => pack_array ('l', @dens_times),
+        dens_groups    => pack_array ('l', @dens_groups),
+        dens_bodycounts => pack_array ('d', @dens_bodycounts),
+    };
+}
+
+# packs an array as base64 encoded little endian doubles ('d')
+# or 32 bit integers ('l')
+sub pack_array {
+    my ($type, @values) = @_;
+    return encode_base64 (pack ("$type<*", @values), '');
+}
+
 # returns a loaded landscape's parameters
 sub get_parameters {
     if (not defined $landscape) {
@@ -154,16 +439,10 @@ sub get_parameters {
 sub read_parameters {
     my $command = shift;
     my $data = $$command{'data'};
-    
-    open (DATALOG, '>read_parameters.data.log');
-    print DATALOG $data;
-    close (DATALOG);
 
-    my $VAR1;
-    my $params = eval ($data);
+    my ($params, $error) = parse_parameters($data);
 
-    if ($@) {
-        my $error = $@;
+    if (defined $error) {
         $log->error("read_parameters: $error");
     	return { type => 'error', message => "error parsing parameters: $error" };
     } else {
@@ -172,12 +451,47 @@ sub read_parameters {
     }
 }
 
+#  several files at once (a control file's PARAMSFILES)
+#  files is a list of {name => filename, data => contents}
+#  the parameters are returned in the same order
+sub read_parameters_multi {
+    my $command = shift;
+    my $files = $$command{'files'};
+
+    my @parameters;
+    foreach my $file (@$files) {
+        my ($params, $error) = parse_parameters($$file{'data'});
+        if (defined $error) {
+            $log->error("read_parameters_multi: $$file{'name'}: $error");
+            return { type => 'error',
+                     message => "error parsing parameters in $$file{'name'}: $error" };
+        }
+        push @parameters, $params;
+    }
+
+    return { type => 'finished', finished => 'read_parameters_multi',
+        parameters => \@parameters };
+}
+
+#  returns (parameters, undef) or (undef, error)
+sub parse_parameters {
+    my $data = shift;
+
+    my $VAR1;
+    my $params = eval ($data);
+
+    return (undef, $@) if $@;
+    return ($params, undef);
+}
+
 # writes parameters from the GUI into Perl dict format that can be saved
 # into a control file
 sub write_parameters_as_control_file {
     my $command = shift;
     my $params = $$command{'params'};
 
+    #  sorted, so saving the same parameters gives the same file (as perl_data.py does)
+    local $Data::Dumper::Sortkeys = 1;
     return { type => 'finished', finished => 'write_parameters_as_control_file',
         control_file_data => Data::Dumper::Dumper($params) };
 }
@@ -3,7 +3,6 @@
 Handles display of statistics (epicurve) plots
 """
 
-import copy
 import wx
 import wx.lib.customtreectrl
 from wx.lib.mixins import treemixin
@@ -18,9 +17,12 @@ from matplotlib.backends.backend_wx import NavigationToolbar2Wx
 from matplotlib.figure import Figure
 
 
+import time
+
 import main
 import outputs
 import workspace
+import downsample
 
 class StatPlotData:
     """Represents data that can be plotted on a single graph
@@ -29,10 +31,10 @@ class StatPlotData:
     It may include several dimensions (eg: model -> state)
     """
 
-    def __init__(self, name, dimension_info, data_array):
+    def __init__(self, name, dimension_info, store):
         self.name = name
         self.dimension_info = dimension_info
-        self.data_array = data_array
+        self.store = store  # stat_store.StatSeriesStore - series loaded on demand
 
         # Build a tree heirarchy for implementing the "tree model" stuff
 
@@ -43,21 +45,42 @@ class StatPlotData:
             my_indices = my_level.keys()
             my_indices.sort()
 
+            # the children are never modified, so all the items
+            # at this level can share the one list
             children = build_hierarchy(dimensions[1:])
             tree_items = []
 
             for txt in my_indices:
-                tree_items.append( (txt, copy.copy(children) ) )
+                tree_items.append( (txt, children) )
 
             return tree_items
 
         if dimension_info is None:
             self.items = [ ('no graph selected', []) ]
         else:
-            temp = copy.copy(dimension_info)
-            self.items = build_hierarchy(temp)
+            self.items = build_hierarchy(dimension_info)
+
+        self.shown_plots = {} # plot index -> line object (checked series)
+        self.lines = {} # plot index -> line object (including hidden ones)
+        self.plot_panel = None
+
+        # lines are drawn downsampled to about max_points over the visible
+        # x range, from a cached min/max pyramid of each series
+        self.pyramids = {} # plot index -> downsample.SeriesPyramid
+        self.view_range = None # (start, stop) in timesteps, None for all
+        self.max_points = 2000
+        self.use_lttb = False
 
-        self.shown_plots = {} # plot index -> line object
+        # shown series whose data changed since their line was drawn
+        self.stale_lines = set()
+
+        # what was shown when the plot panel was last released,
+        # for RestorePlot
+        self.released_checked = []
+        self.released_limits = None
+
+        if store is not None:
+            store.RegisterEvictionCallback(self.OnSeriesEvicted)
 
         # initialise colour info
         #self.colour_list = ['blue', 'black', 'forestgreen', 'red', 'cyan', 'magenta', 'yellow',]
@@ -97,28 +120,75 @@ class StatPlotData:
         else:
             return self.GetLineColour(line)
 
+    def GetLeafIndices(self, indices=()):
+        """returns the indices of all the plottable items below indices"""
+        children = self.GetChildren(indices)
+        if len(children) == 0:
+            return [indices]
+        leaves = []
+        for i in range(len(children)):
+            leaves.extend(self.GetLeafIndices(indices + (i,)))
+        return leaves
+
 
     def SetChecked(self, indices, isChecked, tree, item):
 
-        if (not isChecked) and (self.shown_plots.get(indices) is not None):
-            # being unchecked.. remove plot
-            #print "%s: %s removed" % (self.name, str(indices))
-            line = self.shown_plots[indices]
-            lines = self.axes.lines
-            lines.pop(lines.index(line))
+        full_redraw = self.__set_checked(indices, isChecked)
 
-            del self.shown_plots[indices]
-            
+        line = self.shown_plots.get(indices)
+        if line is None:
             # set tree node colour to black
             tree.SetItemTextColour(item, wx.Color( 0,0,0,255 ))
+        else:
+            # set tree node colour to what matplotlib selected
+            tree.SetItemTextColour(item, self.GetLineColour(line))
+
+        # refresh (when idle, so that a burst of toggles draws once)
+        self.plot_panel.RequestRedraw(full_redraw)
+
+    def SetAllChecked(self, isChecked, tree, indices=()):
+        """checks or unchecks every series below indices with a single redraw"""
+        full_redraw = False
+        for leaf in self.GetLeafIndices(indices):
+            full_redraw = self.__set_checked(leaf, isChecked) or full_redraw
+
+        # picks up the check boxes and colours from this model
+        tree.RefreshItems()
+        self.plot_panel.RequestRedraw(full_redraw)
+
+    def __set_checked(self, indices, isChecked):
+        """shows or hides the line for a series.  Lines are only hidden when
+        unchecked, so that checking them again doesn't need a new line.
+
+        returns True if the axes limits changed (ie: needs a full redraw)
+        """
+
+        if (not isChecked) and (self.shown_plots.get(indices) is not None):
+            # being unchecked.. hide plot
+            #print "%s: %s removed" % (self.name, str(indices))
+            self.shown_plots.pop(indices).set_visible(False)
+
+            # the series may now be evicted if memory is short
+            self.store.Unpin(indices)
 
         elif isChecked and (self.shown_plots.get(indices) is None):
             # being checked.. show plot
 
             #print "%s: %s showing" % (self.name, str(indices))
-            # extract data points from our multidimensional array
-            data_points = self.data_array[indices]
-            time = arange(0, len(data_points) )
+            # hold on to the series while shown
+            self.store.Pin(indices)
+
+            line = self.lines.get(indices)
+            if line is not None:
+                # shown before, and still has its data
+                line.set_data(*self.GetView(indices))
+                line.set_visible(True)
+                self.shown_plots[indices] = line
+                return False
+
+            # load the series (if not already).  Plotted over the whole
+            # range so that the axes are scaled to fit all of it
+            (time, data_points) = self.GetView(indices, whole_range=True)
 
             # find colour
             #colour = self.GetNextColour()
@@ -128,15 +198,108 @@ class StatPlotData:
 
             # plot line
             #line = self.axes.plot(time, data_points, color=matplot_colour)[0]
+            limits = (self.axes.get_xlim(), self.axes.get_ylim())
             line = self.axes.plot(time, data_points)[0]
+            self.lines[indices] = line
             self.shown_plots[indices] = line
 
-            # set tree node colour to what matplotlib selected
-            tree.SetItemTextColour(item, self.GetLineColour(line))
+            # plotting may have rescaled the axes
+            return limits != (self.axes.get_xlim(), self.axes.get_ylim())
+
+        return False
 
-            
-        # refresh
-        self.canvas.draw()
+    def GetLines(self):
+        """returns the lines that are currently shown"""
+        return self.shown_plots.values()
+
+    # Level of detail
+
+    def GetView(self, indices, whole_range=False):
+        """returns the (x, y) points to draw for a series at the current zoom"""
+        pyramid = self.pyramids.get(indices)
+        if pyramid is None:
+            pyramid = downsample.SeriesPyramid(self.store.GetSeries(indices))
+            self.pyramids[indices] = pyramid
+        if whole_range or self.view_range is None:
+            (start, stop) = (0, pyramid.GetLength())
+        else:
+            (start, stop) = self.view_range
+
+        if self.use_lttb:
+            start = max(0, int(start))
+            stop = min(pyramid.GetLength(), int(stop) + 1)
+            return downsample.lttb(arange(start, stop),
+                                   pyramid.values[start:stop],
+                                   self.max_points)
+        return pyramid.GetView(start, stop, self.max_points)
+
+    def Resample(self, view_range, max_points):
+        """redoes the shown lines for a new x range (eg: after a zoom).
+        Hidden lines are redone when they are shown again."""
+        if (view_range, max_points) == (self.view_range, self.max_points):
+            return
+        self.view_range = view_range
+        self.max_points = max_points
+        for (indices, line) in self.shown_plots.iteritems():
+            line.set_data(*self.GetView(indices))
+
+    # Live updates (from a running simulation)
+
+    def UpdateSeries(self, indices, start, values):
+        """writes new values into a series from start onwards"""
+        self.store.SetRange(indices, start, values)
+        self.pyramids.pop(indices, None) # rebuilt when next drawn
+        if indices in self.shown_plots:
+            self.stale_lines.add(indices)
+            if self.plot_panel is not None:
+                self.plot_panel.RequestLiveRedraw()
+
+    def RefreshStaleLines(self):
+        """puts the new data into the lines of updated series.
+        Returns whether there were any."""
+        stale = [i for i in self.stale_lines if i in self.shown_plots]
+        self.stale_lines.clear()
+        for indices in stale:
+            self.shown_plots[indices].set_data(*self.GetView(indices))
+        return len(stale) > 0
+
+    # Rebuilding the plot panel
+
+    def ReleasePlot(self):
+        """forgets the lines and axes (when the plot panel is closed), but
+        keeps which series were checked and the zoom for RestorePlot"""
+        if self.plot_panel is None:
+            return
+        self.released_checked = self.shown_plots.keys()
+        self.released_limits = (self.axes.get_xlim(), self.axes.get_ylim())
+        for indices in self.shown_plots:
+            self.store.Unpin(indices)
+        self.shown_plots = {}
+        self.lines = {}
+        self.stale_lines.clear()
+        self.axes = self.canvas = self.plot_panel = None
+
+    def RestorePlot(self):
+        """plots the series that were shown when ReleasePlot was called,
+        at the same zoom.  Their downsampling pyramids are kept, so this
+        is quick unless the store has evicted them."""
+        # so that the lines are resampled for the restored zoom
+        self.view_range = None
+        for indices in self.released_checked:
+            self.__set_checked(indices, True)
+        if self.released_limits is not None:
+            (xlim, ylim) = self.released_limits
+            self.axes.set_xlim(xlim)
+            self.axes.set_ylim(ylim)
+        self.released_checked = []
+        self.released_limits = None
+
+    def OnSeriesEvicted(self, indices):
+        # the store dropped a hidden series, so drop its line too
+        self.pyramids.pop(indices, None)
+        line = self.lines.pop(indices, None)
+        if line is not None:
+            self.axes.lines.remove(line)
 
     def GetLineColour(self, line):
         colour_0to1 = matplotlib.colors.colorConverter.to_rgb( line.get_color() )
@@ -160,6 +323,9 @@ class StatPlotData:
     def SetCanvas(self, canvas):
         self.canvas = canvas
 
+    def SetPlotPanel(self, plot_panel):
+        self.plot_panel = plot_panel
+
     def __repr__(self):
         return "StatPlotData (name=%s)" % (self.name)
 
@@ -179,6 +345,21 @@ class OutputPlotPanel(wx.Panel, workspace.WorkspacePanel):
 
         stat_data.SetAxes(self.axes)
         stat_data.SetCanvas(self.canvas)
+        stat_data.SetPlotPanel(self)
+
+        # axes (without any series lines) as last drawn, for blitting
+        self.background = None
+        self.redraw_pending = False
+        self.full_redraw_pending = False
+        self.axes.callbacks.connect('xlim_changed', self.OnLimitsChanged)
+        self.axes.callbacks.connect('ylim_changed', self.OnLimitsChanged)
+        self.Bind(wx.EVT_IDLE, self.OnIdle)
+
+        # redraws for a running simulation are at most this often (seconds)
+        self.live_redraw_interval = 1.0
+        self.live_redraw_timer = None
+        self.last_live_redraw = 0
+        self.canvas.Bind(wx.EVT_SIZE, self.OnCanvasSize)
 
         #t = arange(0.0,3.0,0.01)
         #s = sin(2*pi*t)
@@ -193,6 +374,9 @@ class OutputPlotPanel(wx.Panel, workspace.WorkspacePanel):
 
         self.add_toolbar()  # comment this out for no toolbar
 
+        # as it was when last closed (if it was)
+        stat_data.RestorePlot()
+
 
     # WorkspacePanel methods
 
@@ -211,6 +395,15 @@ class OutputPlotPanel(wx.Panel, workspace.WorkspacePanel):
         plotsPanel.SetTreeModel( StatPlotData('no graph selected', None, None) )
         print "disactivated ", self.stat_data.name
 
+    def ReleaseResources(self):
+        if self.live_redraw_timer is not None:
+            self.live_redraw_timer.Stop()
+            self.live_redraw_timer = None
+        self.stat_data.ReleasePlot()
+        self.background = None
+        self.redraw_pending = False
+        self.figure.clear()
+
     def add_toolbar(self):
         self.toolbar = NavigationToolbar2Wx(self.canvas)
         self.toolbar.Realize()
@@ -232,9 +425,80 @@ class OutputPlotPanel(wx.Panel, workspace.WorkspacePanel):
         # update the axes menu on the toolbar
         self.toolbar.update()  
 
-        
+    # Drawing
+
+    def RequestRedraw(self, full=False):
+        """Schedules a redraw for the next idle event.
+
+        Changes to line visibility only need the lines blitted over the
+        cached background; full=True re-renders the whole figure (eg: when
+        the axes have been rescaled).
+        """
+        self.redraw_pending = True
+        self.full_redraw_pending = self.full_redraw_pending or full
+
+    def OnIdle(self, event):
+        if self.redraw_pending:
+            self.Redraw(self.full_redraw_pending)
+        event.Skip()
+
+    def Redraw(self, full=False):
+        self.redraw_pending = False
+        self.full_redraw_pending = False
+
+        if full or self.background is None:
+            # draw everything but the series lines and keep that as the
+            # background, then put the lines back on top
+            lines = self.stat_data.GetLines()
+            for line in lines:
+                line.set_visible(False)
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+            for line in lines:
+                line.set_visible(True)
+        else:
+            self.canvas.restore_region(self.background)
+
+        for line in self.stat_data.GetLines():
+            self.axes.draw_artist(line)
+        self.canvas.blit(self.axes.bbox)
+
+    def RequestLiveRedraw(self):
+        """Schedules a redraw for new data from a running simulation, no
+        sooner than live_redraw_interval after the previous one"""
+        if self.live_redraw_timer is not None:
+            return # already scheduled
+        wait = self.live_redraw_interval - (time.time() - self.last_live_redraw)
+        self.live_redraw_timer = wx.CallLater(max(1, int(wait * 1000)), self.OnLiveRedraw)
+
+    def OnLiveRedraw(self):
+        self.live_redraw_timer = None
+        if not self:
+            return # panel was closed in the meantime
+        self.last_live_redraw = time.time()
+        if self.stat_data.RefreshStaleLines():
+            # rescale to the new data
+            self.axes.relim()
+            self.axes.autoscale_view()
+            self.Redraw(True)
+
+    def OnLimitsChanged(self, axes):
+        # zoomed or panned, so the cached background is out of date
+        self.background = None
+
+        # and the lines need resampling for the new range.  Two points per
+        # pixel are enough to show every peak and trough
+        (width, height) = self.canvas.GetSizeTuple()
+        (start, stop) = self.axes.get_xlim()
+        self.stat_data.Resample( (start, stop), max(2 * width, 100) )
+
+    def OnCanvasSize(self, event):
+        self.background = None
+        self.RequestRedraw(True)
+        event.Skip()
+
     def OnPaint(self, event):
-        self.canvas.draw()
+        self.Redraw(True)
 
 
 class PlotTreeCtrl(treemixin.VirtualTree, wx.lib.customtreectrl.CustomTreeCtrl):
@@ -245,8 +509,16 @@ class PlotTreeCtrl(treemixin.VirtualTree, wx.lib.customtreectrl.CustomTreeCtrl):
         super(PlotTreeCtrl, self).__init__(*args, **kwargs)
 
         self.Bind(wx.lib.customtreectrl.EVT_TREE_ITEM_CHECKED, self.OnItemChecked)
+        self.Bind(wx.EVT_CONTEXT_MENU, self.OnContextMenu)
         self.CreateImageList()
 
+        # the context menu's items, bound once
+        self.menu_indices = ()
+        self.check_all_id = wx.NewId()
+        self.uncheck_all_id = wx.NewId()
+        self.Bind(wx.EVT_MENU, self.OnCheckAll, id=self.check_all_id)
+        self.Bind(wx.EVT_MENU, self.OnUncheckAll, id=self.uncheck_all_id)
+
     def CreateImageList(self):
         size = (16, 16)
         self.imageList = wx.ImageList(*size)
@@ -294,6 +566,29 @@ class PlotTreeCtrl(treemixin.VirtualTree, wx.lib.customtreectrl.CustomTreeCtrl):
     def OnGetItemTextColour(self, indices):
         return self.model.GetTextColour(indices)
 
+    def OnContextMenu(self, event):
+        if self.model.plot_panel is None:
+            return # nothing to plot on
+
+        # applies to the selected model, or everything if nothing is selected
+        item = self.GetSelection()
+        if item is None or not item.IsOk() or item == self.GetRootItem():
+            self.menu_indices = ()
+        else:
+            self.menu_indices = self.GetIndexOfItem(item)
+
+        menu = wx.Menu()
+        menu.Append(self.check_all_id, "Check all")
+        menu.Append(self.uncheck_all_id, "Uncheck all")
+        self.PopupMenu(menu)
+        menu.Destroy()
+
+    def OnCheckAll(self, event):
+        self.model.SetAllChecked(True, self, self.menu_indices)
+
+    def OnUncheckAll(self, event):
+        self.model.SetAllChecked(False, self, self.menu_indices)
+
 
 class PlotsPanel(wx.Panel):
     """ represents the plot tree in the main window (for the currently selected statistic)
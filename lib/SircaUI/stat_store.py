@@ -0,0 +1,205 @@
+# vim: set ts=4 sw=4 et :
+"""
+Lazily loaded, chunked storage for statistics (epicurve) series
+
+A statistic such as COUNT or DENSITY has one series per (model, state).
+Rather than holding a dense array for every series of every statistic,
+each StatSeriesStore loads a series from its loader the first time it
+is asked for, keeps it as a list of fixed-size chunks (optionally as
+float32), and hands it back to the shared MemoryBudget once it is no
+longer pinned (ie: no longer checked in the plot tree).  The budget
+evicts the least recently used unpinned series when over its limit.
+"""
+
+import logging
+import numpy
+from collections import OrderedDict
+
+DEFAULT_CHUNK_SIZE = 1024
+DEFAULT_DTYPE = numpy.float64
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024 # bytes of unpinned series kept around
+
+
+class MemoryBudget:
+    """Tracks unpinned series across all stores and evicts the least
+    recently used ones once the byte limit is exceeded"""
+    log = logging.getLogger('stats.MemoryBudget')
+
+    def __init__(self, limit=DEFAULT_MEMORY_BUDGET):
+        self.limit = limit
+        self.used = 0
+        self.unpinned = OrderedDict() # (store id, key) -> (store, key, nbytes)
+
+    def SetLimit(self, limit):
+        self.limit = limit
+        self.Enforce()
+
+    def Release(self, store, key, nbytes):
+        """called when a series is unpinned - it may now be evicted"""
+        entry_key = (id(store), key)
+        if entry_key in self.unpinned:
+            # refresh its position as most recently used
+            del self.unpinned[entry_key]
+        else:
+            self.used += nbytes
+        self.unpinned[entry_key] = (store, key, nbytes)
+        self.Enforce()
+
+    def Reclaim(self, store, key):
+        """called when a series is pinned again - it must not be evicted"""
+        entry = self.unpinned.pop((id(store), key), None)
+        if entry is not None:
+            self.used -= entry[2]
+
+    def Forget(self, store):
+        """drop all entries belonging to a store (eg: when it is discarded)"""
+        for entry_key in [k for k in self.unpinned if k[0] == id(store)]:
+            self.used -= self.unpinned.pop(entry_key)[2]
+
+    def Enforce(self):
+        while self.used > self.limit and len(self.unpinned) > 0:
+            entry_key, (store, key, nbytes) = self.unpinned.popitem(last=False)
+            self.used -= nbytes
+            self.log.debug('evicting %s %s (%d bytes)', store.name, key, nbytes)
+            store.Evict(key)
+
+# budget shared by all stores in this process
+g_memoryBudget = MemoryBudget()
+
+
+class StatSeriesStore:
+    """Chunked store for the series of a single statistic
+
+    loader(key) must return a sequence of values for the series
+    identified by key (an index tuple such as (model, state)).
+    Stores without a loader only hold values that have been set on
+    them and so never evict anything.
+    """
+    log = logging.getLogger('stats.StatSeriesStore')
+
+    def __init__(self, name, length, loader=None, dtype=DEFAULT_DTYPE,
+                 chunk_size=DEFAULT_CHUNK_SIZE, budget=None):
+        self.name = name
+        self.length = length
+        self.loader = loader
+        self.dtype = numpy.dtype(dtype)
+        self.chunk_size = chunk_size
+        if budget is None:
+            budget = g_memoryBudget
+        self.budget = budget
+
+        self.chunks = {}  # key -> list of chunk arrays
+        self.pinned = {}  # key -> pin count
+        self.eviction_callbacks = []
+
+    def Close(self):
+        """drops all loaded series and any claim on the memory budget"""
+        self.budget.Forget(self)
+        self.chunks = {}
+        self.pinned = {}
+
+    # loading
+
+    def IsLoaded(self, key):
+        return key in self.chunks
+
+    def GetLength(self):
+        return self.length
+
+    def GetSeries(self, key):
+        """returns the whole series as a single array, loading it if need be"""
+        chunks = self.__get_chunks(key)
+        if len(chunks) == 1:
+            return chunks[0][:self.length]
+        return numpy.concatenate(chunks)[:self.length]
+
+    def GetRange(self, key, start, stop):
+        """returns values [start, stop) touching only the chunks involved"""
+        chunks = self.__get_chunks(key)
+        start = max(0, start)
+        stop = min(self.length, stop)
+        if stop <= start:
+            return numpy.zeros(0, dtype=self.dtype)
+        first = start // self.chunk_size
+        last = (stop - 1) // self.chunk_size
+        data = numpy.concatenate(chunks[first:last + 1])
+        offset = first * self.chunk_size
+        return data[start - offset:stop - offset]
+
+    def SetRange(self, key, start, values):
+        """writes values into a series from start onwards (for stores
+        without a loader that are filled in as the data arrives)"""
+        chunks = self.__get_chunks(key)
+        values = numpy.asarray(values, dtype=self.dtype)[:max(0, self.length - start)]
+        pos = 0
+        while pos < len(values):
+            index = start + pos
+            offset = index % self.chunk_size
+            count = min(self.chunk_size - offset, len(values) - pos)
+            chunks[index // self.chunk_size][offset:offset + count] = values[pos:pos + count]
+            pos += count
+
+    def __get_chunks(self, key):
+        chunks = self.chunks.get(key)
+        if chunks is None:
+            if self.loader is None:
+                chunks = self.__allocate(key)
+            else:
+                chunks = self.__load(key)
+        if self.loader is not None and not self.pinned.get(key):
+            # nobody is holding on to it, so it can go when space is short.
+            # (also refreshes it as the most recently used)
+            self.budget.Release(self, key, self.__nbytes(chunks))
+        return chunks
+
+    def __load(self, key):
+        values = numpy.asarray(self.loader(key), dtype=self.dtype)
+        self.log.debug('loaded %s %s (%d values)', self.name, key, len(values))
+        chunks = []
+        for start in range(0, max(len(values), 1), self.chunk_size):
+            chunk = numpy.zeros(self.chunk_size, dtype=self.dtype)
+            piece = values[start:start + self.chunk_size]
+            chunk[:len(piece)] = piece
+            chunks.append(chunk)
+        self.chunks[key] = chunks
+        return chunks
+
+    def __allocate(self, key):
+        nchunks = max(1, (self.length + self.chunk_size - 1) // self.chunk_size)
+        chunks = [numpy.zeros(self.chunk_size, dtype=self.dtype) for i in range(nchunks)]
+        self.chunks[key] = chunks
+        return chunks
+
+    def __nbytes(self, chunks):
+        return sum([c.nbytes for c in chunks])
+
+    # pinning (checked series are pinned)
+
+    def Pin(self, key):
+        self.pinned[key] = self.pinned.get(key, 0) + 1
+        self.budget.Reclaim(self, key)
+
+    def Unpin(self, key):
+        count = self.pinned.get(key, 0) - 1
+        if count > 0:
+            self.pinned[key] = count
+            return
+        self.pinned.pop(key, None)
+        chunks = self.chunks.get(key)
+        if chunks is not None and self.loader is not None:
+            self.budget.Release(self, key, self.__nbytes(chunks))
+
+    def Evict(self, key):
+        if self.pinned.get(key):
+            return
+        self.budget.Reclaim(self, key)
+        if self.chunks.pop(key, None) is not None:
+            for callback in self.eviction_callbacks:
+                callback(key)
+
+    def RegisterEvictionCallback(self, callback):
+        """callback(key) is called after a series has been dropped"""
+        self.eviction_callbacks.append(callback)
+
+    def GetMemoryUsage(self):
+        return sum([self.__nbytes(c) for c in self.chunks.values()])
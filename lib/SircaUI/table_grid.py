@@ -0,0 +1,125 @@
+# vim: set ts=4 sw=4 et :
+"""
+This module defines a control for editing table fields
+found in SIRCA configuration files (eg: the TRANSITION
+matrix), which can have many thousands of rows
+
+The grid is virtual, so only the cells on screen are
+formatted, and edits are written straight back into
+the list of rows from the configuration
+"""
+import wx
+import wx.grid as gridlib
+import logging
+
+#---------------------------------------------------------------------------
+
+class RowsDataTable(gridlib.PyGridTableBase):
+    """Grid table over a list of rows (each a list of values)
+
+    The number of columns is the length of the last row (as for
+    the configuration files).  Cells past the end of shorter
+    rows are shown as blank and readonly.
+    """
+    log = logging.getLogger('config.RowsDataTable')
+    def __init__(self):
+        gridlib.PyGridTableBase.__init__(self)
+        self.rows = []
+        self.ncols = 0
+        self.change_callback = None # called after a cell is edited
+
+    #--------------------------------------------------
+    # data access
+
+    def SetRows(self, rows):
+        """shows rows (which edits are made to)"""
+        (old_nrows, old_ncols) = (len(self.rows), self.ncols)
+
+        self.rows = rows
+        self.ncols = 0
+        if len(rows) > 0:
+            self.ncols = len(rows[-1])
+
+        self.__signal_changed(gridlib.GRIDTABLE_NOTIFY_ROWS_APPENDED,
+                              gridlib.GRIDTABLE_NOTIFY_ROWS_DELETED,
+                              old_nrows, len(self.rows))
+        self.__signal_changed(gridlib.GRIDTABLE_NOTIFY_COLS_APPENDED,
+                              gridlib.GRIDTABLE_NOTIFY_COLS_DELETED,
+                              old_ncols, self.ncols)
+        self.__tell_grid(gridlib.GRIDTABLE_REQUEST_VIEW_GET_VALUES)
+
+    def GetRows(self):
+        return self.rows
+
+    def SetChangeCallback(self, callback):
+        self.change_callback = callback
+
+    #--------------------------------------------------
+    # required methods for the wxPyGridTableBase interface
+
+    def GetNumberRows(self):
+        return len(self.rows)
+
+    def GetNumberCols(self):
+        return self.ncols
+
+    def IsEmptyCell(self, row, col):
+        return col >= len(self.rows[row])
+
+    def GetValue(self, row, col):
+        """formats a cell (only called for the cells being drawn)"""
+        if self.IsEmptyCell(row, col):
+            return ''
+        return str(self.rows[row][col])
+
+    def SetValue(self, row, col, value):
+        if self.IsEmptyCell(row, col):
+            return # readonly
+        self.log.debug("field (%d,%d) changed to %s", row, col, value)
+        # no !!python/unicode pls, but non-ASCII text is kept (as UTF-8)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        self.rows[row][col] = str(value)
+        if self.change_callback is not None:
+            self.change_callback()
+
+    def GetAttr(self, row, col, someExtraParameter ):
+        """called to get custom formatting - readonly, fonts, colours,..."""
+        # empty cells are readonly
+        if self.IsEmptyCell(row, col):
+            attr = gridlib.GridCellAttr()
+            attr.SetReadOnly(1)
+            return attr
+        else:
+            # default
+            return None
+
+    def __signal_changed(self, appended_msg, deleted_msg, old_count, new_count):
+        if new_count > old_count:
+            self.__tell_grid(appended_msg, new_count - old_count)
+        elif new_count < old_count:
+            self.__tell_grid(deleted_msg, new_count, old_count - new_count)
+
+    def __tell_grid(self, *args):
+        msg = gridlib.GridTableMessage(self, *args)
+        view = self.GetView()
+        if view:
+            view.ProcessTableMessage(msg)
+
+
+class RowsTableGrid(gridlib.Grid):
+    """After creating call GetTable().SetRows()"""
+    def __init__(self, parent):
+        gridlib.Grid.__init__(self, parent, -1)
+
+        self.table = RowsDataTable()
+
+        # The second parameter means that the grid is to take ownership of the
+        # table and will destroy it when done.
+        self.SetTable(self.table, True)
+
+        self.SetColLabelAlignment(wx.ALIGN_LEFT, wx.ALIGN_BOTTOM)
+
+    def GetTable(self):
+        """Returns RowsDataTable that manages the grid"""
+        return self.table
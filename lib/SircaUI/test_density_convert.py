@@ -0,0 +1,115 @@
+# vim: set ts=4 sw=4 et :
+from density_convert import *
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+import numpy
+
+DENSITIES = """"x","y","density","state","farms"
+100,200,5,1,2
+101,200,0,,3
+102;200;-1;;4
+103;200;2.5;;
+
+104,201,,2,1
+"""
+
+def read_binary(filename):
+    """returns the records of a binary density file"""
+    f = open(filename, 'rb')
+    try:
+        assert f.read(len(MAGIC)) == MAGIC
+        (version, nrows, ncols) = struct.unpack('<III', f.read(12))
+        assert version == VERSION
+        fields = []
+        for i in range(ncols):
+            name = f.read(NAME_SIZE).rstrip('\0')
+            code = f.read(1)
+            fields.append( (name, {'d' : '<f8', 'l' : '<i4'}[code]) )
+        records = numpy.fromfile(f, dtype=numpy.dtype(fields))
+    finally:
+        f.close()
+    assert len(records) == nrows
+    return records
+
+class TestDensityConvert(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.out_filename = os.path.join(self.dir, 'densities.sdb')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeCSV(self, text):
+        filename = os.path.join(self.dir, 'densities.csv')
+        f = open(filename, 'wb')
+        f.write(text)
+        f.close()
+        return filename
+
+    def testConvert(self):
+        filename = self.writeCSV(DENSITIES)
+        # chunks smaller than the file, and one of only a blank line
+        self.assertEquals(convert(filename, self.out_filename, chunk_rows=2), 3)
+
+        records = read_binary(self.out_filename)
+        self.assertEquals(records.dtype.names, ('X', 'Y', 'DENSITY', 'STATE', 'FARMS'))
+        # densities <= 0 are dropped, but no density is kept
+        self.assertEquals(list(records['X']), [100, 103, 104])
+        self.assertEquals(records['DENSITY'][0], 5)
+        self.assertEquals(records['DENSITY'][1], 2.5)
+        self.assert_(numpy.isnan(records['DENSITY'][2]))
+        # blanks are masked
+        self.assertEquals(list(records['STATE']), [1, NO_STATE, 2])
+        self.assertEquals(records['FARMS'][0], 2)
+        self.assert_(numpy.isnan(records['FARMS'][1]))
+
+    def testSnap(self):
+        filename = self.writeCSV("x,y,density\n"
+                                 "104,96,1\n"
+                                 "116,111,1\n")
+        convert(filename, self.out_filename, cellsize=10, origin=(5, 0))
+        records = read_binary(self.out_filename)
+        self.assertEquals(list(records['X']), [105, 115])
+        self.assertEquals(list(records['Y']), [100, 110])
+
+    def testDuplicatesAfterSnapping(self):
+        filename = self.writeCSV("x,y,density\n"
+                                 "101,99,1\n"
+                                 "200,200,1\n"
+                                 "99,102,1\n")
+        # distinct as given
+        self.assertEquals(convert(filename, self.out_filename), 3)
+        # the same cell once snapped, across chunks
+        self.assertRaises(DensityConvertError, convert, filename, self.out_filename,
+                          cellsize=10, chunk_rows=1)
+        self.failIf(os.path.exists(self.out_filename))
+
+    def testInvalid(self):
+        header = read_header('X,Y,DENSITY,STATE')
+        self.assertEquals(header, ['X', 'Y', 'DENSITY', 'STATE'])
+        rows = [['100', '200', '1', '1'],
+                ['', '200', '1', '1'],
+                ['100', 'north', '1', '1'],
+                ['100', '200', '1', '1.5'],
+                ['100', '200', '1', '-2'],
+                ['100', '200', '1', '1', '7']]
+        (records, errors) = get_records(rows, numpy.arange(2, 8), header, get_dtype(header))
+        self.assertEquals(errors, [
+            "line 3: no X",
+            "line 4: Y isn't a number",
+            "line 5: STATE isn't a whole number",
+            "line 6: STATE is below 0",
+            "line 7: more than 4 columns",
+        ])
+
+    def testNoCoordinates(self):
+        filename = self.writeCSV("x,density\n100,1\n")
+        self.assertRaises(DensityConvertError, convert, filename, self.out_filename)
+        self.failIf(os.path.exists(self.out_filename))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# vim: set ts=4 sw=4 et :
+from event_io import *
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from lxml import etree
+
+TYPES = """<field name='GROUP_EVENTS' type='eventstable'>
+    <type name='GROUP_CULL' display='Group Cull'>
+        <field name='group' type='string' default='' />
+        <field name='fraction' type='float' min='0' max='1' default='0.5' />
+    </type>
+    <type name='GROUP_VACCINATE' display='Group Vaccinate'>
+        <field name='group' type='string' default='' />
+        <field name='count' type='integer' min='1' default='10' />
+    </type>
+</field>
+"""
+
+def make_columns(header, rows):
+    columns = numpy.array(rows, dtype=str)
+    return dict(zip(header, columns.T))
+
+class TestEventIO(unittest.TestCase):
+    def setUp(self):
+        self.event_types = get_event_types(etree.fromstring(TYPES))
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def writeCSV(self, text):
+        filename = os.path.join(self.dir, 'events.csv')
+        f = open(filename, 'wb')
+        f.write(text)
+        f.close()
+        return filename
+
+    def testToFloat(self):
+        numbers = to_float(['1', '', '2.5'])
+        self.assertEquals(numbers[0], 1.0)
+        self.assert_(numpy.isnan(numbers[1]))
+        self.assertEquals(numbers[2], 2.5)
+
+        numbers = to_float(['x', '3'])
+        self.assert_(numpy.isnan(numbers[0]))
+        self.assertEquals(numbers[1], 3.0)
+
+        self.assertEquals(list(is_integer(to_float(['1', '1.5', '', 'x']))),
+                          [True, False, False, False])
+
+    def testBlanksGetDefaults(self):
+        # the blank fraction isn't an error, and the unused count is masked
+        filename = self.writeCSV("time,type,group,fraction,count\n"
+                                 "40,GROUP_CULL,a:b,,\n"
+                                 "41,GROUP_VACCINATE,c:d,,5\n")
+        events = read_events(filename, self.event_types)
+        self.assertEquals(events, [
+            { 'time' : 40, 'type' : 'GROUP_CULL',
+              'params' : { 'group' : 'a:b', 'fraction' : '0.5' } },
+            { 'time' : 41, 'type' : 'GROUP_VACCINATE',
+              'params' : { 'group' : 'c:d', 'count' : '5' } },
+        ])
+
+    def testInvalid(self):
+        header = ['time', 'type', 'group', 'fraction', 'count']
+        columns = make_columns(header, [
+            ['40', 'GROUP_CULL', 'a', '1.5', ''],     # above max
+            ['x', 'GROUP_CULL', 'a', '0.5', ''],      # bad time
+            ['40', 'GROUP_CULL', 'a', 'lots', ''],    # not a number
+            ['40', 'GROUP_VACCINATE', 'a', '', '2.5'],# not whole
+            ['40', 'GROUP_VACCINATE', '', '', '0'],   # no group, below min
+            ['40', 'GROUP_CULL', 'a', '', '3'],       # not a parameter
+            ['40', 'FLY', '', '', ''],                # unknown type
+        ])
+        errors = check_chunk(columns, 2, self.event_types)
+        self.assertEquals(errors, [
+            "line 2: fraction is above 1",
+            "line 3: time isn't a whole number >= 0",
+            "line 4: fraction isn't a number",
+            "line 5: count isn't a whole number",
+            "line 6: count is below 1",
+            "line 6: group isn't given",
+            "line 7: count isn't a parameter of GROUP_CULL",
+            "line 8: unknown event type",
+        ])
+
+    def testMissingGroupColumn(self):
+        filename = self.writeCSV("time,type,fraction\n"
+                                 "40,GROUP_CULL,0.5\n")
+        self.assertRaises(EventIOError, read_events, filename, self.event_types)
+
+    def testNoTypeColumn(self):
+        filename = self.writeCSV("time,group\n40,a\n")
+        self.assertRaises(EventIOError, read_events, filename, self.event_types)
+
+    def testRoundTrip(self):
+        events = [
+            { 'time' : 40, 'type' : 'GROUP_CULL',
+              'params' : { 'group' : 'a:b', 'fraction' : '0.25' } },
+            { 'time' : 3, 'type' : 'GROUP_VACCINATE',
+              'params' : [ ('group', 'c:d'), ('count', '7') ] },
+            { 'time' : 40, 'type' : 'GROUP_CULL',
+              'params' : { 'group' : 'e:f', 'fraction' : '1' } },
+        ]
+        expected = [dict(event, params=dict(event['params'])) for event in events]
+        for name in ('events.csv', 'events.npz'):
+            filename = os.path.join(self.dir, name)
+            write_events(filename, events)
+            # chunks smaller than the file, so they are joined in order
+            self.assertEquals(read_events(filename, self.event_types, chunk_rows=2),
+                              expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# vim: set ts=4 sw=4 et :
+from metadata_index import *
+import os
+import shutil
+import tempfile
+import unittest
+
+import metadata_index
+
+METADATA = """<controlfile>
+    <section name='MODEL'>
+        <!-- a comment -->
+        <field name='LABEL' type='text'>
+            <default value='pig' />
+        </field>
+        <field name='GROUP_EVENTS' type='eventstable'>
+            <type name='GROUP_CULL' display='Group Cull'>
+                <field name='group' type='string' default='' />
+                <field name='fraction' type='float' min='0' max='1' default='0.5' />
+            </type>
+        </field>
+    </section>
+</controlfile>
+"""
+
+def walk(node):
+    yield node
+    for child in node:
+        for n in walk(child):
+            yield n
+
+class TestMetadataIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'metadata.xml')
+        f = open(self.filename, 'w')
+        f.write(METADATA)
+        f.close()
+        self.cache_dir = metadata_index.CACHE_DIR
+        metadata_index.CACHE_DIR = os.path.join(self.dir, 'cache')
+        g_indices.clear()
+
+    def tearDown(self):
+        metadata_index.CACHE_DIR = self.cache_dir
+        g_indices.clear()
+        shutil.rmtree(self.dir)
+
+    def testCacheRoundTrip(self):
+        built = get_metadata_index(self.filename)
+        self.assertEquals(len(os.listdir(metadata_index.CACHE_DIR)), 1)
+        self.assertEquals(os.stat(metadata_index.CACHE_DIR).st_mode & 0777, 0700)
+
+        g_indices.clear()
+        cached = get_metadata_index(self.filename)
+        self.assertNotEquals(id(built), id(cached))
+        self.assertEquals(cached.order, built.order)
+        self.assertEquals(cached.SortFields({'GROUP_EVENTS' : 1, 'LABEL' : 2, 'X' : 3}),
+                          [('LABEL', 2), ('GROUP_EVENTS', 1), ('X', 3)])
+
+        events = cached.GetFields('GROUP_EVENTS')[0]
+        self.assertEquals([f.get('name') for f in events.find('type')], ['group', 'fraction'])
+
+        # cached starts must give what a cold start does (str, not unicode)
+        for index in (built, cached):
+            for name in index.fields.keys() + index.order.keys():
+                self.assert_(type(name) is str)
+            for nodes in index.fields.values():
+                for node in walk(nodes[0]):
+                    self.assert_(type(node.tag) is str)
+                    self.assert_(node.text is None or type(node.text) is str)
+                    for (name, value) in node.attrib.items():
+                        self.assert_(type(name) is str and type(value) is str)
+
+    def testChangedFileIsReindexed(self):
+        get_metadata_index(self.filename)
+        f = open(self.filename, 'w')
+        f.write(METADATA.replace("'pig'", "'cow'  "))
+        f.close()
+        g_indices.clear()
+        index = get_metadata_index(self.filename)
+        self.assertEquals(index.GetFields('LABEL')[0].find('default').get('value'), 'cow')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# vim: set ts=4 sw=4 et :
+from perl_data import *
+import unittest
+
+DUMPED = """$VAR1 = {
+          'GLOBAL_EVENTS' => {
+                               '40' => [
+                                         {
+                                           'fraction' => '0.5',
+                                           'type' => 'CULL'
+                                         }
+                                       ]
+                             },
+          'MODELS' => [
+                        {
+                          'LABEL' => 'pig',
+                          'TRANSITIONS' => [
+                                             [],
+                                             [
+                                               '7',
+                                               '13'
+                                             ]
+                                           ]
+                        }
+                      ],
+          'MODEL_RUNS' => 10,
+          'OUTPFX' => 'C:\\\\sirca\\\\o\\'brien',
+          'SEED' => undef
+        };
+"""
+
+class TestPerlData(unittest.TestCase):
+    def testLoadDumper(self):
+        data = loads(DUMPED)
+        self.assertEquals(data['MODEL_RUNS'], 10)
+        self.assertEquals(data['OUTPFX'], "C:\\sirca\\o'brien")
+        self.assertEquals(data['SEED'], None)
+        self.assertEquals(data['MODELS'][0]['TRANSITIONS'], [[], ['7', '13']])
+        self.assertEquals(data['GLOBAL_EVENTS']['40'][0]['type'], 'CULL')
+
+    def testRoundTrip(self):
+        self.assertEquals(dumps(loads(DUMPED)), DUMPED)
+
+    def testHandWritten(self):
+        text = """# a control file
+        {
+            MODEL_RUNS => 2,   # comment
+            LABEL => "pig\\tfarm",
+            -flag => 1.5e3,
+            LIST => [1, 2, 3,],
+            7 => 'seven',
+        }"""
+        data = loads(text)
+        self.assertEquals(data, { 'MODEL_RUNS' : 2, 'LABEL' : 'pig\tfarm',
+                                  '-flag' : 1500.0, 'LIST' : [1, 2, 3],
+                                  '7' : 'seven' })
+
+    def testUnsupported(self):
+        for text in ["{ A => 1 + 2 }",
+                     "{ A => $x }",
+                     '{ A => "$x" }',
+                     "{ A => 010 }",
+                     "{ A => qw(a b) }",
+                     "$VAR1 = { A => [] }; $VAR1->{B} = $VAR1->{A};",
+                     "{ A => 1, B }"]:
+            self.assertRaises(PerlDataError, loads, text)
+
+    def testDumpNumbers(self):
+        self.assertEquals(dumps([0, -5, 1234567890, 0.5, '1']),
+                          "$VAR1 = [\n          0,\n          -5,\n          '1234567890',\n"
+                          "          '0.5',\n          '1'\n        ];\n")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,9 @@
 # vim: set ts=4 sw=4 et :
+from collections import OrderedDict
+
+# panels kept open in the workspace, unless set otherwise in the config
+DEFAULT_PANEL_LIMIT = 12
+
 class WorkspacePanel:
     """Base class for panels being shown in central notebok of the main window"""
 
@@ -20,3 +25,50 @@ class WorkspacePanel:
     def OnDeactivate(self):
        """called when this notebook page loses the selection"""
        pass
+
+    def ReleaseResources(self):
+        """called before the panel is closed, to free anything
+        that won't be freed with the window (eg: figures) and to keep
+        whatever is needed to rebuild it quickly"""
+        pass
+
+
+class PanelManager:
+    """Keeps track of the panels open in the workspace notebook, by the
+    id of their key.  If there are more than the limit, the least recently
+    activated are closed, to be rebuilt from their key if shown again."""
+
+    def __init__(self, notebook, limit=DEFAULT_PANEL_LIMIT):
+        self.notebook = notebook
+        self.limit = max(limit, 1)
+        self.panels = OrderedDict() # least recently activated first
+
+    def GetPanel(self, key):
+        return self.panels.get(id(key))
+
+    def AddPanel(self, panel, key):
+        self.panels[id(key)] = panel
+        self.__evict()
+
+    def Activated(self, panel):
+        """moves panel to the most recently activated"""
+        key = id(panel.GetKey())
+        if self.panels.pop(key, None) is not None:
+            self.panels[key] = panel
+
+    def Closed(self, panel):
+        """called when the user closes the page of panel"""
+        self.panels.pop(id(panel.GetKey()), None)
+        panel.ReleaseResources()
+
+    def SetLimit(self, limit):
+        self.limit = max(limit, 1)
+        self.__evict()
+
+    def __evict(self):
+        while len(self.panels) > self.limit:
+            (key, panel) = self.panels.popitem(last=False)
+            panel.ReleaseResources()
+            pageID = self.notebook.GetPageIndex(panel)
+            if pageID >= 0:
+                self.notebook.DeletePage(pageID)